@@ -0,0 +1,354 @@
+import os
+import pathlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .SGLXMetaToCoords import readMeta, OriginalChans, ChannelCountsIM, MetaToCoords
+from .utils import printProgressBar, get_cluster_spike_index
+
+
+def calculate_cluster_waveforms(spikeglx_bin,
+                                clus_table_npy,
+                                clus_time_npy,
+                                clus_lbl_npy,
+                                dest,
+                                samples_per_spike = 82,
+                                pre_samples = 20,
+                                num_spikes = 1000,
+                                snr_radius = 8,
+                                prefix = '',
+                                num_threads = 4,
+                                chunk_samples = 300000,
+                                noise_samples = 15):
+
+    """
+    Calculates the mean waveform and SNR of every cluster from a SpikeGLX binary
+
+    In-process replacement for the C_Waves command line tool, with the same
+    inputs and output files. Up to num_spikes spikes, evenly spaced through
+    the recording, are averaged for each cluster. The binary is read once, in
+    time order, in chunks that are processed in parallel by a pool of threads.
+
+    The SNR is (Vmax - Vmin) of the mean waveform on the peak channel divided
+    by 2*sqrt(variance), where the variance of the residuals (waveform - mean)
+    is taken over the first noise_samples samples of all sites within
+    snr_radius sites of the peak channel.
+
+    Inputs:
+    -------
+    spikeglx_bin : str
+        Path to the AP band binary; the .meta file must be next to it
+    clus_table_npy : str
+        Path to clus_Table.npy (spike count, peak channel) written by getSortResults
+    clus_time_npy : str
+        Path to spike times (in samples)
+    clus_lbl_npy : str
+        Path to cluster label for each spike
+    dest : str
+        Output directory
+    samples_per_spike : int
+        Number of samples in each waveform
+    pre_samples : int
+        Number of samples before the spike time
+    num_spikes : int
+        Maximum number of spikes averaged for each cluster
+    snr_radius : int
+        Radius (in sites) of the disk around the peak channel used for the SNR
+    prefix : str
+        Prefix for the output file names
+    num_threads : int
+        Number of threads reading and summing waveforms
+    chunk_samples : int
+        Number of samples read from the binary in each task
+    noise_samples : int
+        Number of samples at the start of the waveform used for the SNR variance
+
+    Outputs:
+    --------
+    mean_waveforms_file : str
+        Path to [prefix_]mean_waveforms.npy, float32 (clusters x AP channels x samples), in uV
+    snr_file : str
+        Path to [prefix_]cluster_snr.npy, (clusters x 2) : SNR, number of spikes averaged
+
+    """
+
+    clus_table = np.load(clus_table_npy)
+    spike_times = np.squeeze(np.load(clus_time_npy)).astype('int64')
+    spike_clusters = np.squeeze(np.load(clus_lbl_npy)).astype('int64')
+
+    num_saved_channels, uv_per_bit, site_x, site_y = read_binary_info(spikeglx_bin)
+    num_ap_channels = uv_per_bit.size
+
+    raw_data = np.memmap(spikeglx_bin, dtype = 'int16', mode = 'r')
+    raw_data = np.reshape(raw_data, (int(raw_data.size / num_saved_channels), num_saved_channels))
+
+    num_clusters = clus_table.shape[0]
+    peak_channels = clus_table[:,1].astype('int64')
+
+    spike_inds, spike_groups = select_cluster_spikes(spike_clusters, num_clusters, num_spikes)
+
+    start_samples = spike_times[spike_inds] - pre_samples
+    is_valid = (start_samples >= 0) * (start_samples + samples_per_spike <= raw_data.shape[0])
+    order = np.argsort(start_samples[is_valid], kind = 'stable')
+    start_samples = start_samples[is_valid][order]
+    spike_groups = spike_groups[is_valid][order]
+
+    # sums of the raw (int16) samples are exact in int64
+    sums = np.zeros((num_clusters, samples_per_spike, num_ap_channels), dtype = 'int64')
+    noise_sum_sq = np.zeros((num_clusters, noise_samples, num_ap_channels), dtype = 'int64')
+    counts = np.zeros((num_clusters,), dtype = 'int64')
+
+    if start_samples.size > 0:
+
+        chunk_starts = np.arange(start_samples[0] - start_samples[0] % chunk_samples, start_samples[-1] + 1, chunk_samples)
+        chunk_bounds = np.searchsorted(start_samples, np.append(chunk_starts, start_samples[-1] + 1))
+
+        def sum_chunk(chunk_idx):
+            return sum_waveforms(raw_data,
+                                 start_samples[chunk_bounds[chunk_idx]:chunk_bounds[chunk_idx+1]],
+                                 spike_groups[chunk_bounds[chunk_idx]:chunk_bounds[chunk_idx+1]],
+                                 samples_per_spike, num_ap_channels, noise_samples)
+
+        def add_chunk(chunk_idx, result):
+            groups, group_sums, group_sum_sq, group_counts = result
+            sums[groups] += group_sums
+            noise_sum_sq[groups] += group_sum_sq
+            counts[groups] += group_counts
+            printProgressBar(chunk_idx + 1, len(chunk_starts))
+
+        # at most num_threads chunks are in flight, so at most num_threads 
+        # per-chunk sums are held at once; each is added to the totals (in 
+        # chunk order) before the next chunk is submitted
+        with ThreadPoolExecutor(max_workers = num_threads) as pool:
+            pending = deque()
+            for chunk_idx in range(len(chunk_starts)):
+                if len(pending) == num_threads:
+                    done_idx, future = pending.popleft()
+                    add_chunk(done_idx, future.result())
+                pending.append((chunk_idx, pool.submit(sum_chunk, chunk_idx)))
+            while len(pending) > 0:
+                done_idx, future = pending.popleft()
+                add_chunk(done_idx, future.result())
+
+    mean_waveforms = np.zeros((num_clusters, num_ap_channels, samples_per_spike), dtype = 'float32')
+    cluster_snr = np.zeros((num_clusters, 2))
+    cluster_snr[:,1] = counts
+
+    disk_distance = snr_radius * get_vertical_pitch(site_y)
+
+    for cluster_idx in np.flatnonzero(counts):
+
+        n = counts[cluster_idx]
+        mean_wv = sums[cluster_idx] / n * uv_per_bit           # samples x channels
+        mean_waveforms[cluster_idx] = mean_wv.T
+
+        peak_channel = peak_channels[cluster_idx]
+
+        if n < 2 or peak_channel >= num_ap_channels:
+            continue
+
+        if disk_distance > 0:
+            in_disk = np.sqrt((site_x - site_x[peak_channel])**2 + (site_y - site_y[peak_channel])**2) <= disk_distance
+        else:
+            in_disk = np.abs(np.arange(num_ap_channels) - peak_channel) <= snr_radius
+
+        noise_mean = sums[cluster_idx, :noise_samples, in_disk].T / n
+        residual_sum_sq = (noise_sum_sq[cluster_idx, :, in_disk].T - n * noise_mean**2) * uv_per_bit[in_disk]**2
+
+        # one degree of freedom is used by the mean at each point
+        num_points = noise_mean.size
+        variance = np.sum(residual_sum_sq) / (n * num_points - num_points)
+
+        if variance > 0:
+            cluster_snr[cluster_idx,0] = (np.max(mean_wv[:,peak_channel]) - np.min(mean_wv[:,peak_channel])) / (2 * np.sqrt(variance))
+
+    if len(prefix) > 0:
+        prefix = prefix + '_'
+
+    mean_waveforms_file = os.path.join(dest, prefix + 'mean_waveforms.npy')
+    snr_file = os.path.join(dest, prefix + 'cluster_snr.npy')
+
+    np.save(mean_waveforms_file, mean_waveforms)
+    np.save(snr_file, cluster_snr)
+
+    return mean_waveforms_file, snr_file
+
+
+def select_cluster_spikes(spike_clusters, num_clusters, num_spikes):
+
+    """
+    Selects up to num_spikes spikes from each cluster, evenly spaced in time
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (N x 0)
+        Cluster label for each spike (spikes in time order)
+    num_clusters : int
+        Number of cluster labels
+    num_spikes : int
+        Maximum number of spikes per cluster
+
+    Outputs:
+    --------
+    spike_inds : numpy.ndarray
+        Indices of the selected spikes
+    spike_groups : numpy.ndarray
+        Cluster label of each selected spike
+
+    """
+
+    spike_order, cluster_offsets = get_cluster_spike_index(spike_clusters, num_clusters)
+
+    total_counts = np.diff(cluster_offsets)
+    selected_counts = np.minimum(total_counts, num_spikes)
+
+    spike_groups = np.repeat(np.arange(num_clusters), selected_counts)
+    position = np.arange(spike_groups.size) - np.repeat(np.cumsum(selected_counts) - selected_counts, selected_counts)
+    position = position * total_counts[spike_groups] // selected_counts[spike_groups]
+
+    return spike_order[cluster_offsets[spike_groups] + position], spike_groups
+
+
+def sum_waveforms(raw_data, start_samples, groups, samples_per_spike, num_channels, noise_samples, batch_size = 256):
+
+    """
+    Sums the waveforms of each group for one time-ordered block of spikes
+
+    Inputs:
+    -------
+    raw_data : numpy.ndarray (samples x channels), int16
+    start_samples : numpy.ndarray
+        First sample of each waveform, in increasing order
+    groups : numpy.ndarray
+        Group (cluster) of each waveform
+    samples_per_spike : int
+    num_channels : int
+        Number of channels (from the first) to sum
+    noise_samples : int
+        Number of samples at the start of each waveform for which the sum
+        of squares is also returned
+
+    Outputs:
+    --------
+    unique_groups : numpy.ndarray
+    sums : numpy.ndarray (groups x samples x channels), int64
+    sum_sq : numpy.ndarray (groups x noise_samples x channels), int64
+    counts : numpy.ndarray (groups)
+
+    """
+
+    unique_groups = np.unique(groups)
+
+    sums = np.zeros((unique_groups.size, samples_per_spike, num_channels), dtype = 'int64')
+    sum_sq = np.zeros((unique_groups.size, noise_samples, num_channels), dtype = 'int64')
+    counts = np.zeros((unique_groups.size,), dtype = 'int64')
+
+    if start_samples.size == 0:
+        return unique_groups, sums, sum_sq, counts
+
+    chunk_start = start_samples[0]
+    chunk = np.asarray(raw_data[chunk_start:start_samples[-1] + samples_per_spike, :num_channels])
+
+    offsets = np.arange(samples_per_spike)
+
+    for batch_start in range(0, start_samples.size, batch_size):
+
+        batch = np.arange(batch_start, min(batch_start + batch_size, start_samples.size))
+        batch = batch[np.argsort(groups[batch], kind = 'stable')]
+
+        # waveforms x samples x channels
+        snippets = chunk[(start_samples[batch] - chunk_start)[:, np.newaxis] + offsets, :]
+
+        batch_groups, group_starts, batch_counts = np.unique(groups[batch], return_index = True, return_counts = True)
+        group_inds = np.searchsorted(unique_groups, batch_groups)
+
+        noise = snippets[:, :noise_samples, :].astype('int64')
+
+        sums[group_inds] += np.add.reduceat(snippets, group_starts, axis = 0, dtype = 'int64')
+        sum_sq[group_inds] += np.add.reduceat(noise * noise, group_starts, axis = 0)
+        counts[group_inds] += batch_counts
+
+    return unique_groups, sums, sum_sq, counts
+
+
+def read_binary_info(spikeglx_bin):
+
+    """
+    Reads channel counts, AP gains and site positions from the SpikeGLX .meta file
+
+    Inputs:
+    -------
+    spikeglx_bin : str
+        Path to the AP band binary
+
+    Outputs:
+    --------
+    num_saved_channels : int
+        Number of channels in the binary (including SY)
+    uv_per_bit : numpy.ndarray
+        Conversion from raw values to uV for each AP channel
+    site_x, site_y : numpy.ndarray
+        Site positions (um) for each AP channel; empty if the geometry
+        cannot be read from the metadata
+
+    """
+
+    meta_path = pathlib.Path(spikeglx_bin).with_suffix('.meta')
+
+    if not meta_path.exists():
+        raise FileNotFoundError('SpikeGLX metadata not found: ' + str(meta_path))
+
+    meta = readMeta(meta_path)
+
+    num_saved_channels = int(meta['nSavedChans'])
+    AP, LF, SY = ChannelCountsIM(meta)
+
+    if 'imDatPrb_type' in meta:
+        probe_type = int(meta['imDatPrb_type'])
+    else:
+        probe_type = 0    # 3A probe
+
+    imro_list = meta['imroTbl'].split(sep=')')[1:-1]
+
+    if probe_type in (21, 24) or probe_type >= 2000:
+        # NP 2.0; APGain = 80 for all channels, 14 bit ADC
+        gains = np.full((len(imro_list),), 80.0)
+        range_max, max_int = 0.5, 8192
+    else:
+        # NP 1.0-like; per channel AP gain is the 4th imro entry, 10 bit ADC
+        gains = np.array([float(entry[1:].split(' ')[3]) for entry in imro_list])
+        range_max, max_int = 0.6, 512
+
+    range_max = float(meta.get('imAiRangeMax', range_max))
+    max_int = float(meta.get('imMaxInt', max_int))
+
+    chans = OriginalChans(meta)[0:AP]
+    uv_per_bit = 1e6 * range_max / max_int / gains[chans]
+
+    try:
+        site_x, site_y, shank_ind = MetaToCoords(meta_path, -1)
+        site_x = np.asarray(site_x, dtype = 'float64') + 250 * np.asarray(shank_ind)
+        site_y = np.asarray(site_y, dtype = 'float64')
+    except (KeyError, IndexError, ValueError):
+        site_x = np.zeros((0,))
+        site_y = np.zeros((0,))
+
+    if site_x.size != AP:
+        site_x = np.zeros((0,))
+        site_y = np.zeros((0,))
+
+    return num_saved_channels, uv_per_bit, site_x, site_y
+
+
+def get_vertical_pitch(site_y):
+
+    """ Smallest vertical distance between sites (0 if unknown) """
+
+    row_steps = np.diff(np.unique(site_y))
+
+    if row_steps.size == 0:
+        return 0
+
+    return np.min(row_steps)
@@ -5,7 +5,11 @@ import json
 import sys
 import time
 import pathlib
+import hashlib
 
+from scipy import sparse
+from scipy.interpolate import CloughTocher2DInterpolator
+from scipy.spatial import Delaunay
 from git import Repo
 
 
@@ -221,7 +225,7 @@ def read_cluster_amplitude_tsv(filename):
 
     return cluster_amplitude
 
-def load(folder, filename):
+def load(folder, filename, mmap_mode = None):
 
     """
     Loads a numpy file from a folder.
@@ -232,6 +236,8 @@ def load(folder, filename):
         Directory containing the file to load
     filename : String
         Name of the numpy file
+    mmap_mode : String (optional)
+        Passed to numpy.load; 'r' memory-maps the file read-only
 
     Outputs:
     --------
@@ -240,7 +246,294 @@ def load(folder, filename):
 
     """
 
-    return np.load(os.path.join(folder, filename))
+    return np.load(os.path.join(folder, filename), mmap_mode = mmap_mode)
+
+
+def unwhiten_templates(templates, whitening_mat_inv):
+
+    """
+    Multiplies all templates by the inverse whitening matrix in one batch
+
+    Inputs:
+    -------
+    templates : numpy.ndarray (M x samples x channels)
+        Whitened templates from templates.npy
+    whitening_mat_inv : numpy.ndarray (channels x channels)
+        Inverse of the whitening matrix used by Kilosort
+
+    Outputs:
+    --------
+    unwhitened_temps : numpy.ndarray (M x samples x channels), float32
+        Templates in the units of the raw data
+
+    """
+
+    return np.matmul(np.asarray(templates, dtype = 'float32'), 
+                     np.asarray(whitening_mat_inv, dtype = 'float32'))
+
+
+def cubic_interpolation_operator(loc_a, loc_i):
+
+    """
+    Linear operator for cubic (Clough-Tocher) interpolation between two sets
+    of 2D locations, as done by griddata(..., method='cubic', fill_value=0)
+
+    The Delaunay triangulation of loc_a is built once, and the interpolation
+    of each location in loc_a on its own (a column of the identity) is 
+    evaluated at loc_i; the interpolation of any values at loc_a is then the
+    product of the operator and the values. The gradient estimate uses a 
+    tighter tolerance than griddata, so that the interpolation is linear.
+
+    Inputs:
+    -------
+    loc_a : numpy.ndarray (N x 2)
+        Locations with known values
+    loc_i : numpy.ndarray (M x 2)
+        Locations to interpolate
+
+    Outputs:
+    --------
+    operator : numpy.ndarray (M x N)
+        Interpolation weights; 0 outside the convex hull of loc_a
+
+    """
+
+    loc_a = np.asarray(loc_a, dtype = 'float')
+
+    return CloughTocher2DInterpolator(Delaunay(loc_a), np.eye(loc_a.shape[0]), fill_value = 0, 
+                                      tol = 1e-10, maxiter = 100000)(loc_i)
+
+
+def hash_files(folder, filenames):
+
+    """ SHA1 hash of the contents of a set of files, read in 1 MB blocks """
+
+    h = hashlib.sha1()
+
+    for filename in filenames:
+        with open(os.path.join(folder, filename), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+
+    return h.hexdigest()
+
+
+def load_unwhitened_templates(folder, cache_file = 'templates_unwhitened.npz'):
+
+    """
+    Loads unwhitened templates, their peak channels and peak-to-peak amplitudes
+
+    The results are stored in a sidecar file in the Kilosort output directory,
+    keyed by a hash of templates.npy and whitening_mat_inv.npy, so the 
+    unwhitening is only done once for a given sort. If the directory cannot 
+    be written, the results are computed without being cached.
+
+    Inputs:
+    -------
+    folder : String
+        Location of Kilosort output directory
+    cache_file : String (optional)
+        Name of the sidecar file
+
+    Outputs:
+    --------
+    unwhitened_temps : numpy.ndarray (M x samples x channels), float32
+        Unwhitened templates, including the zero padding
+    peak_channels : numpy.ndarray (M x 0)
+        Index (into channel_map) of the channel with the largest peak-to-peak amplitude
+    peak_to_peak : numpy.ndarray (M x 0)
+        Peak-to-peak amplitude on the peak channel
+
+    """
+
+    key = hash_files(folder, ['templates.npy', 'whitening_mat_inv.npy'])
+    cache_path = os.path.join(folder, cache_file)
+
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            if str(cached['key']) == key:
+                return cached['templates'], cached['peak_channels'], cached['peak_to_peak']
+
+    unwhitened_temps = unwhiten_templates(load(folder, 'templates.npy', mmap_mode = 'r'),
+                                          load(folder, 'whitening_mat_inv.npy'))
+
+    channel_p2p = np.max(unwhitened_temps, 1) - np.min(unwhitened_temps, 1)
+    peak_channels = np.argmax(channel_p2p, 1)
+    peak_to_peak = channel_p2p[np.arange(peak_channels.size), peak_channels]
+
+    # write to a temporary file first so an interrupted write never leaves a partial cache
+    try:
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path, key = key, templates = unwhitened_temps, 
+                 peak_channels = peak_channels, peak_to_peak = peak_to_peak)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+
+    return unwhitened_temps, peak_channels, peak_to_peak
+
+
+class KilosortDataset():
+
+    """
+    Kilosort output files in one directory, loaded on first access
+
+    The large per-spike feature arrays (pc_features, template_features) are
+    memory-mapped read-only, so only the rows that are used are read from disk.
+    Derived fields (spike times in seconds, unwhitened templates, cluster IDs
+    and quality) are computed the first time they are accessed and cached.
+
+    """
+
+    def __init__(self, folder,
+                 sample_rate = None,
+                 convert_to_seconds = True,
+                 use_master_clock = False,
+                 template_zero_padding = 21):
+
+        """
+        folder : String
+            Location of Kilosort output directory
+        sample_rate : float (optional)
+            AP band sample rate in Hz
+        convert_to_seconds : bool (optional)
+            Flags whether to return spike times in seconds (requires sample_rate to be set)
+        use_master_clock : bool (optional)
+            Flags whether to load spike times that have been converted to the master clock timebase
+        template_zero_padding : int (default = 21)
+            Number of zeros added to the beginning of each template
+        """
+
+        self.folder = folder
+        self.sample_rate = sample_rate
+        self.convert_to_seconds = convert_to_seconds
+        self.use_master_clock = use_master_clock
+        self.template_zero_padding = template_zero_padding
+
+        self._cache = {}
+
+    def _get(self, name, compute):
+
+        if name not in self._cache:
+            self._cache[name] = compute()
+
+        return self._cache[name]
+
+    @property
+    def spike_times(self):
+
+        def compute():
+            if self.use_master_clock:
+                spike_times = np.squeeze(load(self.folder, 'spike_times_master_clock.npy'))
+            else:
+                spike_times = np.squeeze(load(self.folder, 'spike_times.npy'))
+            if self.convert_to_seconds and self.sample_rate is not None:
+                spike_times = spike_times / self.sample_rate
+            return spike_times
+
+        return self._get('spike_times', compute)
+
+    @property
+    def spike_clusters(self):
+        return self._get('spike_clusters', lambda: np.squeeze(load(self.folder, 'spike_clusters.npy')))
+
+    @property
+    def spike_templates(self):
+        return self._get('spike_templates', lambda: load(self.folder, 'spike_templates.npy'))
+
+    @property
+    def amplitudes(self):
+        return self._get('amplitudes', lambda: load(self.folder, 'amplitudes.npy'))
+
+    @property
+    def whitening_mat_inv(self):
+        return self._get('whitening_mat_inv', lambda: load(self.folder, 'whitening_mat_inv.npy'))
+
+    def _load_template_cache(self):
+        return load_unwhitened_templates(self.folder)
+
+    @property
+    def templates(self):
+
+        """ Unwhitened templates (M x samples x channels, float32), with the zero padding removed """
+
+        return self._get('template_cache', self._load_template_cache)[0][:,self.template_zero_padding:,:]
+
+    @property
+    def template_peak_channels(self):
+
+        """ Index (into channel_map) of the channel with the largest peak-to-peak amplitude for each template """
+
+        return self._get('template_cache', self._load_template_cache)[1]
+
+    @property
+    def template_peak_to_peak(self):
+
+        """ Peak-to-peak amplitude of each unwhitened template on its peak channel """
+
+        return self._get('template_cache', self._load_template_cache)[2]
+
+    @property
+    def channel_map(self):
+        return self._get('channel_map', lambda: load(self.folder, 'channel_map.npy'))
+
+    @property
+    def channel_pos(self):
+        return self._get('channel_pos', lambda: load(self.folder, 'channel_positions.npy'))
+
+    def _load_cluster_groups(self):
+        try:
+            return read_cluster_group_tsv(os.path.join(self.folder, 'cluster_group.tsv'))
+        except OSError:
+            cluster_ids = np.unique(self.spike_clusters)
+            return cluster_ids, ['unsorted'] * cluster_ids.size
+
+    @property
+    def cluster_ids(self):
+        return self._get('cluster_groups', self._load_cluster_groups)[0]
+
+    @property
+    def cluster_quality(self):
+        return self._get('cluster_groups', self._load_cluster_groups)[1]
+
+    @property
+    def cluster_amplitude(self):
+        return self._get('cluster_amplitude', 
+                         lambda: read_cluster_amplitude_tsv(os.path.join(self.folder, 'cluster_Amplitude.tsv')))
+
+    @property
+    def similar_templates(self):
+
+        """ Template-by-template similarity matrix written by Kilosort (memory-mapped) """
+
+        return self._get('similar_templates', lambda: load(self.folder, 'similar_templates.npy', mmap_mode = 'r'))
+
+    @property
+    def pc_features(self):
+        return self._get('pc_features', lambda: load(self.folder, 'pc_features.npy', mmap_mode = 'r'))
+
+    @property
+    def pc_feature_ind(self):
+        return self._get('pc_feature_ind', lambda: load(self.folder, 'pc_feature_ind.npy'))
+
+    @property
+    def template_features(self):
+        return self._get('template_features', lambda: load(self.folder, 'template_features.npy', mmap_mode = 'r'))
+
+    def as_tuple(self, include_pcs = False):
+
+        """
+        Returns the fields in the order used by load_kilosort_data
+
+        """
+
+        data = (self.spike_times, self.spike_clusters, self.spike_templates, self.amplitudes, self.templates,
+                self.channel_map, self.channel_pos, self.cluster_ids, self.cluster_quality, self.cluster_amplitude)
+
+        if include_pcs:
+            data = data + (self.pc_features, self.pc_feature_ind, self.template_features)
+
+        return data
 
 
 def load_kilosort_data(folder, 
@@ -253,6 +546,11 @@ def load_kilosort_data(folder,
     """
     Loads Kilosort output files from a directory
 
+    Wrapper around KilosortDataset that returns all fields as a tuple. 
+    pc_features and template_features are loaded into memory, since callers
+    may save them back to the same files; use KilosortDataset to access 
+    them through a read-only memory map.
+
     Inputs:
     -------
     folder : String
@@ -299,59 +597,21 @@ def load_kilosort_data(folder,
 
     """
 
-    if use_master_clock:
-        spike_times = load(folder,'spike_times_master_clock.npy')
-    else:
-        spike_times = load(folder,'spike_times.npy')
-        
-    spike_clusters = load(folder,'spike_clusters.npy')
-    spike_templates = load(folder, 'spike_templates.npy')
-    amplitudes = load(folder,'amplitudes.npy')
-    templates = load(folder,'templates.npy')
-    unwhitening_mat = load(folder,'whitening_mat_inv.npy')
-    channel_map = load(folder, 'channel_map.npy')
-    channel_pos = load(folder, 'channel_positions.npy')
+    dataset = KilosortDataset(folder, 
+                              sample_rate = sample_rate,
+                              convert_to_seconds = convert_to_seconds,
+                              use_master_clock = use_master_clock,
+                              template_zero_padding = template_zero_padding)
+
+    data = dataset.as_tuple(include_pcs)
 
     if include_pcs:
-        pc_features = load(folder, 'pc_features.npy')
-        pc_feature_ind = load(folder, 'pc_feature_ind.npy')
-        template_features = load(folder, 'template_features.npy') 
-
-                
-    templates = templates[:,template_zero_padding:,:] # remove zeros
-    spike_clusters = np.squeeze(spike_clusters) # fix dimensions
-    spike_times = np.squeeze(spike_times)# fix dimensions
-
-    if convert_to_seconds and sample_rate is not None:
-       spike_times = spike_times / sample_rate 
-                    
-    unwhitened_temps = np.zeros((templates.shape))
-    
-    for temp_idx in range(templates.shape[0]):
-        
-        unwhitened_temps[temp_idx,:,:] = np.dot(np.ascontiguousarray(templates[temp_idx,:,:]),np.ascontiguousarray(unwhitening_mat))
-                    
-    try:
-        cluster_ids, cluster_quality = read_cluster_group_tsv(os.path.join(folder, 'cluster_group.tsv'))
-    except OSError:
-        cluster_ids = np.unique(spike_clusters)
-        cluster_quality = ['unsorted'] * cluster_ids.size
-        
-    cluster_amplitude = read_cluster_amplitude_tsv(os.path.join(folder, 'cluster_Amplitude.tsv'))
-    
-        
-        
+        data = data[:-3] + (np.array(dataset.pc_features), dataset.pc_feature_ind, np.array(dataset.template_features))
 
-    if not include_pcs:
-        return spike_times, spike_clusters, spike_templates, amplitudes, unwhitened_temps, \
-               channel_map, channel_pos, cluster_ids, cluster_quality, cluster_amplitude
-    else:
-        return spike_times, spike_clusters, spike_templates, amplitudes, unwhitened_temps, \
-               channel_map, channel_pos, cluster_ids, cluster_quality, cluster_amplitude, \
-               pc_features, pc_feature_ind, template_features
+    return data
 
 
-def get_spike_depths(spike_clusters, unit_template_ids, first_pc_sq, pc_feature_ind, channel_pos):
+def get_spike_depths(spike_clusters, unit_template_ids, pc_features, pc_feature_ind, channel_pos, spike_inds = None, chunk_size = 100000):
 
     """
     Calculates the distance (in microns) of individual spikes from the probe tip
@@ -372,12 +632,16 @@ def get_spike_depths(spike_clusters, unit_template_ids, first_pc_sq, pc_feature_
     unit_template_ids : numpy.ndearray (Nclusters x 0)
         majority template assignment for each cluster ID
         before any manual curation, unit_template_ids = cluster_ids
-    first_pc_sq : numpy.ndarray (N x template channels)
-        square of first pc on each site for each spike
+    pc_features : numpy.ndarray (spikes x num_PCs x template channels)
+        PC features for each spike; can be memory-mapped
     pc_feature_ind  : numpy.ndarray (M x channels)
         Channels used for PC calculation for each unit
     channel_pos : (channels x 2)
         X and Y/depth position of each channel, in um
+    spike_inds : numpy.ndarray (N x 0) (optional)
+        Rows of pc_features for the N spikes; defaults to all rows
+    chunk_size : int (optional)
+        Number of spikes processed at a time, which bounds the memory used
 
     Output:
     ------
@@ -386,27 +650,126 @@ def get_spike_depths(spike_clusters, unit_template_ids, first_pc_sq, pc_feature_
 
     """
     
-    # Need to make a copy of pc_features (which can be up to 20G for a very long run)
-    # to avoid changing the original (python passes by reference)
-    # to help with memory use:
-    # make copy only of the portion of the pc_features array that is used
-    # take the element-wise power in place to avoid making a 2nd copy
-
-    # get values of the 1st pc for each template site for each spike
-#    pc_power = np.copy(pc_features[:,0,:])
-#
-#    # zero out negtaive elements
-#    pc_power[pc_power < 0] = 0
-#
-#    pc_power = pow(pc_power, 2) # element by element square
-  
-    spike_feat_ind = pc_feature_ind[unit_template_ids[spike_clusters], :]
-    spike_feat_ycoord = channel_pos[spike_feat_ind, 1]
-    spike_depths = np.sum(spike_feat_ycoord * first_pc_sq, 1) / np.sum(first_pc_sq,1)
+    # pc_features can be up to 20G for a very long run, so rather than copying
+    # (and squaring) the 1st pc for all spikes at once, read it in chunks of spikes
+
+    spike_clusters = np.squeeze(spike_clusters)
+    num_spikes = spike_clusters.size
+
+    spike_depths = np.zeros((num_spikes,))
+
+    for start in range(0, num_spikes, chunk_size):
+
+        end = min(start + chunk_size, num_spikes)
+
+        if spike_inds is None:
+            first_pc_sq = np.array(pc_features[start:end, 0, :])
+        else:
+            first_pc_sq = pc_features[spike_inds[start:end], 0, :]
+
+        # zero out negative elements, then element by element square
+        first_pc_sq[first_pc_sq < 0] = 0
+        first_pc_sq = pow(first_pc_sq, 2)
+
+        spike_feat_ind = pc_feature_ind[unit_template_ids[spike_clusters[start:end]], :]
+        spike_feat_ycoord = channel_pos[spike_feat_ind, 1]
+        spike_depths[start:end] = np.sum(spike_feat_ycoord * first_pc_sq, 1) / np.sum(first_pc_sq,1)
 
     return spike_depths
 
 
+def get_cluster_spike_index(spike_clusters, total_units = None):
+
+    """
+    Groups spike indices by cluster ID with a single sort, so that the spikes
+    of each cluster can be retrieved as a contiguous slice rather than by
+    comparing every spike against every cluster ID
+
+    Spikes for cluster i are spike_order[cluster_offsets[i]:cluster_offsets[i+1]].
+    The sort is stable, so within each cluster the spike indices (and therefore
+    spike times) remain in their original order.
+
+    Inputs:
+    -------
+    spike_clusters : numpy.ndarray (N x 0)
+        Cluster IDs for N spikes
+    total_units : int (optional)
+        Number of cluster IDs to index; defaults to max(spike_clusters) + 1
+
+    Outputs:
+    --------
+    spike_order : numpy.ndarray (N x 0)
+        Spike indices sorted by cluster ID
+    cluster_offsets : numpy.ndarray (total_units + 1 x 0)
+        Start of each cluster's block of indices in spike_order
+
+    """
+
+    spike_clusters = np.squeeze(spike_clusters)
+
+    if total_units is None:
+        total_units = np.max(spike_clusters) + 1 if spike_clusters.size > 0 else 0
+
+    spike_order = np.argsort(spike_clusters, kind='stable')
+    counts = np.bincount(spike_clusters.astype('int64'), minlength=total_units)
+
+    cluster_offsets = np.zeros((counts.size + 1,), dtype='int64')
+    np.cumsum(counts, out=cluster_offsets[1:])
+
+    return spike_order, cluster_offsets
+
+
+def get_sparse_pc_features(pc_features, pc_feature_ind, spike_templates, spike_inds, num_channels = None):
+
+    """
+    Scatters the PC features of a set of spikes onto the full set of channels,
+    as a sparse matrix with one row per spike
+
+    Each spike only has PCs on the channels of its template (pc_feature_ind),
+    so a dense (spikes x channels*PCs) matrix is mostly zeros. Column 
+    pc * num_channels + channel holds the given PC on the given channel.
+
+    Inputs:
+    -------
+    pc_features : numpy.ndarray (N x num_PCs x template channels)
+        PC features for each spike (can be memory-mapped)
+    pc_feature_ind : numpy.ndarray (M x template channels)
+        Channels used for PC calculation for each template
+    spike_templates : numpy.ndarray (N x 0)
+        Template IDs for N spikes
+    spike_inds : numpy.ndarray
+        Indices of the spikes to include, in the order of the output rows
+    num_channels : int (optional)
+        Number of channels; defaults to max(pc_feature_ind) + 1
+
+    Outputs:
+    --------
+    spike_pcs : scipy.sparse.csr_matrix (spikes x num_channels*num_PCs)
+        PC features for the selected spikes
+
+    """
+
+    if num_channels is None:
+        num_channels = np.max(pc_feature_ind) + 1
+
+    spike_inds = np.asarray(spike_inds)
+    num_spikes = spike_inds.size
+    num_pcs, num_template_channels = pc_features.shape[1:]
+
+    channels = pc_feature_ind[np.squeeze(spike_templates)[spike_inds], :].astype('int64')
+    columns = channels[:, np.newaxis, :] + num_channels * np.arange(num_pcs)[np.newaxis, :, np.newaxis]
+
+    values = pc_features[spike_inds, :, :]
+
+    row_ptr = np.arange(num_spikes + 1, dtype='int64') * num_pcs * num_template_channels
+
+    spike_pcs = sparse.csr_matrix((np.ravel(values), np.ravel(columns), row_ptr), 
+                                  shape = (num_spikes, num_channels * num_pcs))
+    spike_pcs.sort_indices()
+
+    return spike_pcs
+
+
 def get_spike_amplitudes(spike_templates, templates, amplitudes):
 
     """
@@ -573,31 +936,33 @@ def getSortResults(output_dir, clu_version):
     nLabel = unqLabel.shape[0]
     maxLabel = np.max(unqLabel)
 
-    templates = np.load(os.path.join(output_dir, 'templates.npy'))
     channel_map = np.load(os.path.join(output_dir, 'channel_map.npy'))
     channel_map = np.squeeze(channel_map)
     
-    # read in inverse of whitening matrix
-    w_inv = np.load((os.path.join(output_dir, 'whitening_mat_inv.npy')))
-    nTemplate = templates.shape[0]
-    
-    # initialize peak_channels array
-    peak_channels = np.zeros([nLabel,],'uint32')
-    
+    # peak channel of each unwhitened template: the inverse of the whitening 
+    # matrix times the template (w_inv @ template.T). This matches the 
+    # sidecar cache (template @ w_inv) when w_inv is symmetric; otherwise 
+    # the templates are unwhitened here with the transposed matrix
+    w_inv = load(output_dir, 'whitening_mat_inv.npy')
+    if np.array_equal(w_inv, w_inv.T):
+        unwhitened_temps, template_peak_channels, template_p2p = load_unwhitened_templates(output_dir)
+    else:
+        unwhitened_temps = unwhiten_templates(load(output_dir, 'templates.npy', mmap_mode = 'r'), w_inv.T)
+        template_peak_channels = np.argmax(np.max(unwhitened_temps, 1) - np.min(unwhitened_temps, 1), 1)
+    nTemplate = unwhitened_temps.shape[0]
    
     # After manual splits or merges, some labels will have spikes found with
     # different templats.
     # for each label in the list unqLabel, get the most common template
-    # For that template (nt x nchan), multiply the the transpose (nchan x nt) by inverse of 
-    # the whitening matrix (nchan x nchan); get max and min along tthe time axis (1)
-    # to find the peak channel
+    # and use the peak channel of that template
+    cluster_order = np.argsort(cluLabel, kind = 'stable')
+    label_starts = np.concatenate(([0], np.cumsum(labelCounts)[:-1]))
+    template_mode = np.zeros([nLabel,], 'int64')
     for i in np.arange(0,nLabel):
-        curr_spkTemplate = spkTemplate[np.where(cluLabel==unqLabel[i])]
-        template_mode = np.argmax(np.bincount(curr_spkTemplate))
-        currT = templates[template_mode,:].T
-        curr_unwh = np.matmul(w_inv, currT)
-        currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
-        peak_channels[i] = channel_map[np.argmax(currdiff)]
+        curr_spkTemplate = spkTemplate[cluster_order[label_starts[i]:label_starts[i]+labelCounts[i]]]
+        template_mode[i] = np.argmax(np.bincount(curr_spkTemplate))
+
+    peak_channels = channel_map[template_peak_channels[template_mode]].astype('uint32')
 
     clus_Table = np.zeros((maxLabel+1, 2), dtype='uint32')
     clus_Table[unqLabel, 0] = labelCounts
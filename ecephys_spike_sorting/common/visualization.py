@@ -5,6 +5,7 @@ from scipy.signal import butter, filtfilt, medfilt
 
 from .utils import (get_spike_depths, 
                     get_spike_amplitudes,
+                    get_sparse_pc_features,
                     load_kilosort_data,
                     rms)
 
@@ -148,7 +149,8 @@ def plotDriftmap(ks_directory, sample_rate = 30000, time_range = [0, np.inf], ex
                     use_master_clock = False,
                     include_pcs = True)
 
-    spike_depths = get_spike_depths(spike_clusters, pc_features, pc_feature_ind, channel_pos)
+    # use the template of each spike to look up the channels of its pc features
+    spike_depths = get_spike_depths(spike_templates, np.arange(pc_feature_ind.shape[0]), pc_features, pc_feature_ind, channel_pos)
     spike_amplitudes = get_spike_amplitudes(spike_templates, templates, amplitudes)
 
     if exclude_noise:
@@ -309,7 +311,7 @@ def plotContinuousFile(raw_data_file, sample_rate = 30000, bit_volts = 0.195, no
         plt.close('all')
         
 
-def plotFullProbeTSNE(ks_directory, total_spikes=150000, exclude_noise = True, fig=None, output_path = None):
+def plotFullProbeTSNE(ks_directory, total_spikes=150000, exclude_noise = True, num_components = 50, fig=None, output_path = None):
 
     """
     Plots t-SNE embedding of spikes across the entire probe
@@ -331,6 +333,8 @@ def plotFullProbeTSNE(ks_directory, total_spikes=150000, exclude_noise = True, f
         number of spikes to use
     exclude_noise : bool
         True if noise units should be ignored, False otherwise
+    num_components : int
+        number of components of the PC feature matrix passed to t-SNE
     fig : matplotlib.pyplot.figure
         Figure handle to use for plotting
     output_path : str
@@ -352,6 +356,7 @@ def plotFullProbeTSNE(ks_directory, total_spikes=150000, exclude_noise = True, f
         return
 
     from matplotlib.cm import get_cmap
+    from sklearn.decomposition import TruncatedSVD
 
     spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, channel_pos, \
     clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
@@ -372,19 +377,18 @@ def plotFullProbeTSNE(ks_directory, total_spikes=150000, exclude_noise = True, f
 
     random_spike_inds = np.random.permutation(spikes_from_good_units.size)
     random_spike_inds = random_spike_inds[:total_spikes]
-    num_pc_features = pc_features.shape[1]
 
     good_spike_clusters = spike_clusters[spikes_from_good_units]
 
-    all_pcs = np.zeros((total_spikes, np.max(pc_feature_ind) * num_pc_features + 1))
+    all_pcs = get_sparse_pc_features(pc_features, 
+                                     pc_feature_ind, 
+                                     spike_templates, 
+                                     spikes_from_good_units[random_spike_inds])
 
-    for idx, i in enumerate(random_spike_inds):
-        
-        unit_id = good_spike_clusters[i]
-        channels = pc_feature_ind[unit_id,:]
-        
-        for j in range(0,num_pc_features):
-            all_pcs[idx, channels + np.max(pc_feature_ind) * j] = pc_features[i,j,:]
+    # fast_tsne requires a dense array; reduce the sparse matrix to its leading
+    # components rather than expanding it to all channels
+    all_pcs = TruncatedSVD(n_components = min(num_components, all_pcs.shape[1] - 1), 
+                           random_state = 42).fit_transform(all_pcs)
 
     print("Computing T-SNE")
     Z = fast_tsne(all_pcs, perplexity=50, seed=42)
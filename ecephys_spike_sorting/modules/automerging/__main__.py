@@ -6,7 +6,7 @@ import numpy as np
 
 from .automerging import automerging
 
-from ...common.utils import write_cluster_group_tsv, load_kilosort_data
+from ...common.utils import write_cluster_group_tsv, KilosortDataset
 
 
 def run_automerging(args):
@@ -15,13 +15,21 @@ def run_automerging(args):
 
     start = time.time()
     
-    spike_times, spike_clusters, spike_templates, amplitudes, templates, \
-    channel_map, channel_pos, clusterIDs, cluster_quality, cluster_amplitude, template_features = \
-        load_kilosort_data(args['directories']['kilosort_output_directory'], \
+    dataset = KilosortDataset(args['directories']['kilosort_output_directory'], \
             args['ephys_params']['sample_rate'], \
             convert_to_seconds = True)
+
+    spike_times, spike_clusters, spike_templates, amplitudes, templates, \
+    channel_map, channel_pos, clusterIDs, cluster_quality, cluster_amplitude = dataset.as_tuple()
+
+    if args['automerging_params']['similarity_source'] == 'kilosort':
+        similar_templates = dataset.similar_templates
+    else:
+        similar_templates = None
     
-    spike_clusters, cluster_index, cluster_quality = automerging(spike_times, spike_clusters, clusterIDs, templates, args['automerging_params'])
+    spike_clusters, cluster_index, cluster_quality = automerging(spike_times, spike_clusters, clusterIDs, 
+                                                                 np.array(cluster_quality), templates, 
+                                                                 args['automerging_params'], similar_templates)
 
     write_cluster_group_tsv(cluster_index, cluster_quality)
     np.save(os.path.join(args['directories']['kilosort_output_directory'], 'spike_clusters.npy'), spike_clusters)
@@ -1,12 +1,17 @@
 from argschema import ArgSchema, ArgSchemaParser 
 from argschema.schemas import DefaultSchema
-from argschema.fields import Nested, InputDir, String, Float, Dict, Int
+from argschema.fields import Nested, InputDir, String, Float, Dict, Int, Bool
+from marshmallow.validate import OneOf
 from ...common.schemas import EphysParams, Directories
 
 
 class AutomergingParams(DefaultSchema):
     merge_threshold = Float(required=True, default=2.5, help='Minimum merge score required to perform a merge')
     distance_to_compare = Int(required=True, default=5, help='Distance (in channels) to look for potential merges')
+    min_amplitude_ratio = Float(required=False, default=0.0, help='Minimum ratio of the smaller to the larger template peak-to-peak amplitude for a pair to be scored (0 to score all pairs)')
+    min_overlap = Float(required=False, default=0.0, help='Minimum fraction of time bins in which both units have spikes for a pair to be scored (0 to score all pairs)')
+    similarity_source = String(required=False, default='interpolation', validate=OneOf(['interpolation', 'kilosort']), help='interpolation (correlate interpolated templates) or kilosort (read similar_templates.npy)')
+    cross_check_similarity = Bool(required=False, default=False, help='With similarity_source = kilosort, also compute the interpolation-based similarity and print a comparison')
 
 class InputParameters(ArgSchema):
     
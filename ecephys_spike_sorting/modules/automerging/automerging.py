@@ -1,81 +1,196 @@
 import os
+import time
 import pandas as pd
 import numpy as np
 
-from .metrics import compare_templates, make_interp_temp, compute_isi_score, compute_isi_score
-from .merges import compute_overall_score, ID_merge_groups, make_merges
-from ...common.spike_template_helpers import find_depth
+from .metrics import compare_templates, template_spectrum, make_interp_temps, compute_isi_score, find_height, occupied_bins
+from .spike_ISI import unit_ISI_summary
+from .merges import find_comparison_pairs, compute_overall_score, ID_merge_groups, make_merges
+from .metrics import find_depth
 
-def automerging(spike_times, spike_clusters, clusterIDs, cluster_quality, templates, params):
+def automerging(spike_times, spike_clusters, clusterIDs, cluster_quality, templates, params, similar_templates = None):
 
     min_t = np.min(spike_times)
     max_t = np.max(spike_times)
 
     depths = np.zeros((clusterIDs.size,))
 
-    is_noise = np.ones(cluster_quality.shape, dtype=bool)
-    is_noise[cluster_quality == 'noise'] = False
+    is_noise = cluster_quality == 'noise'
 
     for idx, clusterID in enumerate(clusterIDs):
 
         template = templates[clusterID,:,:]
         depths[idx] = find_depth(template)
 
-        sorted_by_depth = np.argsort(depths)
-        clusterIDs = clusterIDs[sorted_by_depth]
-        depths = depths[sorted_by_depth]
-        is_good = np.invert(is_noise[sorted_by_depth])
-
-    comparison_matrix = np.zeros((depths.size, depths.size, 5))
-        
-    for i in range(0,depths.size):
-        for j in range(i+1,depths.size):
-            if np.abs(depths[i] - depths[j]) <= params['distance_to_compare'] and is_good[i] and is_good[j]:
-                comparison_matrix[i,j,0] = 1
+    # sort once all depths are known, so that each unit keeps its own depth
+    sorted_by_depth = np.argsort(depths)
+    clusterIDs = clusterIDs[sorted_by_depth]
+    depths = depths[sorted_by_depth]
+    is_good = np.invert(is_noise[sorted_by_depth])
+
+    # Candidate pairs pass through a cascade of stages, from cheapest to most
+    # expensive; each stage only sees the pairs that survived the last one:
+    #   1. peak depth within distance_to_compare
+    #   2. peak-to-peak amplitude ratio of at least min_amplitude_ratio
+    #   3. fraction of time bins where both units fire of at least min_overlap
+    #   4. template similarity high enough for the score to reach merge_threshold
+    #      (only when merge_threshold >= 2);
+    #      from the interpolated templates, or read from Kilosort's 
+    #      similar_templates matrix if similarity_source is 'kilosort'
+    #   5. ISI scores
+    stage_names = ['depth', 'amplitude ratio', 'overlap', 'waveform similarity', 'ISI']
+    stage_counts = np.zeros((len(stage_names),), dtype=int)
+    stage_times = np.zeros((len(stage_names),))
+
+    start = time.time()
+
+    # pairs of units to compare, as an edge list (i_index < j_index)
+    i_index, j_index = find_comparison_pairs(depths, is_good, params['distance_to_compare'])
             
-    print('Total comparisons: ' + str(np.where(comparison_matrix[:,:,0] == 1)[0].size))
+    print('Total comparisons: ' + str(i_index.size))
+
+    stage_counts[0] = i_index.size
+    stage_times[0] = time.time() - start
+    start = time.time()
+
+    heights = np.array([find_height(templates[clusterID,:,:]) for clusterID in clusterIDs])
+    amplitude_ratio = np.minimum(heights[i_index], heights[j_index]) / \
+                      np.maximum(np.maximum(heights[i_index], heights[j_index]), np.finfo(float).tiny)
+    candidates = amplitude_ratio >= params['min_amplitude_ratio']
+
+    stage_counts[1] = np.sum(candidates)
+    stage_times[1] = time.time() - start
+    start = time.time()
+
+    # spike times of each cluster, in time order
+    spike_order = np.argsort(spike_clusters, kind = 'stable')
+    cluster_bounds = np.searchsorted(spike_clusters[spike_order], np.stack((clusterIDs, clusterIDs + 1)))
+
+    num_bins = 50
+    occupied = np.array([occupied_bins(spike_times[spike_order[cluster_bounds[0,idx]:cluster_bounds[1,idx]]], min_t, max_t, num_bins)
+                         for idx in range(clusterIDs.size)])
+    overlap = np.sum(occupied[i_index[candidates]] & occupied[j_index[candidates]], 1) / float(num_bins)
+    candidates[candidates] = overlap >= params['min_overlap']
+
+    stage_counts[2] = np.sum(candidates)
+    stage_times[2] = time.time() - start
 
     print('Calculating initial metrics...')
 
     max_time = np.max(spike_times)
 
+    # pairs that are pruned keep zero scores, and are not merged
+    waveform_similarity = np.zeros((i_index.size,))
+    isi_score = np.ones((i_index.size,))
+    cISI_similarity = np.zeros((i_index.size,))
+
+    # the ISI and cISI terms of the overall score are at most 1 each, so a pair
+    # can only be merged if its (constrained) waveform similarity is above 
+    # merge_threshold - 2; negative similarities count as 0, so this only 
+    # rules out pairs when merge_threshold is at least 2
+    min_waveform_similarity = params['merge_threshold'] - 2
+    prune_on_similarity = min_waveform_similarity >= 0
+
+    use_kilosort_similarity = params['similarity_source'] == 'kilosort'
+    use_interpolation = not use_kilosort_similarity or params['cross_check_similarity']
+
+    if use_kilosort_similarity:
+        start = time.time()
+        # only the rows of the candidate pairs are read from the memory map
+        pairs = np.flatnonzero(candidates)
+        waveform_similarity[pairs] = similar_templates[clusterIDs[i_index[pairs]], clusterIDs[j_index[pairs]]]
+        stage_times[3] += time.time() - start
+
+    if use_kilosort_similarity and use_interpolation:
+        interp_similarity = np.zeros((i_index.size,))
+
+    # edges are sorted by i_index
+    edge_starts = np.searchsorted(i_index, np.arange(depths.size + 1))
+
+    # interpolated templates, their spectra, spike times and ISI summaries, 
+    # kept while units are still being compared
+    interp_temps = {}
+    spectra = {}
+    unit_times = {}
+    isi_summaries = {}
+
     for i in range(0,depths.size):
 
-        if is_good[i]:
-            
-            temp1 = make_interp_temp(templates,[clusterIDs[i]]) #
-            times1 = spike_times[spike_clusters == clusterIDs[i]]
-            
-            for j in range(i+1,depths.size):
+        edges = edge_starts[i] + np.flatnonzero(candidates[edge_starts[i]:edge_starts[i+1]])
+
+        if edges.size > 0:
+
+            start = time.time()
+
+            # all comparisons of unit i are with units after it, so earlier 
+            # units are no longer needed
+            for cache in (interp_temps, spectra, unit_times, isi_summaries):
+                for unit in [unit for unit in cache if unit < i]:
+                    del cache[unit]
+
+            if use_interpolation:
+
+                units = np.append(i, j_index[edges])
+                missing = [unit for unit in units if unit not in interp_temps]
+
+                if len(missing) > 0:
+                    new_temps = make_interp_temps(templates, clusterIDs[missing])
+                    interp_temps.update(zip(missing, new_temps))
+                    spectra.update(zip(missing, template_spectrum(new_temps)))
                 
-                if comparison_matrix[i,j,0] == 1:
-                    
-                    temp2 = make_interp_temp(templates, [clusterIDs[j]]) #
-                    times2 = spike_times[spike_clusters == clusterIDs[j]]
+                temp1 = interp_temps[i] #
+                
+                for edge in edges:
+                        
+                    temp2 = interp_temps[j_index[edge]] #
                     
-                    rms, offset_distance = compare_templates(temp1, temp2) #
-                   # overlap = percent_overlap(times1, times2, min_t, max_t, 50) #
-                    cISI_score, score_weight, ISI1, ISI2, cISI, rcISI, another_score = compute_isi_score(times1, times2, max_time)
-                    is_good
-                    comparison_matrix[i,j,1] = np.max(rms)
-                    comparison_matrix[i,j,2] = another_score
-                    comparison_matrix[i,j,3] = cISI_score
+                    rms, offset_distance = compare_templates(temp1, temp2, spectra[i], spectra[j_index[edge]]) #
+                    if use_kilosort_similarity:
+                        interp_similarity[edge] = np.max(rms)
+                    else:
+                        waveform_similarity[edge] = np.max(rms)
 
-    overall_score, i_index, j_index = compute_overall_score(comparison_matrix)
+            if prune_on_similarity:
+                edges = edges[np.invert(waveform_similarity[edges] <= min_waveform_similarity)]
 
-    comparison_matrix[:,:,4] = 0
+            stage_counts[3] += edges.size
+            stage_times[3] += time.time() - start
+            start = time.time()
 
-    for index in np.arange(overall_score.size)   :
+            if edges.size > 0:
+                for unit in np.append(i, j_index[edges]):
+                    if unit not in isi_summaries:
+                        unit_times[unit] = spike_times[spike_order[cluster_bounds[0,unit]:cluster_bounds[1,unit]]]
+                        isi_summaries[unit] = unit_ISI_summary(unit_times[unit], max_time)
 
-        if overall_score[index] > params['merge_threshold']: 
-            
-            comparison_matrix[i_index[index],j_index[index],4] = 1
+            for edge in edges:
+
+                j = j_index[edge]
+
+               # overlap = percent_overlap(times1, times2, min_t, max_t, 50) #
+                cISI_score, score_weight, ISI1, ISI2, cISI, rcISI, another_score = \
+                    compute_isi_score(unit_times[i], unit_times[j], max_time, isi_summaries[i], isi_summaries[j])
+                isi_score[edge] = another_score
+                cISI_similarity[edge] = cISI_score
+
+            stage_counts[4] += edges.size
+            stage_times[4] += time.time() - start
 
+    for name, count, stage_time in zip(stage_names, stage_counts, stage_times):
+        print('  ' + name + ': ' + str(count) + ' pairs, ' + str(np.around(stage_time,2)) + ' seconds')
 
-    print('Total merges = ' + str(np.where(comparison_matrix[:,:,4] == 1)[0].size))
+    if use_kilosort_similarity and use_interpolation:
+        compare_similarity(waveform_similarity[candidates], interp_similarity[candidates], 
+                           min_waveform_similarity if prune_on_similarity else -np.inf)
+
+    overall_score = compute_overall_score(waveform_similarity, isi_score, cISI_similarity)
+
+    to_merge = overall_score > params['merge_threshold']
+
+    print('Total merges = ' + str(np.sum(to_merge)))
     print(' ')
 
-    groups = ID_merge_groups(comparison_matrix[:,:,4])
+    groups = ID_merge_groups(i_index[to_merge], j_index[to_merge])
     clusters = np.copy(spike_clusters) 
     clusters = make_merges(groups, clusters, spike_clusters, clusterIDs) 
 
@@ -96,4 +211,37 @@ def automerging(spike_times, spike_clusters, clusterIDs, cluster_quality, templa
             else:
                 cluster_quality.append(-1) # noise
 
-    return clusters, cluster_index, cluster_quality
\ No newline at end of file
+    return clusters, cluster_index, cluster_quality
+
+
+def compare_similarity(kilosort_similarity, interp_similarity, min_waveform_similarity):
+
+    """
+    Prints a comparison of the waveform similarity from Kilosort's 
+    similar_templates matrix with the similarity of the interpolated templates
+
+    Inputs:
+    -------
+    kilosort_similarity : numpy.ndarray
+        similar_templates value for each pair
+    interp_similarity : numpy.ndarray
+        Maximum correlation of the interpolated templates (compare_templates)
+        for each pair
+    min_waveform_similarity : float
+        Similarity a pair needs to exceed to be scored on its ISIs
+
+    """
+
+    print('Waveform similarity cross-check (' + str(kilosort_similarity.size) + ' pairs):')
+
+    if kilosort_similarity.size > 1:
+        print('  correlation: ' + str(np.around(np.corrcoef(kilosort_similarity, interp_similarity)[0,1],3)))
+
+    if kilosort_similarity.size > 0:
+        print('  mean absolute difference: ' + str(np.around(np.mean(np.abs(kilosort_similarity - interp_similarity)),3)))
+
+    kilosort_pass = np.invert(kilosort_similarity <= min_waveform_similarity)
+    interp_pass = np.invert(interp_similarity <= min_waveform_similarity)
+
+    print('  scored with Kilosort similarity only: ' + str(np.sum(kilosort_pass & np.invert(interp_pass))))
+    print('  scored with interpolated similarity only: ' + str(np.sum(interp_pass & np.invert(kilosort_pass))))
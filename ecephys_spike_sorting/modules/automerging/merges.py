@@ -11,9 +11,9 @@ def constrainValues(input_array):
     
     return output_array
 
-def getNextMerge(comparison_matrix):
+def getNextMerge(i_index, j_index, waveform_similarity, isi_score, cISI_similarity):
     
-    overall_score, i_index, j_index = compute_overall_score(comparison_matrix)
+    overall_score = compute_overall_score(waveform_similarity, isi_score, cISI_similarity)
     
     nextMerge = np.argmax(overall_score)
     mergeScore = np.max(overall_score)
@@ -23,27 +23,54 @@ def getNextMerge(comparison_matrix):
     
     return mergeScore, i, j, overall_score
 
-def compute_overall_score(comparison_matrix):
-    
-    num_units = comparison_matrix.shape[0]
-    
-    index_matrix = np.zeros((num_units,num_units,2),dtype='int')
-                
-    for i in range(0,num_units):
-        for j in range(i+1,num_units):
-            index_matrix[i,j,0] = i
-            index_matrix[i,j,1] = j
-    
-    selection = comparison_matrix[:,:,0].flatten() == 1
-    waveform_sim = comparison_matrix[:,:,1].flatten()
-    isi_sim = comparison_matrix[:,:,3].flatten()
-    isi_score = 1 - comparison_matrix[:,:,2].flatten()
-    i_index = index_matrix[:,:,0].flatten()
-    j_index = index_matrix[:,:,1].flatten()
+def find_comparison_pairs(depths, is_good, distance_to_compare):
+
+    """
+    Finds the pairs of good units within distance_to_compare of each other
+
+    Inputs:
+    -------
+    depths : numpy.ndarray
+        Depth of each unit, sorted in ascending order
+    is_good : numpy.ndarray
+        True for units to compare
+    distance_to_compare : float
+        Maximum depth difference between units in a pair
+
+    Outputs:
+    --------
+    i_index, j_index : numpy.ndarray
+        Indices of the units in each pair, with i_index < j_index, sorted 
+        by i_index and then j_index
+
+    """
+
+    num_units = depths.size
+
+    # each unit is compared with the following units up to distance_to_compare deeper
+    window_end = np.searchsorted(depths, depths + distance_to_compare, side = 'right')
+    pairs_per_unit = np.maximum(window_end - np.arange(num_units) - 1, 0)
+
+    i_index = np.repeat(np.arange(num_units), pairs_per_unit)
+    first_pair = np.cumsum(pairs_per_unit) - pairs_per_unit
+    j_index = i_index + 1 + np.arange(i_index.size) - np.repeat(first_pair, pairs_per_unit)
 
-    overall_score = constrainValues(isi_score) + constrainValues(isi_sim) + constrainValues(waveform_sim)
+    selection = is_good[i_index] & is_good[j_index]
+
+    return i_index[selection], j_index[selection]
+
+def compute_overall_score(waveform_similarity, isi_score, cISI_similarity):
+
+    """
+    Merge score for each pair of units: the sum of the waveform similarity,
+    the ISI score (1 - isi_score) and the cISI similarity, each set to 0
+    if it's outside [0, 1]
+
+    """
+    
+    overall_score = constrainValues(1 - isi_score) + constrainValues(cISI_similarity) + constrainValues(waveform_similarity)
     
-    return overall_score[selection], i_index[selection], j_index[selection]
+    return overall_score
     
 def getTemplateIndsForCluster(spike_templates, spike_clusters, clusterId, templateIDs):
     
@@ -74,51 +101,62 @@ def should_merge(waveform_similarity, isi_similarity, isi_score, t1 = 0.2, t2 =0
 
 # identify the merge groups
                 
-def ID_merge_groups(merges):    
+def ID_merge_groups(i_index, j_index):    
+
+    """
+    Groups the units connected by merges (connected components)
+
+    Units are joined with a union-find over the merges, in order. Groups 
+    are listed in the order of their first merge. Within a group, units 
+    are in the order they were added, except that joining two groups 
+    sorts their units (as the previous implementation did).
+
+    Inputs:
+    -------
+    i_index, j_index : numpy.ndarray
+        Units in each accepted merge, e.g. sorted by i_index and then 
+        j_index
+
+    Outputs:
+    --------
+    connected_groups : list of lists
+        Units in each merge group
+
+    """
     
     connected_groups = []
-        
-    for u1 in range(0,merges.shape[0]):
-        
-        for u2 in range(0, merges.shape[0]):
-            
-            if merges[u1,u2] == 1 and u1 != u2:
-                
-                if len(connected_groups) == 0: # initialize merge groups
-                    
-                    connected_groups.append([u1, u2])
-                    
-                else:
-                    
-                    foundMatch = False
-                    
-                    for idx, group in enumerate(connected_groups):
-                        
-                        if u1 in group or u2 in group:
-
-                            if u1 not in group:
-                                group.extend([u1])
-                            if u2 not in group:
-                                group.extend([u2])
-                            
-                            foundMatch = True
-                            
-                        
-                    if not foundMatch:
-                         connected_groups.append([u1,u2])
-                            
-                    # check for overlapping groups
-                    if True:
-                        for idx, group1 in enumerate(connected_groups):
-                            
-                            for idx2, group2 in enumerate(connected_groups):
-                                
-                                L = len(set(group1).intersection(group2))
-                                
-                                if L > 0 and idx != idx2:
+    group_of_unit = {}
+
+    for u1, u2 in zip(i_index, j_index):
+
+        u1 = int(u1)
+        u2 = int(u2)
+
+        if u1 == u2:
+            continue
+
+        g1 = group_of_unit.get(u1)
+        g2 = group_of_unit.get(u2)
+
+        if g1 is None and g2 is None:
+            group_of_unit[u1] = group_of_unit[u2] = len(connected_groups)
+            connected_groups.append([u1, u2])
 
-                                    connected_groups[idx] = list(np.sort(group1 + list(set(group2) - set(group1))))
-                                    connected_groups[idx2] = []
+        elif g1 is None:
+            group_of_unit[u1] = g2
+            connected_groups[g2].append(u1)
+
+        elif g2 is None:
+            group_of_unit[u2] = g1
+            connected_groups[g1].append(u2)
+
+        elif g1 != g2:
+            # join the later group into the earlier one
+            keep, remove = min(g1, g2), max(g1, g2)
+            for unit in connected_groups[remove]:
+                group_of_unit[unit] = keep
+            connected_groups[keep] = sorted(connected_groups[keep] + connected_groups[remove])
+            connected_groups[remove] = []
                                 
     connected_groups[:] = [item for item in connected_groups if item != []] # remove empty elements
                                 
@@ -127,15 +165,29 @@ def ID_merge_groups(merges):
 
 # make the merges
 def make_merges(connected_groups, spike_clusters, spike_templates, templateIDs):
+
+    """
+    Gives the spikes of each merge group a new cluster ID (after the 
+    largest existing ID), in the order of connected_groups
+
+    """
         
+    if len(connected_groups) == 0:
+        return spike_clusters
+
     maxId = np.max(spike_clusters)
-    
-    for merge_group in connected_groups:
-        
-        maxId += 1
-        
-        for unit_idx in merge_group:
 
-            spike_clusters[np.where(spike_templates == templateIDs[unit_idx])[0]] = maxId
+    merged_units = np.concatenate([np.array(group, dtype = 'int') for group in connected_groups])
+    new_ids = np.repeat(maxId + 1 + np.arange(len(connected_groups)), 
+                        [len(group) for group in connected_groups])
+
+    # new cluster ID for each template ID, -1 if not merged
+    merged_templates = np.asarray(templateIDs)[merged_units]
+    lookup = np.full((max(np.max(spike_templates), np.max(merged_templates)) + 1,), -1, dtype = 'int64')
+    lookup[merged_templates] = new_ids
+
+    new_clusters = lookup[spike_templates]
+    is_merged = new_clusters >= 0
+    spike_clusters[is_merged] = new_clusters[is_merged]
             
     return spike_clusters
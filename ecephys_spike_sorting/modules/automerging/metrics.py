@@ -1,7 +1,10 @@
-from scipy.interpolate import griddata
+from functools import lru_cache
+
+from scipy.fft import next_fast_len
 from scipy.signal import correlate
 import numpy as np
 from .spike_ISI import *    
+from ...common.utils import cubic_interpolation_operator
 
 def find_depth(template):
     
@@ -69,32 +72,95 @@ def make_interp_channel_locations(min_chan, max_chan):
     return interp_channel_locations
 
 
-def make_interp_temp(templates, indices):
-    
-    total_samples = templates.shape[1]
-    total_channels = templates.shape[2]
+@lru_cache(maxsize=None)
+def make_interp_operator(total_channels):
+
+    """
+    Linear operator for the cubic interpolation in make_interp_temp (see
+    cubic_interpolation_operator). Reference channels get zero weight. 
+    Cached for each number of channels.
+
+    Returns a (total_channels * 7) x total_channels matrix.
+    """
+
     refs = np.array([36, 75, 112, 151, 188, 227, 264, 303, 340, 379])
     loc_a = make_actual_channel_locations(0, total_channels)
     loc_i = make_interp_channel_locations(0, total_channels)
 
-    indices = np.array(indices)
     to_include = np.arange(0,total_channels)
     to_include = np.delete(to_include, refs)
+
+    operator = np.zeros((loc_i.shape[0], total_channels))
+    operator[:, to_include] = cubic_interpolation_operator(loc_a[to_include,:], loc_i)
+
+    return operator
+
+
+def make_interp_temps(templates, indices):
+
+    """
+    Interpolate several templates at once (see make_interp_temp)
+
+    Returns an array with dims (indices x samples x channels x 7)
+    """
+
+    indices = np.array(indices)
+    total_samples = templates.shape[1]
+    total_channels = templates.shape[2]
+
+    operator = make_interp_operator(total_channels)
+
+    interp_temps = np.matmul(templates[indices, :, :], operator.T)
+
+    return np.reshape(interp_temps, (indices.size, total_samples, total_channels, 7))
+
+
+def make_interp_temp(templates, indices):
     
-    interp_temp = np.zeros((templates.shape[1],templates.shape[2]*7,indices.size))
-    
-    for i in np.arange(indices.size):
-        
-        temp = templates[indices[i], :, :]
-        
-        for t in range(0,total_samples):
-            
-            interp_temp[t,:,i] = griddata(loc_a[to_include,:], temp[t,to_include], loc_i, method='cubic', fill_value=0, rescale=False)  
-        
-    return np.reshape(np.mean(interp_temp,2), (total_samples, total_channels, 7)).astype('float')       
+    return np.mean(make_interp_temps(templates, indices), 0).astype('float')
 
 
-def compare_templates(t1, t2):
+def template_spectrum(template, max_padding = 10):
+
+    """
+    FFT of interpolated templates along the depth axis (second to last),
+    zero padded so that correlations up to max_padding channels apart 
+    don't wrap around. Works on one template (samples x channels x 7) or 
+    on a stack of templates.
+    """
+
+    n = next_fast_len(template.shape[-2] + max_padding)
+
+    return np.fft.rfft(template, n = n, axis = -2)
+
+
+def compare_templates(t1, t2, spectrum1 = None, spectrum2 = None):
+
+    """
+    Correlation between two interpolated templates, with t2 shifted in 
+    depth by each offset between -padding_neg and padding_pos
+
+    The correlations for all offsets come from one FFT cross-correlation 
+    along the depth axis, and sums that only depend on the offset. The 
+    padded arrays that were correlated for each offset contain t1 padded 
+    with zeros, and t2 shifted by the offset, with the first row of t2 
+    repeated above it (the rows left over from the smaller offsets).
+
+    Inputs:
+    -------
+    t1, t2 : numpy.ndarray (samples x channels x 7)
+        Interpolated templates (see make_interp_temp)
+    spectrum1, spectrum2 : numpy.ndarray (optional)
+        template_spectrum of t1 and t2, if already computed
+
+    Outputs:
+    --------
+    sim : numpy.ndarray
+        Correlation for each offset
+    offset_distance : numpy.ndarray
+        Distance of each offset (um)
+
+    """
     
     depth1 = find_depth(t1) / 7
     depth2 = find_depth(t2) / 7
@@ -110,27 +176,48 @@ def compare_templates(t1, t2):
         padding_pos = int(total_channels - np.min((depth1, depth2)))
     else:
         padding_pos = max_padding
-    
-    m1 = np.zeros((61, total_channels+padding_neg+padding_pos, 7))
-    m1[:,padding_neg:total_channels+padding_neg,:] = t1
-    m2 = np.zeros((61, total_channels+padding_neg+padding_pos, 7))
-    
-    sim = np.zeros((padding_neg + padding_pos,))
-    offset_distance = np.zeros((padding_neg + padding_pos,))
-    ii = 0
-    
-    for idx, offset in enumerate(range(-padding_neg, padding_pos)):
-        m2[:,padding_neg+offset:total_channels+padding_neg+offset,:] = t2
-        sim[ii] = np.corrcoef(m1.flatten(), m2.flatten())[0,1]
-        offset_distance[idx] = -offset*10
-        ii += 1
+
+    if spectrum1 is None:
+        spectrum1 = template_spectrum(t1, max_padding)
+    if spectrum2 is None:
+        spectrum2 = template_spectrum(t2, max_padding)
+
+    offsets = np.arange(-padding_neg, padding_pos)
+
+    # sum over all elements of t1 * (t2 shifted by offset)
+    n = next_fast_len(total_channels + max_padding)
+    xcorr = np.fft.irfft(np.sum(spectrum1 * np.conj(spectrum2), axis = (0, 2)), n)
+    cross = xcorr[offsets % n]
+
+    # plus t1 * the repeated first row of t2, above the shifted t2
+    first_row = t2[:, 0, :]
+    edge = np.cumsum(np.einsum('ijk,ik->j', t1[:, :max(padding_pos, 0), :], first_row))
+    cross[offsets > 0] += edge[offsets[offsets > 0] - 1]
+
+    num_elements = t1.shape[0] * (total_channels + padding_neg + padding_pos) * 7
+    repeated_rows = padding_neg + offsets
+
+    mean1 = np.sum(t1) / num_elements
+    mean2 = (np.sum(t2) + repeated_rows * np.sum(first_row)) / num_elements
+    var1 = np.sum(t1 * t1) / num_elements - mean1 * mean1
+    var2 = (np.sum(t2 * t2) + repeated_rows * np.sum(first_row * first_row)) / num_elements - mean2 * mean2
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        sim = (cross / num_elements - mean1 * mean2) / np.sqrt(var1 * var2)
+
+    offset_distance = -offsets * 10.0
         
     return sim, offset_distance
 
 
-def compute_isi_score(t1, t2, max_time):
+def compute_isi_score(t1, t2, max_time, summary1 = None, summary2 = None):
+
+    """
+    cISI score and ISI ratio score for two spike trains; summary1 and 
+    summary2 are unit_ISI_summary outputs, if already computed
+    """
     
-    cISI_score, score_weight, ISI1, ISI2, cISI, rcISI = find_cISI_score(t1, t2, max_time)
+    cISI_score, score_weight, ISI1, ISI2, cISI, rcISI = find_cISI_score(t1, t2, max_time, summary1, summary2)
     
     ms = 5
     ratio = (cISI[:ms*10] + 0.001) / (rcISI[:ms*10] + 0.001)
@@ -146,13 +233,21 @@ def compute_isi_score(t1, t2, max_time):
 
 def percent_overlap(t1, t2, min_t, max_t, num_bins = 50):
     
-    h1,b = np.histogram(t1, bins=np.linspace(min_t, max_t, num_bins))
-    h2,b = np.histogram(t2, bins=np.linspace(min_t, max_t, num_bins))
-    
-    overlap = np.intersect1d(np.where(h1 > 0)[0], np.where(h2 > 0)[0]).size/float(num_bins)
+    overlap = np.sum(occupied_bins(t1, min_t, max_t, num_bins) & \
+                     occupied_bins(t2, min_t, max_t, num_bins))/float(num_bins)
     
     return overlap
 
+def occupied_bins(times, min_t, max_t, num_bins = 50):
+
+    """
+    Time bins (used by percent_overlap) that contain at least one spike
+    """
+
+    h,b = np.histogram(times, bins=np.linspace(min_t, max_t, num_bins))
+
+    return h > 0
+
 def get_templates_for_cluster(spike_templates, spike_clusters, clusterId):
     
     templatesForCluster = np.unique(spike_templates[spike_clusters == clusterId])
@@ -20,19 +20,41 @@ def find_cISI(spike_times1, spike_times2, max_time):
     return intervals
 
 def reverse_spikes(spike_times, max_time, num_bins = 100):
+
+    """
+    Reverses the (sorted) spike times within each of num_bins bins of the
+    recording. Spikes on the boundary of two bins are reversed in the 
+    later bin.
+    """
+
     reverse_times = np.zeros(np.prod(spike_times.shape))
     bin_size = max_time/100
-    for i in range(num_bins):
-        time_min = i*bin_size
-        time_max = (i+1)*bin_size
-        spikes_in_bin = np.flatnonzero(np.logical_and(spike_times>=time_min, spike_times<=time_max))
-        reverse_times[spikes_in_bin] = np.sort(time_max-spike_times[spikes_in_bin]+time_min)
-        #####TODO Fix this. I think we need to re index after the flat nonzero
+
+    time_min = np.arange(num_bins) * bin_size
+    time_max = np.arange(1, num_bins + 1) * bin_size
+
+    # range of spikes in each bin
+    bin_start = np.searchsorted(spike_times, time_min, side = 'left')
+    bin_end = np.searchsorted(spike_times, time_max, side = 'right')
+
+    # last bin that contains each spike
+    spike_bin = np.searchsorted(bin_start, np.arange(reverse_times.size), side = 'right') - 1
+    in_bin = spike_bin >= 0
+    in_bin[in_bin] = np.arange(reverse_times.size)[in_bin] < bin_end[spike_bin[in_bin]]
+
+    spikes_in_bin = np.flatnonzero(in_bin)
+    b = spike_bin[spikes_in_bin]
+
+    # reversed spike times are in increasing order within the bin
+    mirror = bin_start[b] + bin_end[b] - 1 - spikes_in_bin
+    reverse_times[spikes_in_bin] = time_max[b] - spike_times[mirror] + time_min[b]
     return reverse_times   
 
-def find_rcISI(spike_times1,spike_times2, max_time):
-    reverse_times1 = reverse_spikes(spike_times1, max_time)
-    reverse_times2 = reverse_spikes(spike_times2, max_time)
+def find_rcISI(spike_times1,spike_times2, max_time, reverse_times1 = None, reverse_times2 = None):
+    if reverse_times1 is None:
+        reverse_times1 = reverse_spikes(spike_times1, max_time)
+    if reverse_times2 is None:
+        reverse_times2 = reverse_spikes(spike_times2, max_time)
     intervals1 = find_cISI(spike_times1,reverse_times2, max_time)
     intervals2 = find_cISI(spike_times2,reverse_times1, max_time)
     intervals = np.hstack((intervals1,intervals2))
@@ -51,7 +73,7 @@ def ISI_mode(template_ID):
 
 def interval_dist_mode(interval_dist):
     try:
-        mode_window = min(500,np.int(np.nan_to_num(np.median(interval_dist))))
+        mode_window = min(500,int(np.nan_to_num(np.median(interval_dist))))
         values,num_in_window = smooth_ISI(interval_dist, mode_window)
         mode = np.min(np.nonzero(values>.9*np.max(values))) #perhaps double this
     except ValueError:
@@ -98,7 +120,7 @@ def make_ISI_list(times_list):
 def compare_ISI(clusterID1,clusterID2):
     window = max((mode_list[clusterID1],mode_list[clusterID2]))
     window = max((100,min((window,400))))
-    window = np.int(1.25*window)
+    window = int(1.25*window)
     if window>0:
         smoothISI1 = smooth_ISI(ISI_list[clusterID1],window)
         smoothISI2 = smooth_ISI(ISI_list[clusterID2],window)
@@ -127,13 +149,12 @@ def smooth_ISI(ISI,window):
     gaussian_window = 4*window/np.sqrt(max((1,np.size(np.nonzero(ISI<window)))))
     gaussian_std = gaussian_window/6
     box_filter_size = np.floor((gaussian_std*.75*np.sqrt(2*np.pi)+.5))//2*2+1
-    kernel = np.ones(np.int(box_filter_size))/box_filter_size
+    kernel = np.ones(int(box_filter_size))/box_filter_size
     values,bins = np.histogram(ISI,window,range = (0,window))
     num_in_window = sum(values)
     #print("Num in window:",sum(values))
-    for i in range(3):
-        smoothed_ISI = scipy.signal.correlate(values,kernel,'same')
-        #Think about using fft to convolve?
+    smoothed_ISI = scipy.signal.correlate(values,kernel,'same')
+    #Think about using fft to convolve?
     return smoothed_ISI, num_in_window
 
 def normalize_smoothed_ISI(smoothedISI):
@@ -150,40 +171,83 @@ def normalize_smoothed_ISI(smoothedISI):
     norm_smoothISI = smoothedISI - avg
     return norm_smoothISI
 
+def cISI_window(mode):
+    """ Histogram window used by compare_cISI for an ISI mode (0 if none) """
+    if mode>0:
+        window = max((100,min((mode,400))))
+        return int(1.25*window)
+    else:
+        return 0
+
 def compare_cISI(ISI1, cISI, rcISI, window):
+    window = cISI_window(window)
     if window>0:
-        window = max((100,min((window,400))))
-        window = np.int(1.25*window)
-
         smoothISI1, num1 = smooth_ISI(ISI1,window)
-        smoothcISI, numc = smooth_ISI(cISI,window)
-        smoothrcISI, numrc = smooth_ISI(rcISI,window)
-        norm_smoothISI1 = normalize_smoothed_ISI(smoothISI1)
-        norm_smoothcISI = normalize_smoothed_ISI(smoothcISI)
-        norm_smoothrcISI = normalize_smoothed_ISI(smoothrcISI)
-        dotc_1 = np.dot(norm_smoothISI1,norm_smoothcISI)
-        dotr_1 = np.dot(norm_smoothISI1,norm_smoothrcISI)
-        dot1_self = np.dot(norm_smoothISI1,norm_smoothISI1)
-        dotc_self = np.dot(norm_smoothcISI,norm_smoothcISI)
-        dotrc_self= np.dot(norm_smoothrcISI,norm_smoothrcISI)
-        simc_1 = dotc_1/np.max((dot1_self,dotc_self))
-        simr_1 = np.max((0,dotr_1/np.max((dot1_self,dotrc_self))))
-        score = (simc_1 - simr_1)/(1-simr_1)
+        return compare_smoothed_cISI(normalize_smoothed_ISI(smoothISI1), num1, 
+                                     smooth_ISI(cISI,window), smooth_ISI(rcISI,window))
     else: 
-        score = 0 
-        num1 = 0
-        numc = 0
+        return 0, 0, 0
+
+def compare_smoothed_cISI(norm_smoothISI1, num1, smooth_cISI, smooth_rcISI):
+    """
+    compare_cISI, with the ISI of unit 1 already smoothed and normalized, 
+    and smooth_ISI outputs for the cISI and rcISI
+    """
+    smoothcISI, numc = smooth_cISI
+    smoothrcISI, numrc = smooth_rcISI
+    norm_smoothcISI = normalize_smoothed_ISI(smoothcISI)
+    norm_smoothrcISI = normalize_smoothed_ISI(smoothrcISI)
+    dotc_1 = np.dot(norm_smoothISI1,norm_smoothcISI)
+    dotr_1 = np.dot(norm_smoothISI1,norm_smoothrcISI)
+    dot1_self = np.dot(norm_smoothISI1,norm_smoothISI1)
+    dotc_self = np.dot(norm_smoothcISI,norm_smoothcISI)
+    dotrc_self= np.dot(norm_smoothrcISI,norm_smoothrcISI)
+    simc_1 = dotc_1/np.max((dot1_self,dotc_self))
+    simr_1 = np.max((0,dotr_1/np.max((dot1_self,dotrc_self))))
+    score = (simc_1 - simr_1)/(1-simr_1)
     return score, num1, numc
 
-def find_cISI_score(spike_times1, spike_times2, max_time):
+def unit_ISI_summary(spike_times, max_time):
+    """
+    Quantities for one unit used by find_cISI_score, which only need to 
+    be computed once per unit: the ISI, reversed spike times, ISI mode, and
+    the normalized smoothed ISI for the cISI window and for window=1000
+    """
+    summary = {}
+    summary['ISI'] = find_ISI(spike_times)
+    summary['reverse_times'] = reverse_spikes(spike_times, max_time)
+    summary['window'] = cISI_window(interval_dist_mode(summary['ISI']))
+    if summary['window'] > 0:
+        smoothISI, summary['num_in_window'] = smooth_ISI(summary['ISI'], summary['window'])
+        summary['norm_smooth_ISI'] = normalize_smoothed_ISI(smoothISI)
+    summary['isi'] = normalize_smoothed_ISI(smooth_ISI(summary['ISI'], window=1000)[0])
+    return summary
+
+def find_cISI_score(spike_times1, spike_times2, max_time, summary1 = None, summary2 = None):
     
-    ISI1 = find_ISI(spike_times1)
-    ISI2 = find_ISI(spike_times2)
+    if summary1 is None:
+        summary1 = unit_ISI_summary(spike_times1, max_time)
+    if summary2 is None:
+        summary2 = unit_ISI_summary(spike_times2, max_time)
+
     cISI = find_cISI(spike_times1, spike_times2, max_time)
-    rcISI = find_rcISI(spike_times1, spike_times2, max_time)
+    rcISI = find_rcISI(spike_times1, spike_times2, max_time, summary1['reverse_times'], summary2['reverse_times'])
+
+    # the cISI and rcISI are smoothed once for each window
+    smoothed = {}
+    for window in set((summary1['window'], summary2['window'], 1000)):
+        if window > 0:
+            smoothed[window] = (smooth_ISI(cISI, window), smooth_ISI(rcISI, window))
+
+    scores = []
+    for summary in (summary1, summary2):
+        if summary['window'] > 0:
+            scores.append(compare_smoothed_cISI(summary['norm_smooth_ISI'], summary['num_in_window'], 
+                                                *smoothed[summary['window']]))
+        else:
+            scores.append((0, 0, 0))
 
-    sim_1, num1, numc1 = compare_cISI(ISI1, cISI, rcISI, interval_dist_mode(ISI1))
-    sim_2, num2, numc2 = compare_cISI(ISI2, cISI, rcISI, interval_dist_mode(ISI2))
+    (sim_1, num1, numc1), (sim_2, num2, numc2) = scores
 
     weight1 = np.min((1,num1/1000.)) #These will be changed to account for drastically different rates
     weight2 = np.min((1,num2/1000.)) #placing more value on the similarity to the cluster with a higher max rate
@@ -196,10 +260,10 @@ def find_cISI_score(spike_times1, spike_times2, max_time):
     cISI_score = min_score*balanced+rel_score*(1-balanced)
     score_weight = np.min((1,(numc1+numc2)/200.))
  
-    isi1 = normalize_smoothed_ISI(smooth_ISI(ISI1, window=1000)[0])
-    isi2 = normalize_smoothed_ISI(smooth_ISI(ISI2, window=1000)[0])
-    cisi = normalize_smoothed_ISI(smooth_ISI(cISI, window=1000)[0])
-    rcisi = normalize_smoothed_ISI(smooth_ISI(rcISI, window=1000)[0])
+    isi1 = summary1['isi']
+    isi2 = summary2['isi']
+    cisi = normalize_smoothed_ISI(smoothed[1000][0][0])
+    rcisi = normalize_smoothed_ISI(smoothed[1000][1][0])
     
     return cISI_score, score_weight, isi1, isi2, cisi, rcisi
     
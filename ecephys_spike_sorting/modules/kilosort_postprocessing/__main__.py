@@ -8,7 +8,7 @@ import numpy as np
 
 from ...common.utils import load_kilosort_data, getSortResults
 
-from .postprocessing import remove_double_counted_spikes
+from .postprocessing import find_double_counted_spikes, remove_spikes_from_file
 from .postprocessing import align_spike_times
 
 def run_postprocessing(args):
@@ -24,50 +24,38 @@ def run_postprocessing(args):
     
     include_pcs = args['ks_postprocessing_params']['include_pcs']
     
-    if include_pcs:
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        convert_to_seconds = False, \
-                        use_master_clock = False, \
-                        include_pcs = include_pcs )
-    else:
-        spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-        channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        convert_to_seconds = False, \
-                        use_master_clock = False, \
-                        include_pcs = include_pcs )
-        # empty arrays to stand in for the missing variables
-        pc_features = []
-        pc_feature_ind = []
-        template_features = []
+    # pc_features and template_features are not loaded; if spikes are 
+    # removed, the files are rewritten in chunks
+    spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
+    channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
+                load_kilosort_data(args['directories']['kilosort_output_directory'], \
+                    args['ephys_params']['sample_rate'], \
+                    convert_to_seconds = False, \
+                    use_master_clock = False, \
+                    include_pcs = False )
         
     if args['ks_postprocessing_params']['align_avg_waveform']: 
         spike_times = align_spike_times(spike_times,
                                         spike_clusters,
                                         args['ephys_params']['ap_band_file'], 
                                         args['directories']['kilosort_output_directory'], 
-                                        args['ks_postprocessing_params']['cWaves_path'])
+                                        args['ks_postprocessing_params']['num_threads'])
         
     if args['ks_postprocessing_params']['remove_duplicates']:
-        spike_times, spike_clusters, spike_templates, amplitudes, pc_features, \
-        template_features, overlap_matrix, overlap_summary = \
-            remove_double_counted_spikes(spike_times, 
-                                         spike_clusters,
-                                         spike_templates, 
-                                         amplitudes, 
-                                         channel_map,
-                                         channel_pos,
-                                         templates, 
-                                         pc_features, 
-                                         pc_feature_ind, 
-                                         template_features,
-                                         cluster_amplitude,
-                                         args['ephys_params']['sample_rate'],
-                                         args['ks_postprocessing_params'])
+        keep, overlap_matrix, overlap_summary = \
+            find_double_counted_spikes(spike_times, 
+                                       spike_clusters,
+                                       channel_map,
+                                       channel_pos,
+                                       templates, 
+                                       cluster_amplitude,
+                                       args['ephys_params']['sample_rate'],
+                                       args['ks_postprocessing_params'])
+
+        spike_times = spike_times[keep]
+        spike_clusters = spike_clusters[keep]
+        spike_templates = spike_templates[keep]
+        amplitudes = amplitudes[keep]
 
 
     print("Saving data...")
@@ -79,11 +67,13 @@ def run_postprocessing(args):
     np.save(os.path.join(output_dir, 'spike_clusters.npy'), spike_clusters)
     np.save(os.path.join(output_dir, 'spike_templates.npy'), spike_templates)
     
-    if args['ks_postprocessing_params']['include_pcs']:
-        np.save(os.path.join(output_dir, 'pc_features.npy'), pc_features)
-        np.save(os.path.join(output_dir, 'template_features.npy'), template_features)
-    
     if args['ks_postprocessing_params']['remove_duplicates']:
+        if include_pcs:
+            for npy_file in ['pc_features.npy', 'template_features.npy']:
+                remove_spikes_from_file(os.path.join(output_dir, npy_file), 
+                                        keep, 
+                                        args['ks_postprocessing_params']['chunk_spikes'])
+
         np.save(os.path.join(output_dir, 'overlap_matrix.npy'), overlap_matrix)
         np.save(os.path.join(output_dir, 'overlap_summary.npy'), overlap_summary)
         # save the overlap_summary as a text file -- allows user to easily understand what happened
@@ -10,9 +10,11 @@ class PostprocessingParams(DefaultSchema):
     between_unit_dist_um = Int(required=False, default=5, help='Number of channels (above and below peak channel) to search for overlapping spikes')
     deletion_mode = String(required=False, default='lowAmpCluster', help='lowAmpCluster or deleteFirst')
     include_pcs = Boolean(required=False, default=True, help='Set to false if features were not saved with Phy output')
+    chunk_spikes = Int(required=False, default=100000, help='Number of spikes at a time to copy when removing spikes from pc_features and template_features')
     remove_duplicates = Boolean(required=False, default=True, help='Set to True for duplicate removal')
     align_avg_waveform = Boolean(required=False, default=True, help='Set to true to set spike times for mean waveform min = t0')
-    cWaves_path = InputDir(require=False, help='directory containing the CWaves executable.')
+    cWaves_path = InputDir(require=False, help='no longer used; mean waveforms for alignment are calculated in process')
+    num_threads = Int(required=False, default=4, help='Number of threads for calculating mean waveforms used in alignment')
 
 class InputParameters(ArgSchema):
     
@@ -1,11 +1,9 @@
 import numpy as np
 import os
-import sys
-import subprocess
 from collections import OrderedDict
 
-from ...common.utils import printProgressBar
 from ...common.utils import getSortResults
+from ...common.cluster_waveforms import calculate_cluster_waveforms
 
 def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates, 
                                  amplitudes, channel_map, channel_pos, templates, pc_features, 
@@ -63,7 +61,53 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
         Matrix indicating number of spikes removed for each pair of clusters
 
     """
-    include_pcs = params['include_pcs']
+    keep, overlap_matrix, overlap_summary = find_double_counted_spikes(spike_times, 
+                                                                      spike_clusters, 
+                                                                      channel_map, 
+                                                                      channel_pos, 
+                                                                      templates, 
+                                                                      cluster_amplitude, 
+                                                                      sample_rate, 
+                                                                      params)
+
+    # remove all the duplicates at once
+    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
+                                                                         spike_clusters,
+                                                                         spike_templates, 
+                                                                         amplitudes, 
+                                                                         pc_features, 
+                                                                         template_features, 
+                                                                         np.flatnonzero(np.invert(keep)),
+                                                                         params['include_pcs'])
+
+    return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
+
+                
+def find_double_counted_spikes(spike_times, spike_clusters, channel_map, channel_pos, templates, 
+                               cluster_amplitude, sample_rate, params):
+
+    """ Find putative double-counted spikes in Kilosort outputs
+
+    Within-unit overlaps are found first; between-unit overlaps are then 
+    found among the remaining spikes.
+
+    Inputs:
+    ------
+    spike_times, spike_clusters, channel_map, channel_pos, templates, 
+    cluster_amplitude, sample_rate, params :
+        Same as remove_double_counted_spikes
+
+    Outputs:
+    --------
+    keep : numpy.ndarray (num_spikes x 0)
+        False for spikes to remove
+    overlap_matrix : numpy.ndarray (num_clusters x num_clusters)
+        Matrix indicating number of spikes removed for each pair of clusters
+    overlap_summary : numpy.ndarray (num_clusters x 5)
+        Cluster label, spikes remaining, within-unit and between-unit 
+        spikes removed, and the partner with the most duplicates
+
+    """
 
     peak_chan_idx = np.squeeze(np.argmax(np.max(templates,1) - np.min(templates,1),1))
 
@@ -79,92 +123,190 @@ def remove_double_counted_spikes(spike_times, spike_clusters, spike_templates,
     
     sorted_unit_list = unit_list[order]
 
+    # position of each unit in sorted_unit_list, which indexes overlap_matrix
+    unit_position = np.zeros((num_clusters,), dtype = 'int')
+    unit_position[sorted_unit_list] = np.arange(num_clusters)
+
     overlap_matrix = np.zeros((num_clusters, num_clusters), dtype = 'int')
     
 
     within_unit_overlap_samples = int(params['within_unit_overlap_window'] * sample_rate)
     between_unit_overlap_samples = int(params['between_unit_overlap_window'] * sample_rate)
 
+    if within_unit_overlap_samples < between_unit_overlap_samples:
+        print('Warning: within_unit_overlap_window is shorter than between_unit_overlap_window; ' +
+              'spikes from the same unit will not be counted as between-unit overlaps')
+
     print('Removing within-unit overlapping spikes...')
 
-    spikes_to_remove = np.zeros((0,), dtype = 'int')
+    spikes_to_remove = find_within_unit_overlaps(spike_times, spike_clusters, num_clusters, within_unit_overlap_samples)
 
-    for idx1, unit_id1 in enumerate(sorted_unit_list):
+    removed_per_unit = np.bincount(spike_clusters[spikes_to_remove], minlength = num_clusters)[:num_clusters]
+    overlap_matrix[unit_position, unit_position] = removed_per_unit
 
-        printProgressBar(idx1+1, len(unit_list))
+    keep = np.ones((spike_times.size,), dtype = 'bool')
+    keep[spikes_to_remove] = False
 
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
+    # spikes left after removing within-unit overlaps
+    remaining = np.flatnonzero(keep)
 
-        to_remove = find_within_unit_overlap(spike_times[for_unit1], within_unit_overlap_samples)
+    print('Removing between-unit overlapping spikes...')
 
-        overlap_matrix[idx1, idx1] = len(to_remove)
+    # units whose peak channels are close enough to share spikes
+    peak_pos = channel_pos[peak_chan_idx,:]
+    deltaX = peak_pos[:,0][np.newaxis,:] - peak_pos[:,0][:,np.newaxis]
+    deltaZ = peak_pos[:,1][np.newaxis,:] - peak_pos[:,1][:,np.newaxis]
+    dist = pow( (pow(deltaX,2) + pow(deltaZ,2)), 0.5 )
+    neighbors = dist < params['between_unit_dist_um']
+    np.fill_diagonal(neighbors, False)
+
+    early, late = find_between_unit_overlaps(spike_times[remaining], spike_clusters[remaining], neighbors, between_unit_overlap_samples)
+    early = remaining[early]
+    late = remaining[late]
+
+    early_unit = spike_clusters[early]
+    late_unit = spike_clusters[late]
+
+    if params['deletion_mode'] == 'deleteFirst':
+        # always remove the later spike of the pair
+        removed = late
+        removed_unit = late_unit
+        other_unit = early_unit
+    else:
+        # remove the spike from the unit with lower amplitude; for equal 
+        # amplitudes, from the unit that comes later in sorted_unit_list
+        early_first = unit_position[early_unit] < unit_position[late_unit]
+        unit1 = np.where(early_first, early_unit, late_unit)
+        unit2 = np.where(early_first, late_unit, early_unit)
+        remove_unit1 = cluster_amplitude[unit1] < cluster_amplitude[unit2]
+        removed = np.where(remove_unit1 == early_first, early, late)
+        removed_unit = np.where(remove_unit1, unit1, unit2)
+        other_unit = np.where(remove_unit1, unit2, unit1)
 
-        spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove]))
+    np.add.at(overlap_matrix, (unit_position[removed_unit], unit_position[other_unit]), 1)
 
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
-                                                                        spike_clusters, 
-                                                                        spike_templates, 
-                                                                        amplitudes, 
-                                                                        pc_features, 
-                                                                        template_features, 
-                                                                        spikes_to_remove,
-                                                                        include_pcs)
+    keep[removed] = False
 
-    print('Removing between-unit overlapping spikes...')
+#   build overlap summary 
+    kept_clusters = spike_clusters[keep]
+    spike_counts = np.bincount(kept_clusters[kept_clusters < num_clusters], minlength = num_clusters)
+    overlap_summary = np.zeros((num_clusters, 5), dtype=int )
+    overlap_summary[:,0] = sorted_unit_list
+    overlap_summary[:,1] = spike_counts[sorted_unit_list]
+    overlap_summary[:,2] = np.diag(overlap_matrix)
+    overlap_summary[:,3] = np.sum(overlap_matrix, 1) - np.diag(overlap_matrix)
+    overlap_summary[:,4] = sorted_unit_list[np.argmax(overlap_matrix, 1)]
+#   sort by label
+    new_order = np.argsort(overlap_summary[:,0])
+    overlap_summary = overlap_summary[new_order,:]
 
-    spikes_to_remove = np.zeros((0,), dtype = 'int')
+    return keep, overlap_matrix, overlap_summary
 
-    for idx1, unit_id1 in enumerate(sorted_unit_list):
 
-        printProgressBar(idx1+1, len(unit_list))
+def find_within_unit_overlaps(spike_times, spike_clusters, num_clusters, overlap_window = 5):
 
-        for_unit1 = np.where(spike_clusters == unit_id1)[0]
-        
-        for idx2, unit_id2 in enumerate(unit_list[order]):
-            
-            deltaX = np.squeeze(channel_pos[peak_chan_idx[unit_id2],0] - channel_pos[peak_chan_idx[unit_id1],0])
-            deltaZ = np.squeeze(channel_pos[peak_chan_idx[unit_id2],1] - channel_pos[peak_chan_idx[unit_id1],1])
-            
-            dist = pow( (pow(deltaX,2) + pow(deltaZ,2)), 0.5 )
-            
-            if idx2 > idx1 and dist < params['between_unit_dist_um']:
-                
-                amp1 = cluster_amplitude[unit_id1]
-                amp2 = cluster_amplitude[unit_id2]
-                
-                for_unit2 = np.where(spike_clusters == unit_id2)[0]
+    """
+    Finds overlapping spikes within every unit at once
 
-                to_remove1, to_remove2 = find_between_unit_overlap(spike_times[for_unit1], spike_times[for_unit2], amp1, amp2, between_unit_overlap_samples, params['deletion_mode'] )
+    Same as find_within_unit_overlap applied to the spike train of each 
+    unit with ID < num_clusters.
 
-                overlap_matrix[idx1, idx2] = overlap_matrix[idx1, idx2] + len(to_remove1) 
-                overlap_matrix[idx2, idx1] = overlap_matrix[idx2, idx1] + len(to_remove2)
+    Parameters
+    ----------
+    spike_times : numpy.ndarray
+        Spike times (in samples)
+    spike_clusters : numpy.ndarray
+        Cluster IDs for each spike time
+    num_clusters : int
+        Number of units to search
+    overlap_window : int
+        Number of samples to search for overlapping spikes
 
-                spikes_to_remove = np.concatenate((spikes_to_remove, for_unit1[to_remove1], for_unit2[to_remove2]))
+    Outputs
+    -------
+    spikes_to_remove : numpy.ndarray
+        Indices of overlapping spikes (the earlier spike of each pair)
 
+    """
 
-    spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features = remove_spikes(spike_times, 
-                                                                         spike_clusters,
-                                                                         spike_templates, 
-                                                                         amplitudes, 
-                                                                         pc_features, 
-                                                                         template_features, 
-                                                                         np.unique(spikes_to_remove),
-                                                                         include_pcs)
-#   build overlap summary 
-    overlap_summary = np.zeros((num_clusters, 5), dtype=int )
-    for idx1, unit_id1 in enumerate(unit_list[order]):
-        overlap_summary[idx1,0] = unit_id1
-        overlap_summary[idx1,1] = np.sum(spike_clusters == unit_id1)
-        overlap_summary[idx1,2] = overlap_matrix[idx1,idx1]
-        overlap_summary[idx1,3] = np.sum(overlap_matrix[idx1,:]) - overlap_matrix[idx1,idx1]
-        overlap_summary[idx1,4] = sorted_unit_list[np.argmax(overlap_matrix[idx1,:])]     
-#   sort by label
-    new_order = np.argsort(overlap_summary[:,0])
-    overlap_summary = overlap_summary[new_order,:]
+    in_range = np.flatnonzero(spike_clusters < num_clusters)
+    
+    # spikes grouped by unit, in their original order within each unit
+    order = in_range[np.argsort(spike_clusters[in_range], kind = 'stable')]
+    sorted_times = spike_times[order]
+
+    same_unit = spike_clusters[order][1:] == spike_clusters[order][:-1]
+    overlaps = same_unit & (np.diff(sorted_times) < overlap_window)
+
+    return np.sort(order[:-1][overlaps])
+
+
+def find_between_unit_overlaps(spike_times, spike_clusters, neighbors, overlap_window = 5):
+
+    """
+    Finds pairs of overlapping spikes from neighboring units
+
+    All spikes are sorted by time once, and each spike is compared with 
+    the following spikes that are within overlap_window. Assumes that spikes 
+    from the same unit are at least overlap_window apart (i.e. that within 
+    unit overlaps have been removed with a window at least as long), so 
+    that each pair found is also a pair of consecutive spikes in the merged 
+    spike trains of the two units, as in find_between_unit_overlap.
+
+    Parameters
+    ----------
+    spike_times : numpy.ndarray
+        Spike times (in samples)
+    spike_clusters : numpy.ndarray
+        Cluster IDs for each spike time
+    neighbors : numpy.ndarray (num_clusters x num_clusters)
+        True for pairs of units to search; units with ID >= num_clusters 
+        are ignored
+    overlap_window : int
+        Number of samples to search for overlapping spikes
+
+    Outputs
+    -------
+    early : numpy.ndarray
+        Index of the earlier spike of each pair
+    late : numpy.ndarray
+        Index of the later spike of each pair
+
+    """
+
+    num_clusters = neighbors.shape[0]
+
+    # simultaneous spikes stay in their original order
+    in_range = np.flatnonzero(spike_clusters < num_clusters)
+    order = in_range[np.argsort(spike_times[in_range], kind = 'stable')]
+    sorted_times = spike_times[order]
+    sorted_clusters = spike_clusters[order]
+
+    early = [np.zeros((0,), dtype = 'int')]
+    late = [np.zeros((0,), dtype = 'int')]
+
+    offset = 1
+
+    # compare each spike with the spike offset places later, until no pairs
+    # are within the window
+    while offset < order.size:
+
+        within_window = (sorted_times[offset:] - sorted_times[:-offset]) < overlap_window
+
+        if not np.any(within_window):
+            break
+
+        pairs = np.flatnonzero(within_window)
+        pairs = pairs[neighbors[sorted_clusters[pairs], sorted_clusters[pairs + offset]]]
+
+        early.append(order[pairs])
+        late.append(order[pairs + offset])
+
+        offset += 1
+
+    return np.concatenate(early), np.concatenate(late)
 
-    return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features, overlap_matrix, overlap_summary
 
-                
 def find_within_unit_overlap(spike_train, overlap_window = 5):
 
     """
@@ -305,9 +447,51 @@ def remove_spikes(spike_times, spike_clusters, spike_templates, amplitudes, pc_f
 
     return spike_times, spike_clusters, spike_templates, amplitudes, pc_features, template_features
 
-def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWaves_path):
+def remove_spikes_from_file(npy_file, keep, chunk_spikes = 100000):
+
+    """
+    Removes spikes from a Kilosort .npy file (e.g. pc_features.npy) without 
+    loading it into memory
+
+    The file is read through a memory map, chunk_spikes rows at a time, and 
+    the rows to keep are written to a temporary .npy file in the same 
+    directory, which then replaces the original.
+
+    Inputs:
+    ------
+    npy_file : String
+        Path to the .npy file; first dimension is spikes
+    keep : numpy.ndarray (num_spikes x 0)
+        False for spikes to remove
+    chunk_spikes : int
+        Number of spikes to copy at a time
+
+    """
+
+    source = np.load(npy_file, mmap_mode = 'r')
+
+    tmp_file = npy_file + '.tmp.npy'
+    dest = np.lib.format.open_memmap(tmp_file, mode = 'w+', dtype = source.dtype, 
+                                     shape = (np.sum(keep),) + source.shape[1:])
+
+    written = 0
+
+    for start in range(0, source.shape[0], chunk_spikes):
+        rows = source[start:start + chunk_spikes][keep[start:start + chunk_spikes]]
+        dest[written:written + rows.shape[0]] = rows
+        written = written + rows.shape[0]
+
+    dest.flush()
+
+    # close both memory maps before replacing the file
+    del source, dest
+
+    os.replace(tmp_file, npy_file)
+
+
+def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, num_threads = 4):
     
-    print('Calculating mean waveforms for aligh_spike_times using C_waves.')
+    print('Calculating mean waveforms for aligh_spike_times.')
 
     # assume cluster table version = 0;
     getSortResults(output_dir, 0)
@@ -318,30 +502,17 @@ def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWa
     clus_time_npy = os.path.join(output_dir, 'spike_times.npy' )
     clus_lbl_npy = os.path.join(output_dir, 'spike_clusters.npy' )
     
-    # path to the 'runit.bat' executable that calls C_Waves.
-    # Essential in linux where C_Waves executable is only callable through runit
-    if sys.platform.startswith('win'):
-        exe_path = os.path.join(cWaves_path, 'runit.bat')
-    elif sys.platform.startswith('linux'):
-        exe_path = os.path.join(cWaves_path, 'runit.sh')
-    else:
-        print('unknown system, cannot run C_Waves')
-    
-    cwaves_cmd = exe_path + ' -spikeglx_bin=' + spikeglx_bin + \
-                            ' -clus_table_npy=' + clus_table_npy + \
-                            ' -clus_time_npy=' + clus_time_npy + \
-                            ' -clus_lbl_npy=' + clus_lbl_npy + \
-                            ' -dest=' + output_dir + \
-                            ' -samples_per_spike=82' + \
-                            ' -pre_samples=20' + \
-                            ' -num_spikes=5000' + \
-                            ' -snr_radius=8' + \
-                            ' -prefix=preprocess'
-                            
-    print(cwaves_cmd)
-    
-    # make the C_Waves call
-    subprocess.call(cwaves_cmd)
+    calculate_cluster_waveforms(spikeglx_bin,
+                                clus_table_npy,
+                                clus_time_npy,
+                                clus_lbl_npy,
+                                output_dir,
+                                samples_per_spike = 82,
+                                pre_samples = 20,
+                                num_spikes = 5000,
+                                snr_radius = 8,
+                                prefix = 'preprocess',
+                                num_threads = num_threads)
     
     # load snr and waveform arrays
     mean_waveform_fullpath = os.path.join(output_dir, 'preprocess_mean_waveforms.npy')
@@ -351,7 +522,7 @@ def align_spike_times(spike_times, spike_clusters, spikeglx_bin, output_dir, cWa
     snr_array = np.load(snr_fullpath)
     (nClu, nChan, nt) = mean_waveforms.shape
     
-    peak_t = 19   #because pre_samples in C_Waves set to 20
+    peak_t = 19   #because pre_samples set to 20
     
     # Loop over units
     for i in range(nClu):
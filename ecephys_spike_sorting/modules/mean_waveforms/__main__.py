@@ -1,7 +1,5 @@
 from argschema import ArgSchemaParser
 import os
-import sys
-import subprocess
 import time
 import pathlib
 
@@ -12,11 +10,40 @@ from scipy.io import loadmat
 from ...common.utils import load_kilosort_data
 from ...common.utils import getSortResults
 from ...common.utils import getFileVersion
+from ...common.cluster_waveforms import calculate_cluster_waveforms, read_binary_info
 
-from .extract_waveforms import extract_waveforms, writeDataAsNpy
+from .extract_waveforms import extract_waveforms, extract_local_waveforms, writeDataAsNpy
 from .waveform_metrics import calculate_waveform_metrics
 from .metrics_from_file import metrics_from_file
 
+def read_site_positions(ap_band_file):
+
+    """
+    Site positions (um) for each channel of the AP band binary
+
+    Read from the SpikeGLX .meta file if there is one; otherwise from the 
+    <name>_chanMap.mat that kilosort_helper copies next to the data.
+    Empty if neither file gives the positions.
+
+    """
+
+    try:
+        num_saved_channels, uv_per_bit, site_x, site_y = read_binary_info(ap_band_file)
+    except FileNotFoundError:
+        site_x, site_y = np.zeros((0,)), np.zeros((0,))
+
+    if site_x.size == 0:
+        dat_dir, dat_fname = os.path.split(ap_band_file)
+        dat_name, dat_ext = os.path.splitext(dat_fname)
+        chanMapMat = os.path.join(dat_dir, (dat_name +'_chanMap.mat'))
+        if os.path.exists(chanMapMat):
+            chanMap = loadmat(chanMapMat)
+            site_x = np.squeeze(chanMap['xcoords']).astype('float')
+            site_y = np.squeeze(chanMap['ycoords']).astype('float')
+
+    return site_x, site_y
+
+
 def calculate_mean_waveforms(args):
 
     print('ecephys spike sorting: mean waveforms module')
@@ -64,29 +91,18 @@ def calculate_mean_waveforms(args):
             
         
         
-        # path to the 'runit.bat' executable that calls C_Waves.
-        # Essential in linux where C_Waves executable is only callable through runit
-        if sys.platform.startswith('win'):
-            exe_path = os.path.join(args['mean_waveform_params']['cWaves_path'], 'runit.bat')
-        elif sys.platform.startswith('linux'):
-            exe_path = os.path.join(args['mean_waveform_params']['cWaves_path'], 'runit.sh')
-        else:
-            print('unknown system, cannot run C_Waves')
-        
-        cwaves_cmd = exe_path + ' -spikeglx_bin=' + spikeglx_bin + \
-                                ' -clus_table_npy=' + clus_table_npy + \
-                                ' -clus_time_npy=' + clus_time_npy + \
-                                ' -clus_lbl_npy=' + clus_lbl_npy + \
-                                ' -dest=' + dest + \
-                                ' -samples_per_spike=' + repr(args['mean_waveform_params']['samples_per_spike']) + \
-                                ' -pre_samples=' + repr(args['mean_waveform_params']['pre_samples']) + \
-                                ' -num_spikes=' + repr(args['mean_waveform_params']['spikes_per_epoch']) + \
-                                ' -snr_radius=' + repr(args['mean_waveform_params']['snr_radius'])
-                                
-        print(cwaves_cmd)
-        
-        # make the C_Waves call
-        subprocess.call(cwaves_cmd)
+        # calculate the mean waveforms and snr in process; same inputs and
+        # output files as the C_Waves command line tool
+        calculate_cluster_waveforms(spikeglx_bin,
+                                    clus_table_npy,
+                                    clus_time_npy,
+                                    clus_lbl_npy,
+                                    dest,
+                                    samples_per_spike = args['mean_waveform_params']['samples_per_spike'],
+                                    pre_samples = args['mean_waveform_params']['pre_samples'],
+                                    num_spikes = args['mean_waveform_params']['spikes_per_epoch'],
+                                    snr_radius = args['mean_waveform_params']['snr_radius'],
+                                    num_threads = args['mean_waveform_params']['num_threads'])
         
         # for first version, retain original names
         if clu_version == 0:
@@ -168,17 +184,50 @@ def calculate_mean_waveforms(args):
     
         print("Calculating mean waveforms...")
     
-        waveforms, spike_counts, coords, labels, metrics = extract_waveforms(data, spike_times, \
+        # site positions for the 2D waveform metrics
+        site_x, site_y = read_site_positions(args['ephys_params']['ap_band_file'])
+
+        use_local_channels = args['mean_waveform_params']['channel_radius_um'] > 0
+
+        # without site positions, all channels are read and the 2D metrics are NaN
+        if site_x.size == 0:
+            site_x, site_y = None, None
+
+        if use_local_channels and site_x is None:
+            print('Site positions could not be read from the .meta file or channel map; reading all channels for each unit.')
+            use_local_channels = False
+
+        if use_local_channels:
+            
+            # only read the channels near each unit
+            waveforms, spike_counts, channel_index, coords, labels, metrics = extract_local_waveforms(data, spike_times, \
                     spike_clusters,
                     templates,
                     channel_map,
                     args['ephys_params']['bit_volts'], \
                     args['ephys_params']['sample_rate'], \
-                    args['ephys_params']['vertical_site_spacing'], \
+                    site_x, site_y, \
+                    args['mean_waveform_params']['channel_radius_um'], \
                     args['mean_waveform_params'])
+        else:
+            
+            waveforms, spike_counts, coords, labels, metrics = extract_waveforms(data, spike_times, \
+                    spike_clusters,
+                    templates,
+                    channel_map,
+                    args['ephys_params']['bit_volts'], \
+                    args['ephys_params']['sample_rate'], \
+                    args['ephys_params']['vertical_site_spacing'], \
+                    args['mean_waveform_params'], \
+                    site_x = site_x, site_y = site_y)
+            channel_index = None
     
-        writeDataAsNpy(waveforms, args['mean_waveform_params']['mean_waveforms_file'])
-        metrics.to_csv(args['waveform_metrics']['waveform_metrics_file'], index=False)
+        writeDataAsNpy(waveforms, args['mean_waveform_params']['mean_waveforms_file'], channel_index)
+
+        # the python calculation does not version its output files
+        clu_version = 0
+        wm_fullpath = args['waveform_metrics']['waveform_metrics_file']
+        metrics.to_csv(wm_fullpath, index=False)
 
 
     # if the cluster metrics have already been run, merge the waveform metrics into that file
@@ -11,9 +11,11 @@ class MeanWaveformParams(DefaultSchema):
     upsampling_factor = Float(require=False, default=200/82, help='Upsampling factor for calculating waveform metrics')
     spread_threshold = Float(require=False, default=0.12, help='Threshold for computing channel spread of 2D waveform')
     site_range = Int(require=False, default=16, help='Number of sites to use for 2D waveform metrics')
-    cWaves_path = InputDir(require=False, help='directory containing the TPrime executable.')
-    use_C_Waves = Bool(require=False, default=False, help='Use faster C routine to calculate mean waveforms')
+    cWaves_path = InputDir(require=False, help='no longer used; C_Waves calculation runs in process')
+    use_C_Waves = Bool(require=False, default=False, help='Use faster C_Waves-style calculation of mean waveforms and snr')
     snr_radius = Int(require=False, default=8, help='disk radius (chans) about pk-chan for snr calculation in C_waves')
+    channel_radius_um = Float(require=False, default=0, help='If > 0, extract only the channels within this distance (um) of each unit peak channel (python calculation only)')
+    num_threads = Int(require=False, default=4, help='Number of threads for the C_Waves-style calculation')
     mean_waveforms_file = String(required=True, help='Path to mean waveforms file (.npy)')
 
 
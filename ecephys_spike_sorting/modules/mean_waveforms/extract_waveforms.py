@@ -3,13 +3,12 @@ import os
 import glob
 
 import xarray as xr
-import pandas as pd
 
 import warnings
 
-from .waveform_metrics import calculate_waveform_metrics
+from .waveform_metrics import calculate_1D_waveform_metrics, calculate_2D_features, calculate_site_neighborhoods, get_site_neighborhood, make_waveform_metrics_table, calculate_snr_from_stats
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar
+from ...common.utils import printProgressBar, get_cluster_spike_index
 
 def extract_waveforms(raw_data, 
                       spike_times, 
@@ -20,11 +19,19 @@ def extract_waveforms(raw_data,
                       sample_rate, 
                       site_spacing, 
                       params, 
-                      epochs=None):
+                      epochs=None,
+                      chunk_samples=300000,
+                      site_x=None,
+                      site_y=None):
     
     """
     Calculate mean waveforms for sorted units.
 
+    The spikes sampled for every cluster and epoch are sorted by time, and the 
+    raw data is read once, in order, in chunks of chunk_samples. Each spike 
+    waveform is added to running mean and variance accumulators for its 
+    cluster and epoch, so the individual waveforms are never stored.
+
     Inputs:
     -------
     raw_data : continuous data as numpy array (samples x channels)
@@ -34,6 +41,9 @@ def extract_waveforms(raw_data,
     cluster_quality : 'noise' or 'good'
     sample_rate : Hz
     site_spacing : m
+    chunk_samples : number of samples read from raw_data at a time
+    site_x, site_y : positions (um) of each channel in raw_data, for the 2D 
+        waveform metrics (NaN if not given or empty)
 
     Outputs:
     -------
@@ -71,8 +81,6 @@ def extract_waveforms(raw_data,
 
     # #############################################
 
-    metrics = pd.DataFrame()
-
     if epochs is None:
         epochs = [Epoch('complete_session', 0, np.inf)]
 
@@ -81,81 +89,496 @@ def extract_waveforms(raw_data,
     total_epochs = len(epochs)
 
     # allocate array for waveforms, datatype = default, double
+    # while accumulating, the std slot holds the sum of squared deviations
     mean_waveforms = np.zeros(
         (total_units, total_epochs, 2, raw_data.shape[1], samples_per_spike))
     spike_count = np.zeros((total_units, total_epochs + 1), dtype = 'int')
 
     peak_channels = np.squeeze(channel_map[np.argmax(np.max(templates,1) - np.min(templates,1),1)])
 
-    for epoch_idx, epoch in enumerate(epochs):
+    print("Selecting spikes...")
 
-        print("Epoch: " + epoch.name)
+    peak_times, unit_epoch = select_waveform_spikes(spike_times, spike_clusters, total_units, epochs, 
+                                                    sample_rate, spikes_per_epoch, spike_count)
 
-        in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
+    print("Reading waveforms...")
 
-        spike_times_in_epoch = spike_times[in_epoch]
+    valid_count = accumulate_waveforms(raw_data, 
+                                       peak_times.astype('int64') - pre_samples, 
+                                       unit_epoch, 
+                                       mean_waveforms.reshape((total_units * total_epochs, 2, 
+                                                               raw_data.shape[1], samples_per_spike)),
+                                       bit_volts, 
+                                       chunk_samples)
+    valid_count = valid_count.reshape((total_units, total_epochs))
+
+    # (epoch, cluster) pairs with spikes, in the order of the metrics table
+    rows = np.argwhere(spike_count[:, :total_epochs].T > 0)
+    peak_waveforms = np.zeros((len(rows), samples_per_spike))
+    snr = np.zeros((len(rows),))
+
+    for row, (epoch_idx, cluster_idx) in enumerate(rows):
+
+        mean_wv = mean_waveforms[cluster_idx, epoch_idx, 0, :, :]
+        std_wv = mean_waveforms[cluster_idx, epoch_idx, 1, :, :]
+
+        # waveforms at the start or end of the dataset are not counted
+        # (same as the NaN waveforms ignored by nanmean/nanstd)
+        if valid_count[cluster_idx, epoch_idx] > 0:
+            std_wv[:] = std_wv / valid_count[cluster_idx, epoch_idx]
+        else:
+            mean_wv[:] = np.nan
+            std_wv[:] = np.nan
+
+        with warnings.catch_warnings():
+
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            snr[row] = calculate_snr_from_stats(mean_wv[peak_channels[cluster_idx], :], 
+                                                std_wv[peak_channels[cluster_idx], :])
+
+        peak_waveforms[row, :] = mean_wv[peak_channels[cluster_idx], :]
+
+    print("Calculating metrics...")
+
+    # 1D metrics for all clusters and epochs at once
+    with warnings.catch_warnings():
+
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        metrics_1D, timestamps = calculate_1D_waveform_metrics(peak_waveforms, sample_rate, upsampling_factor)
+
+    metrics_2D = np.full((len(rows), 4), np.nan)
+
+    # sites sampled for the 2D metrics, for each peak channel
+    has_sites = site_x is not None and site_x.size > 0
+
+    if has_sites:
+        neighborhoods = calculate_site_neighborhoods(site_x, site_y, site_range, peak_channels[rows[:,1]])
+
+    for row, (epoch_idx, cluster_idx) in enumerate(rows):
+
+        printProgressBar(row+1, len(rows))
+
+        mean_wv = mean_waveforms[cluster_idx, epoch_idx, 0, :, :]
+        std_wv = mean_waveforms[cluster_idx, epoch_idx, 1, :, :]
+
+        # 2D metrics need the position of every channel in raw_data
+        if has_sites:
+            metrics_2D[row, :] = calculate_2D_features(mean_wv, 
+                                                       timestamps, 
+                                                       peak_channels[cluster_idx], 
+                                                       site_x, site_y, 
+                                                       spread_threshold, 
+                                                       site_range,
+                                                       neighborhoods[peak_channels[cluster_idx]])
+
+        std_wv[:] = np.sqrt(std_wv)
+
+        # remove offset
+        mean_wv[:] = mean_wv - mean_wv[:, :1]
+
+    metrics = make_waveform_metrics_table(cluster_ids[rows[:,1]],
+                                          [epochs[epoch_idx].name for epoch_idx in rows[:,0]],
+                                          peak_channels[rows[:,1]],
+                                          snr,
+                                          metrics_1D,
+                                          metrics_2D)
+
+    dimCoords, dimLabels = generateDimLabels(
+        cluster_ids, total_epochs, pre_samples, samples_per_spike, raw_data.shape[1], sample_rate)
+
+    return mean_waveforms, spike_count, dimCoords, dimLabels, metrics
+
+
+def extract_local_waveforms(raw_data, 
+                            spike_times, 
+                            spike_clusters, 
+                            templates, 
+                            channel_map, 
+                            bit_volts, 
+                            sample_rate, 
+                            site_x,
+                            site_y,
+                            channel_radius_um,
+                            params, 
+                            epochs=None,
+                            chunk_samples=300000):
+    
+    """
+    Calculate mean waveforms for sorted units, on the channels near each unit's peak channel
+
+    Same as extract_waveforms, but for each unit only the channels within 
+    channel_radius_um of its peak channel are extracted and averaged. The
+    mean and std are stored for those channels only, with an index of the
+    raw data channel in each slot.
+
+    Inputs:
+    -------
+    raw_data : continuous data as numpy array (samples x channels)
+    spike_times : spike times (in samples)
+    spike_clusters : cluster IDs for each spike time []
+    templates : unwhitened templates (used to find the peak channel)
+    channel_map : channels used for sorting
+    bit_volts : scaling from raw data to microvolts
+    sample_rate : Hz
+    site_x, site_y : positions (um) of each channel in raw_data, e.g. from the .meta file
+    channel_radius_um : distance from the peak channel (um) of the channels to extract
+    chunk_samples : number of samples read from raw_data at a time
+
+    Outputs:
+    -------
+    mean_waveforms : numpy array with dims :
+     - 1 : clusterID
+     - 2 : epochs
+     - 3 : mean (0) or std (1)
+     - 4 : local channel (see channel_index)
+     - 5 : samples
+    spike_count : numpy array with dims :
+     - 1 : clusterID
+     - 2 : epoch (last is entire dataset)
+    channel_index : numpy array (clusterID x local channel)
+        raw data channel in each local channel slot; -1 (and NaN waveforms) 
+        for unused slots
+    dimCoords : list of coordinates for each dimension
+    dimLabels : list of labels for each dimension
+    metrics : DataFrame with waveform metrics
+
+    """
+
+    # #############################################
+
+    samples_per_spike = params['samples_per_spike']
+    pre_samples = params['pre_samples']
+    spikes_per_epoch = params['spikes_per_epoch']
+    upsampling_factor = params['upsampling_factor']
+    spread_threshold = params['spread_threshold']
+    site_range = params['site_range']
+
+    # #############################################
+
+    if epochs is None:
+        epochs = [Epoch('complete_session', 0, np.inf)]
+
+    cluster_ids = np.arange(np.max(spike_clusters) + 1)
+    total_units = len(cluster_ids)
+    total_epochs = len(epochs)
+
+    peak_channels = np.squeeze(channel_map[np.argmax(np.max(templates,1) - np.min(templates,1),1)])
+
+    channel_index = get_local_channels(site_x, site_y, peak_channels, channel_radius_um)
+    local_channels = channel_index.shape[1]
+
+    # allocate array for waveforms, datatype = default, double
+    # while accumulating, the std slot holds the sum of squared deviations
+    mean_waveforms = np.zeros(
+        (total_units, total_epochs, 2, local_channels, samples_per_spike))
+    spike_count = np.zeros((total_units, total_epochs + 1), dtype = 'int')
+
+    print("Selecting spikes...")
+
+    peak_times, unit_epoch = select_waveform_spikes(spike_times, spike_clusters, total_units, epochs, 
+                                                    sample_rate, spikes_per_epoch, spike_count)
+
+    print("Reading waveforms...")
+
+    valid_count = accumulate_waveforms(raw_data, 
+                                       peak_times.astype('int64') - pre_samples, 
+                                       unit_epoch, 
+                                       mean_waveforms.reshape((total_units * total_epochs, 2, 
+                                                               local_channels, samples_per_spike)),
+                                       bit_volts, 
+                                       chunk_samples,
+                                       group_channels = np.repeat(np.maximum(channel_index, 0), total_epochs, axis = 0))
+    valid_count = valid_count.reshape((total_units, total_epochs))
+
+    # (epoch, cluster) pairs with spikes, in the order of the metrics table
+    rows = np.argwhere(spike_count[:, :total_epochs].T > 0)
+    local_peaks = np.argmax(channel_index == peak_channels[:, np.newaxis], axis = 1)
+    peak_waveforms = np.zeros((len(rows), samples_per_spike))
+    snr = np.zeros((len(rows),))
+
+    for row, (epoch_idx, cluster_idx) in enumerate(rows):
+
+        local_peak = local_peaks[cluster_idx]
+        mean_wv = mean_waveforms[cluster_idx, epoch_idx, 0, :, :]
+        std_wv = mean_waveforms[cluster_idx, epoch_idx, 1, :, :]
+
+        if valid_count[cluster_idx, epoch_idx] > 0:
+            std_wv[:] = std_wv / valid_count[cluster_idx, epoch_idx]
+        else:
+            mean_wv[:] = np.nan
+            std_wv[:] = np.nan
+
+        with warnings.catch_warnings():
+
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            snr[row] = calculate_snr_from_stats(mean_wv[local_peak, :], std_wv[local_peak, :])
+
+        peak_waveforms[row, :] = mean_wv[local_peak, :]
 
-        for cluster_idx, cluster_id in enumerate(cluster_ids):
+    print("Calculating metrics...")
 
-            printProgressBar(cluster_idx+1, total_units)
+    # 1D metrics for all clusters and epochs at once
+    with warnings.catch_warnings():
 
-            in_cluster = (spike_clusters[in_epoch] == cluster_id)
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        metrics_1D, timestamps = calculate_1D_waveform_metrics(peak_waveforms, sample_rate, upsampling_factor)
 
-            if np.sum(in_cluster) > 0:
+    metrics_2D = np.zeros((len(rows), 4))
 
-                times_for_cluster = spike_times_in_epoch[in_cluster]
+    # the local channels, and the sites sampled for the 2D metrics, depend 
+    # only on the peak channel
+    neighborhoods = { }
 
-                waveforms = np.empty(
-                    (spikes_per_epoch, raw_data.shape[1], samples_per_spike))
-                waveforms[:] = np.nan
+    for row, (epoch_idx, cluster_idx) in enumerate(rows):
+
+        printProgressBar(row+1, len(rows))
+
+        in_use = channel_index[cluster_idx] >= 0
+        mean_wv = mean_waveforms[cluster_idx, epoch_idx, 0, :, :]
+        std_wv = mean_waveforms[cluster_idx, epoch_idx, 1, :, :]
+
+        local_x = site_x[channel_index[cluster_idx, in_use]]
+        local_y = site_y[channel_index[cluster_idx, in_use]]
+
+        if peak_channels[cluster_idx] not in neighborhoods:
+            neighborhoods[peak_channels[cluster_idx]] = get_site_neighborhood(local_x, local_y, 
+                                                                              local_peaks[cluster_idx], 
+                                                                              site_range)
+
+        # 2D metrics on the local channels, with their own geometry
+        metrics_2D[row, :] = calculate_2D_features(mean_wv[in_use, :], 
+                                                   timestamps, 
+                                                   local_peaks[cluster_idx], 
+                                                   local_x, local_y, 
+                                                   spread_threshold, 
+                                                   site_range,
+                                                   neighborhoods[peak_channels[cluster_idx]])
+
+        std_wv[:] = np.sqrt(std_wv)
+
+        # remove offset
+        mean_wv[:] = mean_wv - mean_wv[:, :1]
+
+        mean_wv[np.invert(in_use), :] = np.nan
+        std_wv[np.invert(in_use), :] = np.nan
+
+    metrics = make_waveform_metrics_table(cluster_ids[rows[:,1]],
+                                          [epochs[epoch_idx].name for epoch_idx in rows[:,0]],
+                                          peak_channels[rows[:,1]],
+                                          snr,
+                                          metrics_1D,
+                                          metrics_2D)
+
+    dimCoords, dimLabels = generateDimLabels(
+        cluster_ids, total_epochs, pre_samples, samples_per_spike, local_channels, sample_rate)
+
+    return mean_waveforms, spike_count, channel_index, dimCoords, dimLabels, metrics
+
+
+def get_local_channels(site_x, site_y, peak_channels, channel_radius_um):
+
+    """
+    Finds the channels within a given distance of each unit's peak channel
+
+    Inputs:
+    -------
+    site_x, site_y : numpy.ndarray
+        Position (um) of each channel
+    peak_channels : numpy.ndarray
+        Peak channel of each unit
+    channel_radius_um : float
+        Maximum distance from the peak channel
+
+    Outputs:
+    --------
+    channel_index : numpy.ndarray (units x local channels)
+        Channels near each unit's peak channel, in increasing order, padded with -1
+
+    """
+
+    peak_channels = np.atleast_1d(peak_channels)
+
+    if site_x.size == 0:
+        raise ValueError('Site positions are required to find the local channels of each unit')
+
+    dist = np.sqrt((site_x[peak_channels, np.newaxis] - site_x[np.newaxis, :])**2 + 
+                   (site_y[peak_channels, np.newaxis] - site_y[np.newaxis, :])**2)
+    is_local = dist <= channel_radius_um
+
+    local_count = np.sum(is_local, 1)
+    channel_index = np.full((peak_channels.size, np.max(local_count)), -1, dtype = 'int64')
+
+    # channels of each row in order, then slot within the row
+    rows, channels = np.nonzero(is_local)
+    slots = np.arange(rows.size) - np.repeat(np.cumsum(local_count) - local_count, local_count)
+    channel_index[rows, slots] = channels
+
+    return channel_index
+
+
+def select_waveform_spikes(spike_times, spike_clusters, total_units, epochs, sample_rate, spikes_per_epoch, spike_count):
+
+    """
+    Randomly selects up to spikes_per_epoch spikes for each cluster in each epoch
+
+    Spikes are drawn in the same order (epoch, then cluster) and with the same
+    calls to the random number generator as when each cluster is processed
+    separately, so a given seed selects the same spikes.
+
+    Inputs:
+    -------
+    spike_times : spike times (in samples)
+    spike_clusters : cluster IDs for each spike time
+    total_units : number of cluster IDs
+    epochs : list of Epoch objects
+    sample_rate : Hz
+    spikes_per_epoch : max number of spikes per cluster and epoch
+    spike_count : numpy.ndarray (units x epochs + 1)
+        Filled in with the number of spikes selected for each cluster and epoch
+
+    Outputs:
+    --------
+    peak_times : numpy.ndarray
+        Times (in samples) of the selected spikes, in increasing order
+    unit_epoch : numpy.ndarray
+        Index (cluster * number of epochs + epoch) of each selected spike
+
+    """
+
+    selected_times = []
+    selected_groups = []
+
+    for epoch_idx, epoch in enumerate(epochs):
+
+        in_epoch = ((spike_times / sample_rate) > epoch.start_time) * ((spike_times / sample_rate) < epoch.end_time)
+
+        spike_times_in_epoch = spike_times[in_epoch]
+
+        spike_order, cluster_offsets = get_cluster_spike_index(spike_clusters[in_epoch], total_units)
+
+        for cluster_idx in range(total_units):
+
+            if cluster_offsets[cluster_idx+1] > cluster_offsets[cluster_idx]:
+
+                times_for_cluster = spike_times_in_epoch[spike_order[cluster_offsets[cluster_idx]:cluster_offsets[cluster_idx+1]]]
 
                 np.random.shuffle(times_for_cluster)
 
                 total_waveforms = np.min(
                     [times_for_cluster.size, spikes_per_epoch])
 
-                for wv_idx, peak_time in enumerate(times_for_cluster[:total_waveforms]):
-                    start = int(peak_time-pre_samples)
-                    end = start + samples_per_spike
-                    rawWaveform = raw_data[start:end, :].T
-
-                    # in case spike was at start or end of dataset
-                    if rawWaveform.shape[1] == samples_per_spike:
-                        waveforms[wv_idx, :, :] = rawWaveform * bit_volts
-
-                # concatenate to existing dataframe
-                metrics = pd.concat([metrics, calculate_waveform_metrics(waveforms[:total_waveforms, :, :],
-                                                                         cluster_id, 
-                                                                         peak_channels[cluster_idx], 
-                                                                         channel_map,
-                                                                         sample_rate, 
-                                                                         upsampling_factor,
-                                                                         spread_threshold,
-                                                                         site_range,
-                                                                         site_spacing,
-                                                                         epoch.name
-                                                                         )])
-
-                with warnings.catch_warnings():
-
-                    warnings.simplefilter("ignore", category=RuntimeWarning)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   0, :, :] = np.nanmean(waveforms, 0)
-                    mean_waveforms[cluster_idx, epoch_idx,
-                                   1, :, :] = np.nanstd(waveforms, 0)
-
-                    # remove offset
-                    for channel in range(0, mean_waveforms.shape[3]):
-                        mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] = \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, :] - \
-                            mean_waveforms[cluster_idx, epoch_idx, 0, channel, 0]
+                selected_times.append(times_for_cluster[:total_waveforms])
+                selected_groups.append(np.full((total_waveforms,), cluster_idx * len(epochs) + epoch_idx))
 
                 spike_count[cluster_idx, epoch_idx] = total_waveforms
 
-    dimCoords, dimLabels = generateDimLabels(
-        cluster_ids, total_epochs, pre_samples, samples_per_spike, raw_data.shape[1], sample_rate)
+    if len(selected_times) == 0:
+        return np.zeros((0,), dtype = spike_times.dtype), np.zeros((0,), dtype = 'int64')
 
-    return mean_waveforms, spike_count, dimCoords, dimLabels, metrics
+    peak_times = np.concatenate(selected_times)
+    unit_epoch = np.concatenate(selected_groups)
+
+    order = np.argsort(peak_times, kind = 'stable')
+
+    return peak_times[order], unit_epoch[order]
+
+
+def accumulate_waveforms(raw_data, start_samples, groups, accumulators, bit_volts, chunk_samples, batch_size = 256, group_channels = None):
+
+    """
+    Reads waveforms in time order and adds them to running mean accumulators
+
+    Waveforms are combined in batches and merged into the accumulators with
+    the parallel form of Welford's algorithm (Chan et al., 1979), which is as
+    accurate as computing the mean and variance from all waveforms at once.
+
+    Inputs:
+    -------
+    raw_data : continuous data as numpy array (samples x channels)
+    start_samples : numpy.ndarray
+        First sample of each waveform, in increasing order
+    groups : numpy.ndarray
+        Accumulator index for each waveform
+    accumulators : numpy.ndarray (groups x 2 x channels x samples)
+        Running mean (0) and sum of squared deviations from the mean (1); 
+        updated in place
+    bit_volts : float
+        Scaling from raw data to microvolts
+    chunk_samples : int
+        Number of samples read from raw_data at a time
+    batch_size : int
+        Maximum number of waveforms combined before merging
+    group_channels : numpy.ndarray (groups x channels) (optional)
+        Channels of raw_data to read for each accumulator; if None, all
+        channels are read
+
+    Outputs:
+    --------
+    counts : numpy.ndarray
+        Number of waveforms added to each accumulator. Waveforms that extend
+        past the start or end of the data are skipped.
+
+    """
+
+    total_samples = raw_data.shape[0]
+    samples_per_spike = accumulators.shape[3]
+
+    counts = np.zeros((accumulators.shape[0],), dtype = 'int64')
+
+    is_valid = (start_samples >= 0) * (start_samples + samples_per_spike <= total_samples)
+    start_samples = start_samples[is_valid]
+    groups = groups[is_valid]
+
+    if start_samples.size == 0:
+        return counts
+
+    chunk_starts = np.arange(start_samples[0] - start_samples[0] % chunk_samples, start_samples[-1] + 1, chunk_samples)
+    chunk_bounds = np.searchsorted(start_samples, np.append(chunk_starts, start_samples[-1] + 1))
+
+    offsets = np.arange(samples_per_spike)
+
+    for chunk_idx, chunk_start in enumerate(chunk_starts):
+
+        printProgressBar(chunk_idx+1, len(chunk_starts))
+
+        first, last = chunk_bounds[chunk_idx], chunk_bounds[chunk_idx+1]
+
+        if last == first:
+            continue
+
+        chunk_end = start_samples[last-1] + samples_per_spike
+        chunk = np.asarray(raw_data[chunk_start:chunk_end, :])
+
+        for batch_start in range(first, last, batch_size):
+
+            batch = np.arange(batch_start, min(batch_start + batch_size, last))
+
+            # waveforms x channels x samples, sorted by accumulator
+            batch = batch[np.argsort(groups[batch], kind = 'stable')]
+            sample_inds = (start_samples[batch] - chunk_start)[:, np.newaxis] + offsets
+            if group_channels is None:
+                snippets = chunk[sample_inds, :]
+            else:
+                snippets = chunk[sample_inds[:, :, np.newaxis], group_channels[groups[batch]][:, np.newaxis, :]]
+            snippets = np.transpose(snippets, (0, 2, 1)) * bit_volts
+
+            batch_groups, group_starts, batch_counts = np.unique(groups[batch], return_index = True, return_counts = True)
+
+            batch_mean = np.add.reduceat(snippets, group_starts, axis = 0) / batch_counts[:, np.newaxis, np.newaxis]
+            deviations = snippets - np.repeat(batch_mean, batch_counts, axis = 0)
+            batch_m2 = np.add.reduceat(deviations * deviations, group_starts, axis = 0)
+
+            prior_counts = counts[batch_groups]
+            total_counts = prior_counts + batch_counts
+            delta = batch_mean - accumulators[batch_groups, 0]
+
+            weight = (batch_counts / total_counts)[:, np.newaxis, np.newaxis]
+            accumulators[batch_groups, 0] += delta * weight
+            accumulators[batch_groups, 1] += batch_m2 + delta * delta * (prior_counts[:, np.newaxis, np.newaxis] * weight)
+
+            counts[batch_groups] = total_counts
+
+    return counts
 
 
 def generateDimLabels(good_clusters, num_epochs, pre_samples, total_samples, num_channels, sample_rate):
@@ -202,9 +625,13 @@ def writeDataAsXarray(mean_waveforms, spike_count, dimCoords, dimLabels, output_
     ds.to_netcdf(output_file)
 
 
-def writeDataAsNpy(waveforms, output_file):
+def writeDataAsNpy(waveforms, output_file, channel_index = None):
     """ Saves mean waveforms as xarray """
 
     mean_waveforms = waveforms[:, -1, 0, :, :]  # extract overall mean
 
     np.save(output_file, mean_waveforms)
+
+    # channel-local waveforms are saved with the channel of each slot
+    if channel_index is not None:
+        np.save(os.path.splitext(output_file)[0] + '_channels.npy', channel_index)
@@ -3,11 +3,10 @@ import os
 import glob
 
 import xarray as xr
-import pandas as pd
 
 import warnings
 
-from .waveform_metrics import calculate_waveform_metrics_from_avg
+from .waveform_metrics import calculate_1D_waveform_metrics, calculate_2D_features, calculate_site_neighborhoods, make_waveform_metrics_table
 from ...common.epoch import Epoch
 from ...common.utils import printProgressBar
 
@@ -80,8 +79,6 @@ def metrics_from_file(mean_waveform_fullpath,
 
     # #############################################
 
-    metrics = pd.DataFrame()
-
     cluster_ids = np.arange(np.max(spike_clusters) + 1)
     total_units = len(cluster_ids)
     
@@ -105,27 +102,38 @@ def metrics_from_file(mean_waveform_fullpath,
 #        currdiff = np.max(curr_unwh,1) - np.min(curr_unwh,1)
 #        peak_channels[i] = channel_map[np.argmax(currdiff)]
     
-    for cluster_idx, cluster_id in enumerate(cluster_ids):
-
-        printProgressBar(cluster_idx+1, total_units)
-
-        snr = snr_array[cluster_idx,0]
-        nSpike = snr_array[cluster_idx,1]
-        # if at least one spike, calculate metrics and concatenate to existing dataframe
-        if nSpike > 0:
-            metrics = pd.concat([metrics, calculate_waveform_metrics_from_avg(mean_waveforms[cluster_idx,:],
-                                                                     snr,
-                                                                     cluster_id, 
-                                                                     peak_channels[cluster_idx], 
-                                                                     channel_map,
-                                                                     sample_rate, 
-                                                                     upsampling_factor,
-                                                                     spread_threshold,
-                                                                     site_range,
-                                                                     site_x, site_y                                                                    
-                                                                     )])
-
-
+    # units with at least one spike
+    units = np.flatnonzero(snr_array[:total_units,1] > 0)
+    unit_peaks = peak_channels[units].astype('int64')
+
+    # 1D metrics for all units at once, from the peak channel waveforms
+    metrics_1D, timestamps = calculate_1D_waveform_metrics(mean_waveforms[units, unit_peaks, :],
+                                                           sample_rate,
+                                                           upsampling_factor)
+
+    metrics_2D = np.zeros((units.size, 4))
+
+    # sites sampled for the 2D metrics, for each peak channel
+    neighborhoods = calculate_site_neighborhoods(site_x, site_y, site_range, unit_peaks)
+
+    for idx, cluster_idx in enumerate(units):
+
+        printProgressBar(idx+1, units.size)
+
+        metrics_2D[idx,:] = calculate_2D_features(mean_waveforms[cluster_idx,:], 
+                                                  timestamps, 
+                                                  unit_peaks[idx], 
+                                                  site_x, site_y, 
+                                                  spread_threshold, 
+                                                  site_range,
+                                                  neighborhoods[unit_peaks[idx]])
+
+    metrics = make_waveform_metrics_table(cluster_ids[units],
+                                          ['complete_session'] * units.size,
+                                          peak_channels[units],
+                                          snr_array[units,0],
+                                          metrics_1D,
+                                          metrics_2D)
 
     return metrics
 
@@ -1,6 +1,7 @@
 import numpy as np
 import random
 import pandas as pd
+from collections import OrderedDict
 
 from scipy.stats import linregress
 from scipy.signal import resample
@@ -55,10 +56,53 @@ def calculate_waveform_metrics(waveforms,
 
     snr = calculate_snr(waveforms[:, peak_channel, :])
 
-    mean_2D_waveform = np.squeeze(np.nanmean(waveforms[:, channel_map, :], 0))
+    return calculate_waveform_metrics_from_mean(np.nanmean(waveforms, 0),
+                                                snr,
+                                                cluster_id, 
+                                                peak_channel, 
+                                                channel_map, 
+                                                sample_rate, 
+                                                upsampling_factor, 
+                                                spread_threshold,
+                                                site_range,
+                                                site_spacing,
+                                                epoch_name)
+
+def calculate_waveform_metrics_from_mean(mean_waveform, 
+                                         snr,
+                                         cluster_id, 
+                                         peak_channel, 
+                                         channel_map, 
+                                         sample_rate, 
+                                         upsampling_factor, 
+                                         spread_threshold,
+                                         site_range,
+                                         site_spacing,
+                                         epoch_name):
+    
+    """
+    Calculate metrics for the mean waveform of one cluster, when the 
+    individual waveforms have already been averaged
+
+    Inputs:
+    -------
+    mean_waveform : numpy.ndarray (num_channels x num_samples)
+        Mean waveform on all channels of the raw data
+    snr : float
+        Signal-to-noise ratio on the peak channel
+    (other inputs are the same as calculate_waveform_metrics)
+
+    Outputs:
+    -------
+    metrics : pandas.DataFrame
+        Single-row table containing all metrics
+
+    """
+
+    mean_2D_waveform = np.squeeze(mean_waveform[channel_map, :])
     local_peak = np.argmin(np.abs(channel_map - peak_channel))
 
-    num_samples = waveforms.shape[2]
+    num_samples = mean_waveform.shape[1]
     new_sample_count = int(num_samples * upsampling_factor)
 
     mean_1D_waveform = resample(
@@ -179,6 +223,200 @@ def calculate_waveform_metrics_from_avg(avg_waveform,
 
 # ==========================================================
 
+# BATCHED METRICS FOR MANY UNITS
+
+# ==========================================================
+
+
+def calculate_1D_waveform_metrics(peak_waveforms, sample_rate, upsampling_factor):
+
+    """
+    Calculate the 1D waveform metrics for many units at once
+
+    Same values as calculate_waveform_duration, _halfwidth, _PT_ratio, 
+    _repolarization_slope and _recovery_slope applied to each unit, with all
+    waveforms upsampled by one batched FFT resample.
+
+    Inputs:
+    -------
+    peak_waveforms : numpy.ndarray (units x samples)
+        Mean waveform of each unit on its peak channel
+    sample_rate : float
+        Sample rate in Hz
+    upsampling_factor : float
+        Relative rate at which to upsample the spike waveform
+
+    Outputs:
+    --------
+    metrics : OrderedDict
+        duration, halfwidth, PT_ratio, repolarization_slope and 
+        recovery_slope arrays (one value per unit)
+    timestamps : numpy.ndarray
+        Timestamps of the upsampled waveforms
+
+    """
+
+    num_samples = peak_waveforms.shape[1]
+    new_sample_count = int(num_samples * upsampling_factor)
+
+    waveforms = resample(peak_waveforms, new_sample_count, axis = 1)
+
+    timestamps = np.linspace(0, num_samples / sample_rate, new_sample_count)
+
+    metrics = OrderedDict()
+    metrics['duration'] = calculate_waveform_durations(waveforms, timestamps)
+    metrics['halfwidth'] = calculate_waveform_halfwidths(waveforms, timestamps)
+    metrics['PT_ratio'] = calculate_waveform_PT_ratios(waveforms)
+    metrics['repolarization_slope'] = calculate_waveform_repolarization_slopes(waveforms, timestamps)
+    metrics['recovery_slope'] = calculate_waveform_recovery_slopes(waveforms, timestamps)
+
+    return metrics, timestamps
+
+
+def make_waveform_metrics_table(cluster_ids, epoch_names, peak_channels, snr, metrics_1D, metrics_2D):
+
+    """
+    Builds the waveform metrics DataFrame for many units at once
+
+    Inputs:
+    -------
+    cluster_ids, epoch_names, peak_channels, snr : array-like (one value per row)
+    metrics_1D : OrderedDict
+        Output of calculate_1D_waveform_metrics
+    metrics_2D : numpy.ndarray (rows x 4)
+        amplitude, spread, velocity_above, velocity_below for each row
+
+    Outputs:
+    --------
+    metrics : pandas.DataFrame
+        Same columns as calculate_waveform_metrics, one row per unit
+
+    """
+
+    metrics_2D = np.reshape(metrics_2D, (-1, 4))
+
+    data = OrderedDict((('cluster_id', cluster_ids),
+                        ('epoch_name', epoch_names),
+                        ('peak_channel', peak_channels),
+                        ('snr', snr)))
+    data.update(metrics_1D)
+    data.update((('amplitude', metrics_2D[:,0]),
+                 ('spread', metrics_2D[:,1]),
+                 ('velocity_above', metrics_2D[:,2]),
+                 ('velocity_below', metrics_2D[:,3])))
+
+    return pd.DataFrame(data)
+
+
+def calculate_waveform_durations(waveforms, timestamps):
+
+    """ Batched calculate_waveform_duration (waveforms : units x samples) """
+
+    trough_idx = np.argmin(waveforms, 1)
+    peak_idx = np.argmax(waveforms, 1)
+    rows = np.arange(waveforms.shape[0])
+
+    peak_first = waveforms[rows, peak_idx] > np.abs(waveforms[rows, trough_idx])
+    start_idx = np.where(peak_first, peak_idx, trough_idx)
+
+    # first minimum after the peak, or first maximum after the trough
+    before_start = np.arange(waveforms.shape[1]) < start_idx[:, np.newaxis]
+    after_peak = np.where(before_start, np.inf, waveforms)
+    after_trough = np.where(before_start, -np.inf, waveforms)
+    end_idx = np.where(peak_first, np.argmin(after_peak, 1), np.argmax(after_trough, 1))
+
+    return (timestamps[end_idx] - timestamps[start_idx]) * 1e3
+
+
+def calculate_waveform_halfwidths(waveforms, timestamps):
+
+    """ Batched calculate_waveform_halfwidth (waveforms : units x samples) """
+
+    trough_idx = np.argmin(waveforms, 1)
+    peak_idx = np.argmax(waveforms, 1)
+    rows = np.arange(waveforms.shape[0])
+
+    peak_first = waveforms[rows, peak_idx] > np.abs(waveforms[rows, trough_idx])
+    ref_idx = np.where(peak_first, peak_idx, trough_idx)
+    threshold = waveforms[rows, ref_idx] * 0.5
+
+    above = waveforms > threshold[:, np.newaxis]
+    below = waveforms < threshold[:, np.newaxis]
+    before_ref = np.arange(waveforms.shape[1]) < ref_idx[:, np.newaxis]
+
+    # first threshold crossing before and after the peak (or trough)
+    crossing_1 = np.where(peak_first[:, np.newaxis], above, below) * before_ref
+    crossing_2 = np.where(peak_first[:, np.newaxis], below, above) * np.invert(before_ref)
+
+    has_crossings = np.any(crossing_1, 1) * np.any(crossing_2, 1)
+
+    halfwidth = timestamps[np.argmax(crossing_2, 1)] - timestamps[np.argmax(crossing_1, 1)]
+    halfwidth[np.invert(has_crossings)] = np.nan
+
+    return halfwidth * 1e3
+
+
+def calculate_waveform_PT_ratios(waveforms):
+
+    """ Batched calculate_waveform_PT_ratio (waveforms : units x samples) """
+
+    return np.abs(np.max(waveforms, 1) / np.min(waveforms, 1))
+
+
+def calculate_waveform_repolarization_slopes(waveforms, timestamps, window=20):
+
+    """ Batched calculate_waveform_repolarization_slope (waveforms : units x samples) """
+
+    rows = np.arange(waveforms.shape[0])
+    max_point = np.argmax(np.abs(waveforms), 1)
+
+    waveforms = - waveforms * np.sign(waveforms[rows, max_point])[:, np.newaxis]
+
+    return window_slopes(waveforms, timestamps, max_point, window) * 1e-6
+
+
+def calculate_waveform_recovery_slopes(waveforms, timestamps, window=20):
+
+    """ Batched calculate_waveform_recovery_slope (waveforms : units x samples) """
+
+    rows = np.arange(waveforms.shape[0])
+    max_point = np.argmax(np.abs(waveforms), 1)
+
+    waveforms = - waveforms * np.sign(waveforms[rows, max_point])[:, np.newaxis]
+
+    before_max = np.arange(waveforms.shape[1]) < max_point[:, np.newaxis]
+    peak_idx = np.argmax(np.where(before_max, -np.inf, waveforms), 1)
+
+    return window_slopes(waveforms, timestamps, peak_idx, window) * 1e-6
+
+
+def window_slopes(waveforms, timestamps, start_idx, window):
+
+    """ Least-squares slope of each waveform over [start_idx, start_idx + window) """
+
+    inds = start_idx[:, np.newaxis] + np.arange(window)
+    in_range = inds < waveforms.shape[1]
+    inds = np.minimum(inds, waveforms.shape[1] - 1)
+
+    x = np.where(in_range, timestamps[inds], 0)
+    y = np.where(in_range, np.take_along_axis(waveforms, inds, 1), 0)
+    n = np.sum(in_range, 1)
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        x_mean = np.sum(x, 1) / n
+        y_mean = np.sum(y, 1) / n
+        dx = np.where(in_range, x - x_mean[:, np.newaxis], 0)
+        dy = np.where(in_range, y - y_mean[:, np.newaxis], 0)
+        slopes = np.sum(dx * dy, 1) / np.sum(dx * dx, 1)
+
+    # linregress needs at least two points
+    slopes[n < 2] = np.nan
+
+    return slopes
+
+
+# ==========================================================
+
 # EXTRACTING 1D FEATURES
 
 # ==========================================================
@@ -210,6 +448,28 @@ def calculate_snr(W):
     return snr
 
 
+def calculate_snr_from_stats(W_bar, W_var):
+    
+    """
+    Calculate SNR of spike waveforms from their mean and variance, without
+    the individual waveforms. Equivalent to calculate_snr.
+
+    Input:
+    -------
+    W_bar : mean waveform (samples)
+    W_var : variance of the waveforms at each sample (samples)
+
+    Output:
+    snr : signal-to-noise ratio for unit (scalar)
+
+    """
+
+    A = np.max(W_bar) - np.min(W_bar)
+    snr = A/(2*np.sqrt(np.mean(W_var)))
+
+    return snr
+
+
 def calculate_waveform_duration(waveform, timestamps):
     
     """ 
@@ -368,7 +628,7 @@ def calculate_waveform_recovery_slope(waveform, timestamps, window=20):
 # ==========================================================
 
 
-def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, spread_threshold = 0.12, site_range=16):
+def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, spread_threshold = 0.12, site_range=16, neighborhood=None):
     
     """ 
     Compute features of 2D waveform (channels x samples)
@@ -381,6 +641,9 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
     spread_threshold : float
     site_range: int
     site_x, site_y : float
+    neighborhood : tuple (optional)
+        Output of get_site_neighborhood for this peak channel and geometry;
+        computed here if not given
 
     Outputs:
     --------
@@ -393,53 +656,27 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
 
     assert site_range % 2 == 0 # must be even
     
-    # sample sites that are in the same "column" as the peak channel
-    # first find nn with y ~= y_peak
-    # x = x_peak or x_nn. For NP 1.0, this will select either the 
-    # two left or two right hand columns.
-    
-    dist = np.sqrt(( pow((site_x - site_x[peak_channel]),2) + pow((site_y - site_y[peak_channel]),2)))
-    ydiff = ( site_y != site_y[peak_channel])
-    n_channel = site_x.size
-    min_dist = 1e6   # a value larger than the  distance to nn
-    x_nn = -1
-    amp_nn = 0
-    x_peak = site_x[peak_channel]
-    
-    for i in range(n_channel):
-        if ydiff[i] and dist[i] <= min_dist:  #only consider nn at diff y
-            min_dist = dist[i]
-            # to break ties between columns at the same distance, pick nn with
-            # largest amplitude
-            currAmp = np.max(waveform[i,:]) - np.min(waveform[i,:])
-            if currAmp > amp_nn:
-                x_nn = site_x[i]
-            
-    # select among sites with x = x_peak and x_nn for sites to sample
-    inCol = (site_x == x_peak) | (site_x == x_nn)   
-    sort_dist_ind = np.argsort(dist)
-    sites_to_sample = np.zeros(site_range+1, dtype='int32')
-    
-    nfound = 0
-    i = 0
-    # walk over all sites in order of distance from the peak_channel, add to
-    # list of channels to sample
-    while nfound < site_range and i < n_channel:
-        curr_chan = sort_dist_ind[i]
-        if inCol[curr_chan]:
-            sites_to_sample[nfound] = curr_chan
-            nfound = nfound + 1           
-            # print('site, dist: ' + repr(curr_chan) + ',' + repr(dist[curr_chan]))
-        i = i+1
-            
-    
+    if neighborhood is None:
+        neighborhood = get_site_neighborhood(site_x, site_y, peak_channel, site_range)
+
+    nn_candidates, sampled_sites = neighborhood
+
+    # nearest neighbor column: the last candidate with a non-flat waveform
+    amp_nn = np.max(waveform[nn_candidates,:], 1) - np.min(waveform[nn_candidates,:], 1)
+    with_amp = nn_candidates[amp_nn > 0]
+
+    if with_amp.size > 0:
+        x_nn = site_x[with_amp[-1]]
+    else:
+        x_nn = -1
+
+    sites_to_sample, yDist = sampled_sites[x_nn]
+
     # original implentation for NP 1.0, assuming all sites in one bank, pick 
     # even or odd sites 
     # sites_to_sample = np.arange(-site_range, site_range+1, 2) + peak_channel
     # sites_to_sample = sites_to_sample[(sites_to_sample > 0) * (sites_to_sample < waveform.shape[0])]
 
-    # take only as many sites as we "found"
-    sites_to_sample = sites_to_sample[0:nfound]
     wv = waveform[sites_to_sample, :]
 
     #smoothed_waveform = np.zeros((wv.shape[0]-1,wv.shape[1]))
@@ -463,7 +700,6 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
     if len(points_above_thresh) > 1:
         points_above_thresh = points_above_thresh[isnot_outlier(points_above_thresh)]
         
-    yDist = site_y[sites_to_sample] - site_y[peak_channel]
     yDist = yDist[points_above_thresh]
     
     # debug print to understand what sites are selected
@@ -495,6 +731,84 @@ def calculate_2D_features(waveform, timestamps, peak_channel, site_x, site_y, sp
 # ==========================================================
 
 
+def get_site_neighborhood(site_x, site_y, peak_channel, site_range=16):
+
+    """
+    Find the sites sampled by calculate_2D_features for one peak channel
+
+    The sites are in the "column" of the peak channel and of its nearest 
+    neighbor at a different y. Which neighbor column is used depends on the
+    waveform only through which candidate sites are flat, so this returns 
+    the candidates and the sampled sites for each candidate column.
+
+    Inputs:
+    -------
+    site_x, site_y : numpy.ndarray
+        Channel positions in um
+    peak_channel : int
+    site_range : int
+        Number of sites to sample
+
+    Outputs:
+    --------
+    nn_candidates : numpy.ndarray
+        Sites at a different y that are the closest so far, in channel order
+    sampled_sites : dict
+        Maps the x position of the neighbor column (-1 for none) to the 
+        sampled sites (in order of distance from the peak channel) and 
+        their y distance from the peak channel
+
+    """
+
+    dist = np.sqrt(( pow((site_x - site_x[peak_channel]),2) + pow((site_y - site_y[peak_channel]),2)))
+    ydiff = np.flatnonzero(site_y != site_y[peak_channel])
+
+    # running minimum of the distance, starting from a value larger than the 
+    # distance to nn
+    min_dist = np.minimum.accumulate(np.concatenate(([1e6], dist[ydiff])))[:-1]
+    nn_candidates = ydiff[dist[ydiff] <= min_dist]
+
+    # walk over all sites in order of distance from the peak_channel
+    sort_dist_ind = np.argsort(dist)
+    sampled_sites = { }
+
+    for x_nn in np.append(site_x[nn_candidates], -1):
+        inCol = (site_x == site_x[peak_channel]) | (site_x == x_nn)
+        sites_to_sample = sort_dist_ind[inCol[sort_dist_ind]][:site_range]
+        sampled_sites[x_nn] = (sites_to_sample, site_y[sites_to_sample] - site_y[peak_channel])
+
+    return nn_candidates, sampled_sites
+
+
+def calculate_site_neighborhoods(site_x, site_y, site_range=16, peak_channels=None):
+
+    """
+    Table of get_site_neighborhood for many peak channels on one probe
+
+    Inputs:
+    -------
+    site_x, site_y : numpy.ndarray
+        Channel positions in um
+    site_range : int
+        Number of sites to sample
+    peak_channels : array-like (optional)
+        Channels to include; defaults to all channels
+
+    Outputs:
+    --------
+    neighborhoods : dict
+        Maps each peak channel to its neighborhood, to pass to 
+        calculate_2D_features
+
+    """
+
+    if peak_channels is None:
+        peak_channels = np.arange(site_x.size)
+
+    return {peak_channel : get_site_neighborhood(site_x, site_y, peak_channel, site_range)
+            for peak_channel in np.unique(peak_channels)}
+
+
 def get_velocity(yDist, times):
     
     """
@@ -516,20 +830,21 @@ def get_velocity(yDist, times):
 
     """
     
-    above_soma = yDist >= 0
-    below_soma = yDist <= 0
+    # least-squares slopes above (row 0) and below (row 1) the soma
+    masks = np.stack((yDist >= 0, yDist <= 0))
+    n = np.sum(masks, 1)
 
-    if np.sum(above_soma) > 1:
-        slope_above, intercept, r_value, p_value, std_err = linregress(yDist[above_soma], times[above_soma])
-        velocity_above = slope_above * 1e6     #convert slope to s / m
-    else:
-        velocity_above = np.nan
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        x_mean = np.sum(np.where(masks, yDist, 0), 1) / n
+        y_mean = np.sum(np.where(masks, times, 0), 1) / n
+        dx = np.where(masks, yDist - x_mean[:, np.newaxis], 0)
+        dy = np.where(masks, times - y_mean[:, np.newaxis], 0)
+        slopes = np.sum(dx * dy, 1) / np.sum(dx * dx, 1) * 1e6     #convert slope to s / m
 
-    if np.sum(below_soma) > 1:
-        slope_below, intercept, r_value, p_value, std_err = linregress(yDist[below_soma], times[below_soma])
-        velocity_below = slope_below * 1e6     #convert slope to s / m
-    else:
-        velocity_below = np.nan
+    # at least two points are needed
+    slopes[n < 2] = np.nan
+
+    velocity_above, velocity_below = slopes
 
     return velocity_above, velocity_below
 
@@ -16,6 +16,9 @@ def classify_noise_templates(args):
     
     start = time.time()
 
+    if args['noise_waveform_params'].get('multiprocessing_worker_count') is not None:
+        print('Warning: multiprocessing_worker_count is deprecated and ignored by the noise templates module')
+
     spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
     channel_pos, cluster_ids, cluster_quality, cluster_amplitude = \
             load_kilosort_data(args['directories']['kilosort_output_directory'], \
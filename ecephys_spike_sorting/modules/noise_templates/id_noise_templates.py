@@ -1,15 +1,14 @@
+from functools import lru_cache
+
 import numpy as np
 
 from scipy.signal import correlate, find_peaks, cwt, ricker
 from sklearn.ensemble import RandomForestClassifier
 
-from scipy.interpolate import griddata
+from scipy.sparse import csr_matrix
 from scipy.ndimage.filters import gaussian_filter1d
 
-from ...common.utils import printProgressBar
-
-import multiprocessing
-from functools import partial
+from ...common.utils import printProgressBar, cubic_interpolation_operator
 
 import pickle
 
@@ -155,6 +154,10 @@ def check_template_spatial_peaks(templates, channel_map, params):
     """
     Checks templates for multiple spatial peaks
 
+    The peak sample of every template is interpolated with one sparse matrix
+    product, and the peaks along each column of the interpolated sites are
+    found for all templates in turn.
+
     Inputs:
     -------
     templates : template for each unit output by Kilosort
@@ -168,41 +171,43 @@ def check_template_spatial_peaks(templates, channel_map, params):
     ----------
     """
 
-    is_noise = []
+    total_units = templates.shape[0]
 
-    pool = multiprocessing.Pool(np.min([params['multiprocessing_worker_count'],multiprocessing.cpu_count()]))
-    is_noise = pool.map(partial(template_spatial_peaks, templates, channel_map, params), 
-                        np.arange(templates.shape[0]))
+    peak_channels = np.argmax(np.max(templates,1) - np.min(templates,1), 1)
+    peak_indices = np.argmax(np.max(templates,2) - np.min(templates,2), 1)
 
-    return np.array(is_noise)
+    # interpolated peak sample of each template (units x height x width)
+    x_i, y_i, operator = make_interpolation_operator(channel_map)
+    peak_samples = templates[np.arange(total_units), peak_indices, :]
+    interp_peaks = np.reshape((operator @ peak_samples.T).T, (total_units, len(y_i), len(x_i)))
 
+    peak_waveforms = interp_peaks[:,:,1:6]
+    abs_peak = np.max(np.abs(peak_waveforms), 1)
 
-def template_spatial_peaks(templates, channel_map, params, index):
+    pw = np.reshape(peak_waveforms, (total_units, -1))
+    si = np.sign(pw[np.arange(total_units), np.argmax(np.abs(pw), 1)])
 
-    template = templates[index,:,:]
-        
-    peak_channel = np.argmax((np.max(template,0) - np.min(template,0)))
-    peak_index = np.argmax((np.max(template,1) - np.min(template,1)))
+    # columns with a large enough amplitude
+    use_column = abs_peak >= np.max(abs_peak, 1, keepdims=True) * params['channel_amplitude_thresh']
 
-    temp = interpolate_template(template, channel_map)
-    
-    peak_waveform = temp[peak_index,:,1:6]
-    pw = peak_waveform.flatten()
-    si = np.sign(pw[np.argmax(np.abs(pw))])
+    min_loc = channel_map[peak_channels] - params['peak_channel_range']
+    max_loc = channel_map[peak_channels] + params['peak_channel_range']
 
-    peak_locs = []
-    
-    for x in range(peak_waveform.shape[1]):
-        D = peak_waveform[:,x]
-        if np.max(np.abs(D)) >= np.max(np.abs(peak_waveform)) * params['channel_amplitude_thresh']:
-            D = D * si
-            D = D / np.max(np.abs(D))
+    is_noise = np.zeros((total_units,), dtype='bool')
+
+    for index in range(total_units):
+
+        peak_locs = []
+
+        for x in np.flatnonzero(use_column[index]):
+            D = peak_waveforms[index,:,x] * si[index]
+            D = D / abs_peak[index,x]
             p, _ = find_peaks(D, height = params['peak_height_thresh'], prominence = params['peak_prominence_thresh'])
-            peaks_in_range = p[(p > (channel_map[peak_channel] - params['peak_channel_range'])) * \
-                (p < (channel_map[peak_channel] + params['peak_channel_range']))]
-            peak_locs.extend(list(peaks_in_range))
+            peak_locs.extend(list(p[(p > min_loc[index]) * (p < max_loc[index])]))
+
+        is_noise[index] = np.std(peak_locs) > params['peak_locs_std_thresh']
 
-    return (np.std(peak_locs) > params['peak_locs_std_thresh'])
+    return is_noise
 
 
 def check_template_temporal_peaks(templates, channel_map, params):
@@ -300,13 +305,11 @@ def actual_channel_locations(channel_map):
     
     """
 
-    max_chan = np.max(channel_map)+1
-    actual_channel_locations = np.zeros((max_chan,2))
-    xlocations = [16, 48, 0, 32]
+    xlocations = np.array([16, 48, 0, 32])
     
-    for i in range(0, max_chan):
-        actual_channel_locations[i,0] = xlocations[i%4]
-        actual_channel_locations[i,1] = np.floor(i/2)*20
+    channels = np.arange(0, np.max(channel_map)+1)
+    actual_channel_locations = np.stack((xlocations[channels%4], 
+                                         np.floor(channels/2)*20), 1).astype('float')
 
     return actual_channel_locations[channel_map,:]
 
@@ -326,44 +329,76 @@ def interp_channel_locations(channel_map):
     
     """
 
-    max_chan = (np.max(channel_map)+1)*7
-    interp_channel_locations = np.zeros((max_chan,2))
-    xlocations = [0, 8, 16, 24, 32, 40, 48]
+    xlocations = np.array([0, 8, 16, 24, 32, 40, 48])
 
-    for i in range(0, max_chan):
-        interp_channel_locations[i,0] = xlocations[i%7]
-        interp_channel_locations[i,1] = np.floor(i/7)*10
+    channels = np.arange(0, (np.max(channel_map)+1)*7)
+    interp_channel_locations = np.stack((xlocations[channels%7], 
+                                         np.floor(channels/7)*10), 1).astype('float')
 
     return interp_channel_locations
 
-def interpolate_template(template, channel_map):
+def make_interpolation_operator(channel_map, min_weight = 1e-9):
 
     """
-    Interpolate template, based on physical channel locations
+    Sparse linear operator for the cubic interpolation in interpolate_template
+    (see cubic_interpolation_operator). Only depends on the channel map, so it
+    is cached for each channel map and reused for all templates.
 
     Inputs:
     -------
-    template : template for one unit (samples x channels)
     channel_map : mapping between template channels and actual probe channels
+    min_weight : float
+        Weights with a smaller absolute value are dropped
 
     Outputs:
     --------
-    template_interp : 3D interpolated template (samples x height x width)
-    
+    x_i : unique x locations of the virtual channels (width)
+    y_i : unique y locations of the virtual channels (height)
+    operator : scipy.sparse.csr_matrix (virtual channels x channels)
+
     """
 
-    total_samples = template.shape[0]
+    return _make_interpolation_operator(tuple(np.asarray(channel_map).flatten().tolist()), min_weight)
+
+@lru_cache(maxsize=None)
+def _make_interpolation_operator(channel_map, min_weight):
+
+    channel_map = np.array(channel_map, dtype='int')
+
     loc_a = actual_channel_locations(channel_map)
     loc_i = interp_channel_locations(channel_map)
-    
+
     x_i = np.unique(loc_i[:,0])
     y_i = np.unique(loc_i[:,1])
+
+    weights = cubic_interpolation_operator(loc_a, loc_i)
+    weights[np.abs(weights) < min_weight] = 0
+
+    return x_i, y_i, csr_matrix(weights)
+
+def interpolate_template(template, channel_map, interpolation = None):
+
+    """
+    Interpolate template, based on physical channel locations
+
+    Inputs:
+    -------
+    template : template for one unit (samples x channels)
+    channel_map : mapping between template channels and actual probe channels
+    interpolation : (x_i, y_i, operator) from make_interpolation_operator 
+        for channel_map (optional)
+
+    Outputs:
+    --------
+    template_interp : 3D interpolated template (samples x height x width)
     
-    interp_temp = np.zeros((total_samples, len(x_i) * len(y_i)))
-    
-    for t in range(0,total_samples):
+    """
+
+    if interpolation is None:
+        interpolation = make_interpolation_operator(channel_map)
 
-        interp_temp[t,:,] = griddata(loc_a, template[t,:], loc_i, method='cubic', fill_value=0, rescale=False)  
+    x_i, y_i, operator = interpolation
 
-    return np.reshape(interp_temp, (total_samples, len(y_i), len(x_i))).astype('float')       
+    interp_temp = (operator @ template.T).T
 
+    return np.reshape(interp_temp, (template.shape[0], len(y_i), len(x_i))).astype('float')
@@ -8,11 +8,12 @@ import pathlib
 import numpy as np
 import pandas as pd
 
-from ...common.utils import load_kilosort_data
+from ...common.utils import KilosortDataset
 from ...common.utils import getFileVersion
 from ...common.epoch import get_epochs_from_nwb_file
 
 from .metrics import calculate_metrics
+from .metrics_cache import MetricsCache, get_data_key
 
 
 def calculate_quality_metrics(args):
@@ -34,25 +35,40 @@ def calculate_quality_metrics(args):
     print("Loading data...")
 
 
+    dataset = KilosortDataset(args['directories']['kilosort_output_directory'],
+                              args['ephys_params']['sample_rate'],
+                              use_master_clock = False)
+
     try:
+        spike_times = dataset.spike_times
+        spike_clusters = dataset.spike_clusters
+        spike_templates = dataset.spike_templates
+        amplitudes = dataset.amplitudes
+        templates = dataset.templates
+        channel_map = dataset.channel_map
+        channel_pos = dataset.channel_pos
+
         if include_pcs:
-            spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-            channel_pos, clusterIDs, cluster_quality, cluster_amplitude, pc_features, pc_feature_ind, template_features = \
-                    load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        use_master_clock = False,
-                        include_pcs = include_pcs)
+            pc_features = dataset.pc_features
+            pc_feature_ind = dataset.pc_feature_ind
         else:
-            spike_times, spike_clusters, spike_templates, amplitudes, templates, channel_map, \
-            channel_pos, clusterIDs, cluster_quality, cluster_amplitude = \
-            load_kilosort_data(args['directories']['kilosort_output_directory'], \
-                        args['ephys_params']['sample_rate'], \
-                        use_master_clock = False,
-                        include_pcs = include_pcs)
             pc_features = []
             pc_feature_ind = []
+
+        if args['quality_metrics_params']['use_metrics_cache']:
+            # settings that do not change the metric values are left out of the key
+            metric_params = {k : v for k, v in args['quality_metrics_params'].items() 
+                             if k not in ('multiprocessing_worker_count', 'spike_depth_chunk_size', 'use_metrics_cache')}
+            cache = MetricsCache(os.path.join(args['directories']['kilosort_output_directory'], 'quality_metrics_cache.csv'),
+                                 get_data_key(metric_params, spike_times, spike_templates, amplitudes,
+                                              pc_feature_ind, channel_pos))
+        else:
+            cache = None
                     
-        metrics = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, args['quality_metrics_params'])
+        metrics = calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, args['quality_metrics_params'], cache = cache)
+
+        if cache is not None:
+            cache.save()
 
     except FileNotFoundError:
         
@@ -16,7 +16,10 @@ class QualityMetricsParams(DefaultSchema):
 
     drift_metrics_min_spikes_per_interval = Int(required=False, default=10, help='Minimum number of spikes for computing depth')
     drift_metrics_interval_s = Float(required=False, default=100, help='Interval length is seconds for computing spike depth')
+    spike_depth_chunk_size = Int(required=False, default=100000, help='Number of spikes read from pc_features at a time when computing spike depths; bounds memory use of drift metrics')
     include_pcs = Boolean(required=False, default=True, help='Set to false if features were not saved with Phy output')
+    multiprocessing_worker_count = Int(required=False, default=1, help='Number of worker processes for PC-based metrics; 1 computes them serially')
+    use_metrics_cache = Boolean(required=False, default=False, help='Reuse metrics stored in the Kilosort output directory for clusters that did not change since the last run')
 
 class InputParameters(ArgSchema):
     
@@ -4,10 +4,14 @@ import psutil
 from collections import OrderedDict
 
 import warnings
+import mmap
+import multiprocessing
+from multiprocessing import shared_memory
+from functools import partial
 
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
 from sklearn.neighbors import NearestNeighbors
-from sklearn.metrics import silhouette_score
+from sklearn.metrics import pairwise_distances_chunked
 
 from scipy.spatial.distance import cdist
 from scipy.stats import chi2
@@ -15,10 +19,15 @@ from scipy.ndimage.filters import gaussian_filter1d
 from scipy import special
 
 from ...common.epoch import Epoch
-from ...common.utils import printProgressBar, get_spike_depths
+from ...common.utils import printProgressBar, get_spike_depths, get_cluster_spike_index, get_sparse_pc_features
 
+from .metrics_cache import (CLUSTER_METRICS, 
+                            PC_METRICS, 
+                            get_cluster_fingerprints, 
+                            get_neighborhood_fingerprints)
 
-def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None):
+
+def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, templates, pc_features, pc_feature_ind, params, epochs = None, cache = None):
 
     """ Calculate metrics for all units on one probe
 
@@ -47,6 +56,9 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
         'tbin_sec' : time bin for ccg for contam_rate
     epochs : list of Epoch objects
         contains information on Epoch start and stop times
+    cache : MetricsCache (optional)
+        metrics from a previous run; only clusters whose spikes (or, for PC 
+        metrics, whose neighbors' spikes) changed are recomputed
 
     
     Outputs:
@@ -87,68 +99,112 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
 
         in_epoch = (spike_times > epoch.start_time) * (spike_times < epoch.end_time)
 
+        curr_spike_times = spike_times[in_epoch]
+        curr_spike_clusters = spike_clusters[in_epoch]
+        curr_cluster_ids = np.unique(curr_spike_clusters)
+
+        # sort spikes by cluster once per epoch; each metric then reads the
+        # spikes of a unit as a contiguous slice of this index
+        cluster_index = get_cluster_spike_index(curr_spike_clusters, total_units)
+
+        # with a cache, only compute metrics for clusters whose spikes changed
+        if cache is not None:
+            fingerprints = get_cluster_fingerprints(cluster_index, curr_cluster_ids)
+            cached = cache.lookup(epoch.name)
+            is_cached = np.array([fingerprints[cid] in cached.index for cid in curr_cluster_ids], dtype='bool')
+            units_to_compute = curr_cluster_ids[np.invert(is_cached)]
+            print("Reusing cached metrics for " + repr(np.sum(is_cached)) + " of " + repr(curr_cluster_ids.size) + " units")
+        else:
+            units_to_compute = None
+
         print("Calculating isi violations")
-        isi_viol, num_viol = calculate_isi_violations(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['isi_threshold'], params['min_isi'])
+        isi_viol, num_viol = calculate_isi_violations(curr_spike_times, curr_spike_clusters, total_units, params['isi_threshold'], params['min_isi'], cluster_index, units_to_compute)
         
         print("Calculating contamination rate")
-        contam_rate = calculate_contam_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units, params['tbin_sec'], params['isi_threshold'])
+        contam_rate = calculate_contam_rate(curr_spike_times, curr_spike_clusters, total_units, params['tbin_sec'], params['isi_threshold'], cluster_index, units_to_compute)
 
         print("Calculating presence ratio")
-        presence_ratio = calculate_presence_ratio(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
+        presence_ratio = calculate_presence_ratio(curr_spike_times, curr_spike_clusters, total_units, cluster_index, units_to_compute)
 
         print("Calculating firing rate")
-        firing_rate = calculate_firing_rate(spike_times[in_epoch], spike_clusters[in_epoch], total_units)
+        firing_rate = calculate_firing_rate(curr_spike_times, curr_spike_clusters, total_units, cluster_index, units_to_compute)
         
         print("Calculating amplitude cutoff")
-        amplitude_cutoff = calculate_amplitude_cutoff(spike_clusters[in_epoch], amplitudes[in_epoch], total_units)
+        amplitude_cutoff = calculate_amplitude_cutoff(curr_spike_clusters, amplitudes[in_epoch], total_units, cluster_index, units_to_compute)
         
+        pc_fingerprints = {}
+
         if include_pcs:
             
             # determine template this is the best match for each cluster id
             # initialize template ids
             template_ids = template_ids + total_units + 10  # unassinged template_ids out of range
-            curr_spike_clusters = spike_clusters[in_epoch]
             curr_spike_templates = spike_templates[in_epoch]
-            curr_cluster_ids = np.unique(curr_spike_clusters)
+            curr_pc_features = epoch_rows(pc_features, in_epoch)
+            spike_order, cluster_offsets = cluster_index
             for cid in curr_cluster_ids:
-                cluster_templates = curr_spike_templates[np.where(curr_spike_clusters==cid)]
+                cluster_templates = curr_spike_templates[spike_order[cluster_offsets[cid]:cluster_offsets[cid+1]]]
                 template_ids[cid] = np.argmax(np.bincount(cluster_templates)) 
 
+            neighborhoods = calculate_pc_neighborhoods(total_units,
+                                                       curr_cluster_ids,
+                                                       template_ids,
+                                                       curr_pc_features,
+                                                       pc_feature_ind,
+                                                       channel_pos,
+                                                       params['max_radius_um'],
+                                                       cluster_index)
+
+            # PC metrics also need to be recomputed if any neighbor changed
+            if cache is not None:
+                pc_fingerprints = get_neighborhood_fingerprints(fingerprints, neighborhoods)
+                pc_is_cached = np.array([is_cached[idx] and cached.loc[fingerprints[cid], 'pc_fingerprint'] == pc_fingerprints[cid]
+                                         for idx, cid in enumerate(curr_cluster_ids)], dtype='bool')
+                pc_units_to_compute = curr_cluster_ids[np.invert(pc_is_cached)]
+            else:
+                pc_units_to_compute = None
+
             print("Calculating PC-based metrics")
-            isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate = calculate_pc_metrics(spike_clusters[in_epoch],
-                                                                                                spike_templates[in_epoch],
+            isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate = calculate_pc_metrics(curr_spike_clusters,
+                                                                                                curr_spike_templates,
                                                                                                 total_units,
                                                                                                 curr_cluster_ids,
                                                                                                 template_ids,
-                                                                                                pc_features[in_epoch,:,:],
+                                                                                                curr_pc_features,
                                                                                                 pc_feature_ind,
                                                                                                 channel_pos,
                                                                                                 params['max_radius_um'],
                                                                                                 params['max_spikes_for_unit'],
                                                                                                 params['max_spikes_for_nn'],
-                                                                                                params['n_neighbors'])
+                                                                                                params['n_neighbors'],
+                                                                                                cluster_index,
+                                                                                                params['multiprocessing_worker_count'],
+                                                                                                neighborhoods,
+                                                                                                pc_units_to_compute)
   
             print("Calculating silhouette score")
-            nSpikes = spike_times[in_epoch].size
-            the_silhouette_score = calculate_silhouette_score(spike_clusters[in_epoch], 
-                                                       spike_templates[in_epoch],
+            nSpikes = curr_spike_times.size
+            the_silhouette_score = calculate_silhouette_score(curr_spike_clusters, 
+                                                       curr_spike_templates,
                                                        total_units,                                                      
-                                                       pc_features[in_epoch,:,:],
+                                                       curr_pc_features,
                                                        pc_feature_ind,
                                                        min(nSpikes, params['n_silhouette']))
 
 
             print("Calculating drift metrics")
-            max_drift, cumulative_drift = calculate_drift_metrics(spike_times[in_epoch],
-                                                       spike_clusters[in_epoch], 
-                                                       spike_templates,
+            max_drift, cumulative_drift = calculate_drift_metrics(curr_spike_times,
+                                                       curr_spike_clusters, 
+                                                       curr_spike_templates,
                                                        template_ids,
                                                        total_units,
-                                                       pc_features[in_epoch,:,:],
+                                                       curr_pc_features,
                                                        pc_feature_ind,
                                                        channel_pos,
                                                        params['drift_metrics_interval_s'],
-                                                       params['drift_metrics_min_spikes_per_interval'])
+                                                       params['drift_metrics_min_spikes_per_interval'],
+                                                       params['spike_depth_chunk_size'],
+                                                       units_to_compute)
         else:
             # fill in empty arrays for dataframe            
             isolation_distance = np.zeros((total_units,))
@@ -165,7 +221,7 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
 
         epoch_name = [epoch.name] * len(cluster_ids)
 
-        metrics = pd.concat((metrics, pd.DataFrame(data= OrderedDict((('cluster_id', cluster_ids),
+        epoch_metrics = pd.DataFrame(data= OrderedDict((('cluster_id', cluster_ids),
                                 ('firing_rate' , firing_rate),
                                 ('presence_ratio' , presence_ratio),
                                 ('isi_viol' , isi_viol),
@@ -181,59 +237,109 @@ def calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes,
                                 ('max_drift', max_drift),
                                 ('cumulative_drift', cumulative_drift),
                                 ('epoch_name' , epoch_name),
-                                )))))
+                                )))
+
+        if cache is not None:
+
+            # fill in the metrics of unchanged clusters from the cache
+            reused = curr_cluster_ids[is_cached]
+            reused_fingerprints = [fingerprints[cid] for cid in reused]
+            epoch_metrics.loc[reused, CLUSTER_METRICS] = cached.loc[reused_fingerprints, CLUSTER_METRICS].values
+
+            if include_pcs:
+                reused = curr_cluster_ids[pc_is_cached]
+                reused_fingerprints = [fingerprints[cid] for cid in reused]
+                epoch_metrics.loc[reused, PC_METRICS] = cached.loc[reused_fingerprints, PC_METRICS].values
+
+            cache.store(epoch.name, curr_cluster_ids, fingerprints, pc_fingerprints, epoch_metrics)
+
+        metrics = pd.concat((metrics, epoch_metrics))
 
     return metrics 
 
+def epoch_rows(data, in_epoch):
+
+    # spike times are sorted, so the spikes in an epoch are usually a contiguous
+    # block; return a view of that block rather than copying (possibly 
+    # memory-mapped) per-spike arrays such as pc_features
+
+    inds = np.flatnonzero(in_epoch)
+
+    if inds.size > 0 and inds[-1] - inds[0] + 1 == inds.size:
+        return data[inds[0]:inds[-1]+1]
+    else:
+        return data[inds]
+
 # ===============================================================
 
 # HELPER FUNCTIONS TO LOOP THROUGH CLUSTERS:
 
 # ===============================================================
 
-def calculate_isi_violations(spike_times, spike_clusters, total_units, isi_threshold, min_isi):
+def calculate_isi_violations(spike_times, spike_clusters, total_units, isi_threshold, min_isi, cluster_index = None, cluster_ids = None):
+
+    if cluster_index is None:
+        cluster_index = get_cluster_spike_index(spike_clusters, total_units)
+    spike_order, cluster_offsets = cluster_index
 
-    cluster_ids = np.unique(spike_clusters)
+    if cluster_ids is None:
+        cluster_ids = np.unique(spike_clusters)
 
     viol_rates = np.zeros((total_units,))
     
     num_viol =np.zeros((total_units,))
 
+    min_time = np.min(spike_times)
+    max_time = np.max(spike_times)
+
     for idx, cluster_id in enumerate(cluster_ids):
 
         printProgressBar(idx+1, len(cluster_ids))
 
-        for_this_cluster = (spike_clusters == cluster_id)
+        for_this_cluster = spike_order[cluster_offsets[cluster_id]:cluster_offsets[cluster_id+1]]
         viol_rates[cluster_id], num_viol[cluster_id] = isi_violations(spike_times[for_this_cluster], 
-                                                               min_time = np.min(spike_times), 
-                                                               max_time = np.max(spike_times), 
+                                                               min_time = min_time, 
+                                                               max_time = max_time, 
                                                                isi_threshold=isi_threshold, 
                                                                min_isi = min_isi)
 
     return viol_rates, num_viol
 
-def calculate_presence_ratio(spike_times, spike_clusters, total_units):
+def calculate_presence_ratio(spike_times, spike_clusters, total_units, cluster_index = None, cluster_ids = None):
 
-    cluster_ids = np.unique(spike_clusters)
+    if cluster_index is None:
+        cluster_index = get_cluster_spike_index(spike_clusters, total_units)
+    spike_order, cluster_offsets = cluster_index
+
+    if cluster_ids is None:
+        cluster_ids = np.unique(spike_clusters)
 
     ratios = np.zeros((total_units,))
 
+    min_time = np.min(spike_times)
+    max_time = np.max(spike_times)
+
     for idx, cluster_id in enumerate(cluster_ids):
 
         printProgressBar(idx + 1, len(cluster_ids))
 
-        for_this_cluster = (spike_clusters == cluster_id)
+        for_this_cluster = spike_order[cluster_offsets[cluster_id]:cluster_offsets[cluster_id+1]]
         ratios[cluster_id] = presence_ratio(spike_times[for_this_cluster], 
-                                                       min_time = np.min(spike_times), 
-                                                       max_time = np.max(spike_times))
+                                                       min_time = min_time, 
+                                                       max_time = max_time)
 
     return ratios
 
 
 
-def calculate_firing_rate(spike_times, spike_clusters, total_units):
+def calculate_firing_rate(spike_times, spike_clusters, total_units, cluster_index = None, cluster_ids = None):
+
+    if cluster_index is None:
+        cluster_index = get_cluster_spike_index(spike_clusters, total_units)
+    spike_order, cluster_offsets = cluster_index
 
-    cluster_ids = np.unique(spike_clusters)
+    if cluster_ids is None:
+        cluster_ids = np.unique(spike_clusters)
 
     firing_rates = np.zeros((total_units,))
 
@@ -244,17 +350,22 @@ def calculate_firing_rate(spike_times, spike_clusters, total_units):
 
         printProgressBar(idx + 1, len(cluster_ids))
 
-        for_this_cluster = (spike_clusters == cluster_id)
+        for_this_cluster = spike_order[cluster_offsets[cluster_id]:cluster_offsets[cluster_id+1]]
         firing_rates[cluster_id] = firing_rate(spike_times[for_this_cluster], 
-                                        min_time = np.min(spike_times),
-                                        max_time = np.max(spike_times))
+                                        min_time = min_time,
+                                        max_time = max_time)
 
     return firing_rates
 
 
-def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units):
+def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units, cluster_index = None, cluster_ids = None):
+
+    if cluster_index is None:
+        cluster_index = get_cluster_spike_index(spike_clusters, total_units)
+    spike_order, cluster_offsets = cluster_index
 
-    cluster_ids = np.unique(spike_clusters)
+    if cluster_ids is None:
+        cluster_ids = np.unique(spike_clusters)
 
     amplitude_cutoffs = np.zeros((total_units,))
 
@@ -263,26 +374,30 @@ def calculate_amplitude_cutoff(spike_clusters, amplitudes, total_units):
         printProgressBar(idx + 1, len(cluster_ids))
 
 
-        for_this_cluster = (spike_clusters == cluster_id)
+        for_this_cluster = spike_order[cluster_offsets[cluster_id]:cluster_offsets[cluster_id+1]]
         amplitude_cutoffs[cluster_id] = amplitude_cutoff(amplitudes[for_this_cluster])
 
     return amplitude_cutoffs
 
 
-def calculate_contam_rate(spike_times, spike_clusters, total_units, tbin_sec, refPer_sec):
+def calculate_contam_rate(spike_times, spike_clusters, total_units, tbin_sec, refPer_sec, cluster_index = None, cluster_ids = None):
 
-    cluster_ids = np.unique(spike_clusters)
+    if cluster_index is None:
+        cluster_index = get_cluster_spike_index(spike_clusters, total_units)
+    spike_order, cluster_offsets = cluster_index
 
-    contam_rate = np.ones((total_units,))
+    if cluster_ids is None:
+        cluster_ids = np.unique(spike_clusters)
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    contam_rate = np.ones((total_units,))
 
-        printProgressBar(idx + 1, len(cluster_ids))
+    # compute the auto-correlograms for all units with enough spikes in one batch
+    cluster_ids = cluster_ids[np.diff(cluster_offsets)[cluster_ids] > 10]
 
-        curr_st_sec = spike_times[spike_clusters == cluster_id]
-        
-        if len(curr_st_sec) > 10: 
-            contam_rate[cluster_id] = contamination_rate(curr_st_sec, tbin_sec, refPer_sec)           
+    if cluster_ids.size > 0:
+        spike_trains = [spike_times[spike_order[cluster_offsets[cluster_id]:cluster_offsets[cluster_id+1]]] 
+                        for cluster_id in cluster_ids]
+        contam_rate[cluster_ids] = contamination_rates(spike_trains, tbin_sec, refPer_sec)
 
     return contam_rate
 
@@ -298,38 +413,165 @@ def calculate_pc_metrics(spike_clusters,
                          max_radius_um, 
                          max_spikes_for_cluster, 
                          max_spikes_for_nn, 
-                         n_neighbors):
+                         n_neighbors,
+                         cluster_index = None,
+                         worker_count = 1,
+                         neighborhoods = None,
+                         units_to_compute = None):
 
-# OLDER calculatioon assuming linear array and using a number of channels instead of max_radius
-#    assert(num_channels_to_compare % 2 == 1)
-#    half_spread = int((num_channels_to_compare - 1) / 2)
-
-
-    peak_channels = np.zeros((total_units,), dtype='uint16')
     isolation_distances = np.zeros((total_units,))
     l_ratios = np.zeros((total_units,))
     d_primes = np.zeros((total_units,))
     nn_hit_rates = np.zeros((total_units,))
     nn_miss_rates = np.zeros((total_units,))
     
+    if cluster_index is None:
+        cluster_index = get_cluster_spike_index(spike_clusters, total_units)
+    spike_order, cluster_offsets = cluster_index
+    cluster_spike_counts = np.diff(cluster_offsets)
+
+    if neighborhoods is None:
+        neighborhoods = calculate_pc_neighborhoods(total_units,
+                                                   cluster_ids,
+                                                   template_ids,
+                                                   pc_features,
+                                                   pc_feature_ind,
+                                                   channel_pos,
+                                                   max_radius_um,
+                                                   cluster_index)
+
+    if units_to_compute is None:
+        units_to_compute = cluster_ids
+
+    # draw the spike subsamples for every unit first, in the same order as the 
+    # serial calculation, so that the random subsamples (and therefore the 
+    # metrics) do not depend on the worker count
+    unit_jobs = []
+
+    for idx, cluster_id in enumerate(units_to_compute):
+
+        units_for_channel, channels_to_use = neighborhoods[cluster_id]
+
+        # If there is at least one neighbor unit in range, compare pcs across 
+        # units for channels that overlap AND lie within maximum radius
+        
+        unit_spike_inds = []
+
+        if len(units_for_channel) > 0:
+    
+            spike_counts = cluster_spike_counts[units_for_channel].astype('int')
+                
+            this_unit_idx = np.where(units_for_channel == cluster_id)[0]
+    
+            # calculate how many spikes from this unit will be used
+            if spike_counts[this_unit_idx] > max_spikes_for_cluster:
+                relative_counts = spike_counts / spike_counts[this_unit_idx] * max_spikes_for_cluster
+            else:
+                relative_counts = spike_counts
+                
+            for idx2, cluster_id2 in enumerate(units_for_channel):
+    
+# if any manual curation as been done, the cluster ids are no longer identical to the template ids
+# That means we can't use a universal channelmask. Rather, we have to check for each spike what
+# channels are there (recorded in pc_feature_ind) and take those that are included in 
+# channels to use
+                
+                subsample = int(relative_counts[idx2]) # how many spikes to use from this unit
+                spike_inds = make_index_subset(cluster_index, cluster_id2, min_num = 0, max_num = subsample)
+
+                unit_spike_inds.append((cluster_id2, spike_inds))
+
+        unit_jobs.append((cluster_id, channels_to_use, unit_spike_inds))
+
+    if worker_count > 1 and len(unit_jobs) > 1:
+        results = _map_pc_metrics_parallel(unit_jobs, pc_features, spike_templates, pc_feature_ind, 
+                                           max_spikes_for_nn, n_neighbors, worker_count)
+    else:
+        results = map(partial(unit_pc_metrics, pc_features, spike_templates, pc_feature_ind, 
+                              max_spikes_for_nn, n_neighbors), unit_jobs)
+
+    for idx, ((cluster_id, channels_to_use, unit_spike_inds), unit_metrics) in enumerate(zip(unit_jobs, results)):
+
+        printProgressBar(idx + 1, len(unit_jobs))
+
+        if unit_metrics is not None:
+
+            isolation_distances[cluster_id], l_ratios[cluster_id], d_primes[cluster_id], \
+                nn_hit_rates[cluster_id], nn_miss_rates[cluster_id] = unit_metrics
+
+        else:
+
+            isolation_distances[cluster_id] = np.nan
+            d_primes[cluster_id] = np.nan
+            nn_hit_rates[cluster_id] = np.nan
+            nn_miss_rates[cluster_id] = np.nan
+
+
+    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
+
+
+def calculate_pc_neighborhoods(total_units,
+                               cluster_ids,
+                               template_ids,
+                               pc_features,
+                               pc_feature_ind,
+                               channel_pos,
+                               max_radius_um,
+                               cluster_index):
+
+    """ Find the units and channels to compare for the PC-based metrics of each unit
+
+    Inputs:
+    -------
+    total_units : Int
+        Number of cluster IDs
+    cluster_ids : numpy.ndarray
+        Cluster IDs with spikes
+    template_ids : numpy.ndarray (total_units x 0)
+        Majority template for each cluster ID
+    pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
+        Pre-computed PCs for blocks of channels around each spike
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+        Channel indices of PCs for each unit
+    channel_pos : numpy.ndarray (num_channels x 2)
+        Channel positions in um
+    max_radius_um : Int
+        Maximum distance of neighbor peak channels and compared channels
+    cluster_index : tuple (spike_order, cluster_offsets)
+        Output of get_cluster_spike_index
+
+    Outputs:
+    --------
+    neighborhoods : dict
+        For each cluster ID, (units_for_channel, channels_to_use): the units 
+        (including this one) whose spikes are compared, and the channels used.
+        units_for_channel is empty if there are no neighbor units in range.
+
+    """
+
+# OLDER calculatioon assuming linear array and using a number of channels instead of max_radius
+#    assert(num_channels_to_compare % 2 == 1)
+#    half_spread = int((num_channels_to_compare - 1) / 2)
+
+    spike_order, cluster_offsets = cluster_index
+
+    peak_channels = np.zeros((total_units,), dtype='uint16')
 
 # pc_feature_ind is NOT updated by phy during manual clustering
 
     for idx, cluster_id in enumerate(cluster_ids):
             
         # individual pcs are stored for each spike, independent of cluster id
-        for_unit = np.squeeze(spike_clusters == cluster_id)
+        for_unit = spike_order[cluster_offsets[cluster_id]:cluster_offsets[cluster_id+1]]
         pc_max = np.argmax(np.mean(pc_features[for_unit, 0, :],0))
         
         # pc_feature_ind are stored according to template, using the 
         # most common template for spikes in this cluster in this epoch
         peak_channels[cluster_id] = pc_feature_ind[template_ids[cluster_id], pc_max]
 
-    for idx, cluster_id in enumerate(cluster_ids):
-
-        
-        printProgressBar(idx + 1, len(cluster_ids))
+    neighborhoods = {}
 
+    for idx, cluster_id in enumerate(cluster_ids):
             
         peak_channel = peak_channels[cluster_id]
         
@@ -365,102 +607,185 @@ def calculate_pc_metrics(spike_clusters,
         # of those units that have pc overlap, which have their peak channel 
         # within range of the current unit?              
         units_in_range = np.where( chan_dist[peak_channels[units_for_channel]] < max_radius_um )[0]
-           
-            
-        # If there is at least one neighbor unit in range, compare pcs across 
-        # units for channels that overlap AND lie within maximum radius
-        
+
         if len(units_in_range) > 1 :
 
             units_for_channel = np.asarray(units_for_channel[units_in_range])
                     
-    
 # OLDER calculatioon assuming linear array
 #           channels_to_use = np.arange(peak_channel - half_spread_down, peak_channel + half_spread_up + 1)
             
             channels_to_use = np.where(chan_dist < max_radius_um)[0]
 
-    
-            spike_counts = np.zeros(units_for_channel.shape, dtype = 'int')
-    
-            for idx2, cluster_id2 in enumerate(units_for_channel):
-                spike_counts[idx2] = np.sum(spike_clusters == cluster_id2)
-                
-            this_unit_idx = np.where(units_for_channel == cluster_id)[0]
-    
-            # calculate how many spikes from this unit will be used
-            if spike_counts[this_unit_idx] > max_spikes_for_cluster:
-                relative_counts = spike_counts / spike_counts[this_unit_idx] * max_spikes_for_cluster
-            else:
-                relative_counts = spike_counts
-            
-            all_pcs = np.zeros((0, pc_features.shape[1], channels_to_use.size))     #dtype = default, double
-            all_labels = np.zeros((0,), dtype = 'int')
-                
-            for idx2, cluster_id2 in enumerate(units_for_channel):
-    
-# if any manual curation as been done, the cluster ids are no longer identical to the template ids
-# That means we can't use a universal channelmask. Rather, we have to check for each spike what
-# channels are there (recorded in pc_feature_ind) and take those that are included in 
-# channels to use
-#                try:
-#                    channel_mask = make_channel_mask(cluster_id2, pc_feature_ind, channels_to_use)
-#                except IndexError:
-#                    # Occurs when pc_feature_ind does not contain all channels of interest
-#                    # In that case, we will exclude this unit for the calculation
-#                    pass
-#                else:
-#                    subsample = int(relative_counts[idx2])
-#                    index_mask = make_index_mask(spike_clusters, cluster_id2, min_num = 0, max_num = subsample)
-#        
-#                    pcs = get_unit_pcs(pc_features, index_mask, channel_mask)
-#                    labels = np.ones((pcs.shape[0],), dtype = 'int') * cluster_id2
-#                    
-#                    all_pcs = np.concatenate((all_pcs, pcs),0)
-#                    all_labels = np.concatenate((all_labels, labels),0)
-                
-                subsample = int(relative_counts[idx2]) # how many spikes to use from this unit
-                index_mask = make_index_mask(spike_clusters, cluster_id2, min_num = 0, max_num = subsample)
-                
-                pcs = get_unit_pcs(pc_features, index_mask, spike_templates, channels_to_use, pc_feature_ind)
-                labels = np.ones((pcs.shape[0],), dtype = 'int') * cluster_id2
-
-                all_pcs = np.concatenate((all_pcs, pcs),0)
-                all_labels = np.concatenate((all_labels, labels),0) 
-                
-            all_pcs = np.reshape(all_pcs, (all_pcs.shape[0], pc_features.shape[1]*channels_to_use.size))
-            
-            num_pcs = all_pcs.shape[0];
-#            num_pcs_str = 'cluster_id: ' + repr(cluster_id) + '; num pcs: ' + repr(num_pcs)
-#            print(num_pcs_str)
-            
-            pcs_for_this_unit = all_pcs[all_labels == cluster_id,:].shape[0]   
-            pcs_for_other_units = all_pcs[all_labels != cluster_id, :].shape[0]
-        
         else:
             # no near neighbor units to compare
-            num_pcs = 0
-            pcs_for_this_unit = 0
-            pcs_for_other_units = 0
-        
+            units_for_channel = np.zeros((0,), dtype='int')
+            channels_to_use = np.zeros((0,), dtype='int')
+
+        neighborhoods[cluster_id] = (units_for_channel, channels_to_use)
+
+    return neighborhoods
+
+
+def unit_pc_metrics(pc_features, spike_templates, pc_feature_ind, max_spikes_for_nn, n_neighbors, unit_job):
+
+    """ Calculate the PC-based metrics for one unit and its neighbors
+
+    Inputs:
+    -------
+    pc_features : numpy.ndarray (num_spikes x num_pcs x num_channels)
+        Pre-computed PCs for blocks of channels around each spike
+    spike_templates : numpy.ndarray (num_spikes x 0)
+        template IDs for each spike
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+        Channel indices of PCs for each unit
+    max_spikes_for_nn : Int
+        number of spikes to use for the nearest neighbor metrics
+    n_neighbors : Int
+        number of neighbors to use
+    unit_job : tuple (cluster_id, channels_to_use, unit_spike_inds)
+        unit_spike_inds is a list of (cluster_id, spike indices) for this unit
+        and each of its neighbors, as selected in calculate_pc_metrics
+
+    Outputs:
+    --------
+    unit_metrics : tuple or None
+        (isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate),
+        or None if there are not enough spikes to compare
+
+    """
+
+    cluster_id, channels_to_use, unit_spike_inds = unit_job
+
+    if len(unit_spike_inds) == 0:
+        # no near neighbor units to compare
+        return None
+
+    all_pcs = np.zeros((0, pc_features.shape[1], channels_to_use.size))     #dtype = default, double
+    all_labels = np.zeros((0,), dtype = 'int')
+
+    for cluster_id2, spike_inds in unit_spike_inds:
+
+        pcs = get_unit_pcs(pc_features, spike_inds, spike_templates, channels_to_use, pc_feature_ind)
+        labels = np.ones((pcs.shape[0],), dtype = 'int') * cluster_id2
+
+        all_pcs = np.concatenate((all_pcs, pcs),0)
+        all_labels = np.concatenate((all_labels, labels),0) 
         
-        if num_pcs > 10 and pcs_for_this_unit > 5 and pcs_for_other_units > 5 :
+    all_pcs = np.reshape(all_pcs, (all_pcs.shape[0], pc_features.shape[1]*channels_to_use.size))
+    
+    num_pcs = all_pcs.shape[0];
+    
+    pcs_for_this_unit = all_pcs[all_labels == cluster_id,:].shape[0]   
+    pcs_for_other_units = all_pcs[all_labels != cluster_id, :].shape[0]
 
-            isolation_distances[cluster_id], l_ratios[cluster_id] = mahalanobis_metrics(all_pcs, all_labels, cluster_id)
+    if num_pcs > 10 and pcs_for_this_unit > 5 and pcs_for_other_units > 5 :
 
-            d_primes[cluster_id] = lda_metrics(all_pcs, all_labels, cluster_id)
+        isolation_distance, l_ratio = mahalanobis_metrics(all_pcs, all_labels, cluster_id)
 
-            nn_hit_rates[cluster_id], nn_miss_rates[cluster_id] = nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors)
+        d_prime = lda_metrics(all_pcs, all_labels, cluster_id)
 
-        else:
+        nn_hit_rate, nn_miss_rate = nearest_neighbors_metrics(all_pcs, all_labels, cluster_id, max_spikes_for_nn, n_neighbors)
 
-            isolation_distances[cluster_id] = np.nan
-            d_primes[cluster_id] = np.nan
-            nn_hit_rates[cluster_id] = np.nan
-            nn_miss_rates[cluster_id] = np.nan
+        return isolation_distance, l_ratio, d_prime, nn_hit_rate, nn_miss_rate
 
+    else:
 
-    return isolation_distances, l_ratios, d_primes, nn_hit_rates, nn_miss_rates 
+        return None
+
+
+def _map_pc_metrics_parallel(unit_jobs, pc_features, spike_templates, pc_feature_ind, 
+                             max_spikes_for_nn, n_neighbors, worker_count):
+
+    # pc_features and spike_templates are handed to the workers through shared
+    # memory (or the file they are memory-mapped from), not pickled per task
+
+    shared_blocks = []
+
+    try:
+        pc_features_desc = _share_array(pc_features, shared_blocks)
+        spike_templates_desc = _share_array(np.ascontiguousarray(spike_templates), shared_blocks)
+
+        with multiprocessing.Pool(np.min([worker_count, multiprocessing.cpu_count()]),
+                                  initializer = _init_pc_metrics_worker,
+                                  initargs = (pc_features_desc, spike_templates_desc, pc_feature_ind,
+                                              max_spikes_for_nn, n_neighbors)) as pool:
+
+            results = list(pool.imap(_pc_metrics_worker, unit_jobs, 
+                                     chunksize = max(1, len(unit_jobs) // (4 * worker_count))))
+    finally:
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
+
+    return results
+
+
+def _share_array(arr, shared_blocks):
+
+    # arrays loaded with np.load(..., mmap_mode='r'), and contiguous slices of 
+    # them (see epoch_rows), are re-opened by the workers from their file at 
+    # the byte offset of the slice; anything else is copied once into a 
+    # shared memory block
+
+    root = _memmap_root(arr)
+
+    if root is not None and arr.flags['C_CONTIGUOUS']:
+        offset = root.offset + arr.__array_interface__['data'][0] - root.__array_interface__['data'][0]
+        return ('memmap', root.filename, offset, arr.dtype.str, arr.shape)
+
+    shm = shared_memory.SharedMemory(create = True, size = max(arr.nbytes, 1))
+    shared_blocks.append(shm)
+
+    shared_arr = np.ndarray(arr.shape, dtype = arr.dtype, buffer = shm.buf)
+    shared_arr[...] = arr
+
+    return ('shm', shm.name, 0, arr.dtype.str, arr.shape)
+
+
+def _memmap_root(arr):
+
+    # the memmap that owns the file mapping of arr (views of a memmap have 
+    # the parent memmap as their base), or None if arr is not file-backed
+
+    while isinstance(arr, np.ndarray):
+        if isinstance(arr, np.memmap) and isinstance(arr.base, mmap.mmap):
+            return arr
+        arr = arr.base
+
+    return None
+
+
+def _attach_array(desc):
+
+    kind, name, offset, dtype, shape = desc
+
+    if kind == 'memmap':
+        return np.memmap(name, dtype = dtype, mode = 'r', offset = offset, shape = shape), None
+
+    shm = shared_memory.SharedMemory(name = name)
+    arr = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+    arr.flags.writeable = False
+
+    return arr, shm
+
+
+_pc_worker_state = {}
+
+def _init_pc_metrics_worker(pc_features_desc, spike_templates_desc, pc_feature_ind, max_spikes_for_nn, n_neighbors):
+
+    pc_features, pc_shm = _attach_array(pc_features_desc)
+    spike_templates, st_shm = _attach_array(spike_templates_desc)
+
+    # keep the shared memory handles alive for the lifetime of the worker
+    _pc_worker_state['shm'] = (pc_shm, st_shm)
+    _pc_worker_state['unit_metrics'] = partial(unit_pc_metrics, pc_features, spike_templates, pc_feature_ind,
+                                               max_spikes_for_nn, n_neighbors)
+
+
+def _pc_metrics_worker(unit_job):
+
+    return _pc_worker_state['unit_metrics'](unit_job)
 
 
 def calculate_silhouette_score(spike_clusters,
@@ -474,44 +799,24 @@ def calculate_silhouette_score(spike_clusters,
 
     random_spike_inds = np.random.permutation(spike_clusters.size)
     random_spike_inds = random_spike_inds[:total_spikes]
-    num_pc_features = pc_features.shape[1]
-
-    # initialize array to hold pcs: number of spikes X number of channeles x number of pc features
-    all_pcs = np.zeros((total_spikes, np.max(pc_feature_ind) * num_pc_features + 1))
 
-    for idx, i in enumerate(random_spike_inds):
-        
-        # unit_id = spike_clusters[i]
-        
-        # look up channel using the template id for this spike
-        template_id = spike_templates[i]       
-        channels = pc_feature_ind[template_id,:]
-        
-        # fill pcs into the correct channels for this spike
-        for j in range(0,num_pc_features):
-            all_pcs[idx, channels + np.max(pc_feature_ind) * j] = pc_features[i,j,:]
+    # sparse array of pcs: number of spikes X (number of channels x number of pc features)
+    all_pcs = get_sparse_pc_features(pc_features, pc_feature_ind, spike_templates, random_spike_inds)
 
     cluster_labels = spike_clusters[random_spike_inds]
 
-    cluster_ids = np.unique(cluster_labels)
-
     SS = np.empty((total_units, total_units))
     SS[:] = np.nan
 
-    for idx1, i in enumerate(cluster_ids):
+    cluster_ids, pair_scores = pairwise_silhouette_scores(all_pcs, cluster_labels)
 
-        printProgressBar(idx1+1, len(cluster_ids))
-        
-        for idx2, j in enumerate(cluster_ids):
-            
-            if j > i:
-                # positions of cluster labels = i or j
-                inds = np.in1d(cluster_labels, np.array([i,j]))
-                X = all_pcs[inds,:]
-                labels = cluster_labels[inds]
-                
-                if len(labels) > 2:
-                    SS[i,j] = silhouette_score(X, labels)
+    # silhouette score is only defined for pairs with more than 2 spikes
+    cluster_counts = np.bincount(cluster_labels)[cluster_ids]
+    valid = (cluster_counts[:,None] + cluster_counts[None,:]) > 2
+    valid = np.triu(valid, 1)
+
+    idx1, idx2 = np.nonzero(valid)
+    SS[cluster_ids[idx1], cluster_ids[idx2]] = pair_scores[idx1, idx2]
 
     with warnings.catch_warnings():
       warnings.simplefilter("ignore")
@@ -521,6 +826,63 @@ def calculate_silhouette_score(spike_clusters,
     return np.array([np.nanmin([a,b]) for a, b in zip(a,b)])
 
 
+def pairwise_silhouette_scores(X, labels):
+
+    """ Calculates the silhouette score of every pair of clusters
+
+    Equivalent to calling sklearn silhouette_score on the spikes of each pair
+    of clusters, but the distances between spikes are computed only once (in 
+    float32, in blocks) and reduced to per-spike sums of distances to each 
+    cluster, from which all the pairwise scores are derived.
+
+    Inputs:
+    -------
+    X : numpy.ndarray or scipy.sparse matrix (num_spikes x num_features)
+        Features for each spike
+    labels : numpy.ndarray (num_spikes x 0)
+        Cluster label for each spike
+
+    Outputs:
+    --------
+    cluster_ids : numpy.ndarray (num_clusters x 0)
+        Sorted cluster labels
+    pair_scores : numpy.ndarray (num_clusters x num_clusters)
+        Silhouette score for the spikes of each pair of clusters 
+        (diagonal is not meaningful)
+
+    """
+
+    order = np.argsort(labels, kind='stable')
+    X = X[order,:].astype('float32')
+    labels = labels[order]
+
+    cluster_ids, cluster_starts, cluster_counts = np.unique(labels, return_index=True, return_counts=True)
+
+    # sum of distances from each spike to all spikes in each cluster
+    dist_sums = np.zeros((X.shape[0], cluster_ids.size))
+    row = 0
+    for block in pairwise_distances_chunked(X, 
+                                            reduce_func = lambda D, start: np.add.reduceat(D.astype('float64'), cluster_starts, axis=1)):
+        dist_sums[row:row+block.shape[0],:] = block
+        row += block.shape[0]
+
+    label_index = np.repeat(np.arange(cluster_ids.size), cluster_counts)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # mean distance within own cluster (undefined for single-spike clusters)
+        intra = dist_sums[np.arange(X.shape[0]), label_index] / (cluster_counts[label_index] - 1)
+        # mean distance to each of the other clusters
+        inter = dist_sums / cluster_counts[None,:]
+        sil_samples = np.nan_to_num((inter - intra[:,None]) / np.maximum(intra[:,None], inter))
+
+    # sum of silhouette values of spikes in cluster i when paired with cluster j
+    sil_sums = np.add.reduceat(sil_samples, cluster_starts, axis=0)
+
+    pair_scores = (sil_sums + sil_sums.T) / (cluster_counts[:,None] + cluster_counts[None,:])
+
+    return cluster_ids, pair_scores
+
+
 def calculate_drift_metrics(spike_times,
                             spike_clusters,
                             spike_templates,
@@ -530,7 +892,9 @@ def calculate_drift_metrics(spike_times,
                             pc_feature_ind,
                             channel_pos,
                             interval_length,
-                            min_spikes_per_interval):
+                            min_spikes_per_interval,
+                            chunk_size = 100000,
+                            cluster_ids = None):
 
     max_drift = np.zeros((total_units,))
     cumulative_drift = np.zeros((total_units,))
@@ -539,70 +903,123 @@ def calculate_drift_metrics(spike_times,
     # the majority template. Make array of the majority template for these clusters
     maj_tid = unit_template_ids[spike_clusters]
     match_maj = spike_templates==maj_tid
-    
-    # calculate size of the arrays we'll be copying
-    # 2*(number of spikes*4) for spike_times and spike_clusters
-    # number of spikes*number of template channels*4 for first pc on each site
-#    pc_size = pc_features.shape
-#    nmatch = match_maj.shape
-#    memuse = 2*nmatch[0]*4 + nmatch[0]*pc_size[2]*4
-
-#    print("expected size of new memory: " + repr(memuse))
-#    currmem = psutil.Process().memory_info().rss / (1024 * 1024)
-#    print("psutil memory info before copies: " + repr(currmem))
-    
+
+    if cluster_ids is not None:
+        # only calculate drift for the requested clusters
+        match_maj = match_maj * np.isin(spike_clusters, cluster_ids)
+
+    match_maj = np.flatnonzero(match_maj)
     
     # make arrays of just those spikes for which the template matches the 
-    # majority template for htat cluster. These operations make copies of the
-    # arrays.
+    # majority template for htat cluster. 
     m_spike_clusters = spike_clusters[match_maj]
     m_spike_times = spike_times[match_maj]
     
-    # same for pc_features, but we only need the first pc for each
-    # this operation makes a copy of pc_features so original is not altered
-    m_pc_features_sq = np.squeeze(pc_features[match_maj,0,:]);
-    # set negative pc_features to zero before taking square
-    m_pc_features_sq[m_pc_features_sq < 0] = 0
-    # elementwise square
-    m_pc_features_sq = pow(m_pc_features_sq, 2) 
-    
-#    currmem = psutil.Process().memory_info().rss / (1024 * 1024)
-#    print("psutil memory info after copies: " + repr(currmem))
-    
-#    send only
-    
-    depths = get_spike_depths(m_spike_clusters, unit_template_ids, m_pc_features_sq, pc_feature_ind, channel_pos)
+    # the first pc on each site is read from pc_features in chunks of spikes,
+    # so the (possibly memory-mapped) pc_features array is never copied in full
+    depths = get_spike_depths(m_spike_clusters, unit_template_ids, pc_features, pc_feature_ind, channel_pos, 
+                              spike_inds = match_maj, chunk_size = chunk_size)
     
     interval_starts = np.arange(np.min(spike_times), np.max(spike_times), interval_length)
     interval_ends = interval_starts + interval_length
 
     cluster_ids = np.unique(m_spike_clusters)
 
-    for idx, cluster_id in enumerate(cluster_ids):
+    if cluster_ids.size == 0:
+        return max_drift, cumulative_drift
 
-        printProgressBar(idx+1, len(cluster_ids))
+    # sort spikes by cluster, then time, so that the spikes of each cluster in
+    # each interval are a contiguous segment
+    order = np.lexsort((m_spike_times, m_spike_clusters))
+    sorted_times = m_spike_times[order]
+    sorted_depths = depths[order]
+    cluster_offsets = np.searchsorted(m_spike_clusters[order], np.append(cluster_ids, cluster_ids[-1] + 1))
 
-        in_cluster = m_spike_clusters == cluster_id
-        times_for_cluster = m_spike_times[in_cluster]
-        depths_for_cluster = depths[in_cluster]
+    # median depth for each cluster (rows) in each interval (columns)
+    median_depths = segment_medians(sorted_times, 
+                                    sorted_depths, 
+                                    cluster_offsets, 
+                                    interval_starts, 
+                                    interval_ends, 
+                                    min_spikes_per_interval)
 
-        median_depths = []
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        max_drift[cluster_ids] = np.around(np.nanmax(median_depths,1) - np.nanmin(median_depths,1),2)
+    cumulative_drift[cluster_ids] = np.around(np.nansum(np.abs(np.diff(median_depths,axis=1)),1),2)
 
-        for t1, t2 in zip(interval_starts, interval_ends):
+    return max_drift, cumulative_drift
 
-            in_range = (times_for_cluster > t1) * (times_for_cluster < t2)
-            
-            if np.sum(in_range) >= min_spikes_per_interval:
-                median_depths.append(np.median(depths_for_cluster[in_range]))
-            else:
-                median_depths.append(np.nan)
-            
-        median_depths = np.array(median_depths)
-            
-        max_drift[cluster_id] = np.around(np.nanmax(median_depths) - np.nanmin(median_depths),2)
-        cumulative_drift[cluster_id] = np.around(np.nansum(np.abs(np.diff(median_depths))),2)
 
-    return max_drift, cumulative_drift
+def segment_medians(sorted_times, sorted_values, cluster_offsets, interval_starts, interval_ends, min_count):
+
+    """ Median value of each cluster's spikes within each time interval
+
+    Equivalent to taking np.median of the values with start < time < end for 
+    each cluster and interval, but the interval boundaries are found with one 
+    searchsorted per cluster and all medians are computed with a single sort.
+
+    Inputs:
+    -------
+    sorted_times : numpy.ndarray (num_spikes x 0)
+        Spike times, sorted by cluster and then by time
+    sorted_values : numpy.ndarray (num_spikes x 0)
+        Value (e.g. depth) of each spike, in the same order
+    cluster_offsets : numpy.ndarray (num_clusters + 1 x 0)
+        Start of each cluster's block of spikes
+    interval_starts : numpy.ndarray (num_intervals x 0)
+    interval_ends : numpy.ndarray (num_intervals x 0)
+    min_count : Int
+        Minimum number of spikes in an interval; intervals with fewer are NaN
+
+    Outputs:
+    --------
+    medians : numpy.ndarray (num_clusters x num_intervals)
+
+    """
+
+    num_clusters = cluster_offsets.size - 1
+    num_intervals = interval_starts.size
+
+    seg_lo = np.zeros((num_clusters, num_intervals), dtype='int64')
+    seg_hi = np.zeros((num_clusters, num_intervals), dtype='int64')
+
+    for idx in range(num_clusters):
+        times_for_cluster = sorted_times[cluster_offsets[idx]:cluster_offsets[idx+1]]
+        seg_lo[idx,:] = cluster_offsets[idx] + np.searchsorted(times_for_cluster, interval_starts, side='right')
+        seg_hi[idx,:] = cluster_offsets[idx] + np.searchsorted(times_for_cluster, interval_ends, side='left')
+
+    seg_lo = seg_lo.flatten()
+    counts = np.maximum(seg_hi.flatten() - seg_lo, 0)
+
+    medians = np.empty((num_clusters * num_intervals,))
+    medians[:] = np.nan
+
+    valid = np.flatnonzero((counts >= min_count) * (counts > 0))
+
+    if valid.size > 0:
+
+        # gather the values of every valid segment, then sort within segments
+        valid_counts = counts[valid]
+        seg_starts = np.cumsum(valid_counts) - valid_counts
+        segment = np.repeat(np.arange(valid.size), valid_counts)
+        spike_inds = np.repeat(seg_lo[valid] - seg_starts, valid_counts) + np.arange(np.sum(valid_counts))
+
+        values = sorted_values[spike_inds]
+        values = values[np.lexsort((values, segment))]
+
+        lower = values[seg_starts + (valid_counts - 1) // 2]
+        upper = values[seg_starts + valid_counts // 2]
+
+        segment_medians = np.where(valid_counts % 2 == 1, lower, (lower + upper) / 2)
+
+        # as with np.median, any NaN in a segment makes its median NaN
+        has_nan = np.bincount(segment, weights = np.isnan(values), minlength = valid.size) > 0
+        segment_medians[has_nan] = np.nan
+
+        medians[valid] = segment_medians
+
+    return np.reshape(medians, (num_clusters, num_intervals))
 
 
 # ==========================================================
@@ -953,6 +1370,45 @@ def make_index_mask(spike_clusters, unit_id, min_num, max_num):
     return index_mask
 
 
+def make_index_subset(cluster_index, unit_id, min_num, max_num):
+
+    """ Select spike indices for one unit from a cluster-grouped spike index
+
+    Equivalent to make_index_mask, but reads the unit's spikes as a slice of the
+    index built by get_cluster_spike_index instead of comparing every spike, and
+    returns indices rather than a boolean mask over all spikes. The random
+    subsample draws the same permutation as make_index_mask.
+
+    Inputs:
+    -------
+    cluster_index : tuple (spike_order, cluster_offsets)
+        Output of get_cluster_spike_index for the spikes in pc_features array
+    unit_id : Int
+        ID for this unit
+    min_num : Int
+        Minimum number of spikes to return; if there are not enough spikes for this unit, return none
+    max_num : Int
+        Maximum number of spikes to return; if too many spikes for this unit, return a random subsample
+
+    Output:
+    -------
+    spike_inds : numpy.ndarray (int)
+        Sorted spike indices for pc_features array
+
+    """
+
+    spike_order, cluster_offsets = cluster_index
+
+    inds = spike_order[cluster_offsets[unit_id]:cluster_offsets[unit_id+1]]
+
+    if len(inds) < min_num:
+        return np.zeros((0,), dtype='int64')
+
+    order = np.random.permutation(inds.size)
+
+    return np.sort(inds[order[:max_num]])
+
+
 def make_channel_mask(unit_id, pc_feature_ind, channels_to_use):
 
     """ Create a mask for the channel dimension of the pc_features array  
@@ -1014,10 +1470,14 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
     -------
     these_pc_features : numpy.ndarray (float)
         Array of pre-computed PC features (num_spikes x num_PCs x num_channels)
-    index_mask : numpy.ndarray (boolean)
-        Mask for spike index dimension of pc_features array
-    channel_mask : numpy.ndarray (boolean)
-        Mask for channel index dimension of pc_features array
+    index_mask : numpy.ndarray (boolean or int)
+        Mask (or sorted indices) for spike index dimension of pc_features array
+    spike_templates : numpy.ndarray (num_spikes x 0)
+        Template IDs for each spike in pc_features array
+    channels_to_use : numpy.ndarray
+        Channels to use for calculating metrics
+    pc_feature_ind : numpy.ndarray (num_units x num_channels)
+        Channel indices of PCs for each unit
 
     Output:
     -------
@@ -1026,6 +1486,11 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
 
     """
 
+    if index_mask.dtype == bool:
+        spike_inds = np.flatnonzero(index_mask)
+    else:
+        spike_inds = index_mask
+
     # start with an empty 3D array
     [nspike,npcs,nchan] = these_pc_features.shape
     
@@ -1035,11 +1500,12 @@ def get_unit_pcs(these_pc_features, index_mask, spike_templates, channels_to_use
     
     # get list of templates included in this cluster
     # for data with no curation, there will just be one value   
-    template_ids = np.unique(spike_templates[index_mask])
+    unit_spike_templates = spike_templates[spike_inds]
+    template_ids = np.unique(unit_spike_templates)
     
     # for each template id, create a channel mask (if possible) and extract templates
     for tid in template_ids:
-        curr_idx = index_mask & (spike_templates == tid)
+        curr_idx = spike_inds[unit_spike_templates == tid]
         try:
             channel_mask = make_channel_mask(tid, pc_feature_ind, channels_to_use)            
         except IndexError:
@@ -1073,48 +1539,104 @@ def ccg(st1, st2, nbins, tbin, auto):
     Q01
     
     """
-    # print('ccg num spikes = ' + repr(len(st1)))
-    st1 = np.sort(np.squeeze(st1))
-    st2 = np.sort(np.squeeze(st2))
-    
+
+    K, Qi, Q00, Q01, Ri = ccg_batch([st1], [st2], nbins, tbin, auto)
+
+    return K[0], Qi[0], Q00[0], Q01[0], Ri[0]
+
+
+def ccg_batch(st1_list, st2_list, nbins, tbin, auto, max_pairs = 4194304):
+
+    """ calculate crosscorrelograms for many pairs of spike trains at once
+
+        Vectorized version of the Kilosort2 ccg algorithm: for each spike in st2,
+        the range of spikes in st1 within plus/minus nbins*tbin is found with
+        searchsorted, and all spike pairs in range are binned with a single 
+        bincount. Pairs are processed in blocks of at most max_pairs (unless a
+        single spike has more partners than that) to bound memory use.
+        Returns the same values as looping ccg over the pairs.
+
+    Inputs:
+    -------
+    st1_list : list of numpy.ndarray
+        spike times for set #1 of each pair in sec
+    st2_list : list of numpy.ndarray
+        spike times for set #2 of each pair in sec (pass st1_list for auto)
+    nbins : ccg will be calculated for 2*nbins + 1 bins
+    tbin : bin width in seconds
+    auto : bool
+        if True, remove the self-counted spikes from the zero bin
+    max_pairs : int
+        maximum number of spike pairs to hold in memory at once
+
+    Outputs:
+    --------
+    K : numpy.ndarray (num_pairs x 2*nbins+1)
+        ccg histograms
+    Qi : numpy.ndarray (num_pairs x 11)
+    Q00 : numpy.ndarray (num_pairs x 0)
+    Q01 : numpy.ndarray (num_pairs x 0)
+    Ri : numpy.ndarray (num_pairs x 11)
+
+    """
+
+    num_pairs = len(st1_list)
+    num_bins = 2*nbins + 1
+
     dt = nbins*tbin  # cross correlogram spans -dt-dt
-    
-    T = max(np.max(st1),np.max(st2)) - min(np.min(st1),np.min(st2))
-    
-    # traverse both spike trains together, keeping track of the spikes in the first
-    # spike train that are within dt of the second spike train
-    ilow = 0
-    ihigh = 0
-    j = 0
-    
-    n_st2 = len(st2)
-    n_st1 = len(st1)
-    
-    K = np.zeros((2*nbins+1,))
-    
-    while j < n_st2:                      # walk over all spikes in 2nd spike train
-        while (ihigh < n_st1) and (st1[ihigh] < st2[j]+dt):            
-            ihigh = ihigh + 1             # increase upper bound until its outisde the dt range
-        while (ilow < n_st1) and (st1[ilow] <= st2[j]-dt):
-            ilow = ilow + 1                # increase lower bound until it is inside the dt range
-        if ilow > n_st1:
-            break
-        if st1[ilow] > st2[j] + dt:
-            # if the lower bound is actually outside of the dt range, means
-            # there were no spikes in range of the ccg
-            # just move on to next spike st2
-            j = j + 1
-            continue
-        for k in range(ilow,ihigh):
-            # for all spikes within the plus/minus dt range
-            ibin = int(np.round((st2[j]-st1[k])/tbin))    # calculate which bin
-            K[ibin + nbins] = K[ibin + nbins] + 1    # increment corresponding bin in correlogram
-        j = j + 1   # go to next spike in st2
-        
+
+    st1_list = [np.sort(np.squeeze(st1)) for st1 in st1_list]
+    st2_list = [np.sort(np.squeeze(st2)) for st2 in st2_list]
+
+    n_st1 = np.array([st1.size for st1 in st1_list], dtype='int64')
+    n_st2 = np.array([st2.size for st2 in st2_list], dtype='int64')
+
+    T = np.array([max(np.max(st1),np.max(st2)) - min(np.min(st1),np.min(st2)) 
+                  for st1, st2 in zip(st1_list, st2_list)])
+
+    # for each spike in the 2nd train, the spikes in the 1st train within the
+    # dt range are st1[ilow:ihigh]; indices are offset into the concatenated trains
+    st1_offsets = np.concatenate(([0], np.cumsum(n_st1)[:-1]))
+    ilow = np.concatenate([np.searchsorted(st1, st2 - dt, side='right') + offset
+                           for st1, st2, offset in zip(st1_list, st2_list, st1_offsets)])
+    ihigh = np.concatenate([np.searchsorted(st1, st2 + dt, side='left') + offset
+                            for st1, st2, offset in zip(st1_list, st2_list, st1_offsets)])
+
+    st1_all = np.concatenate(st1_list)
+    st2_all = np.concatenate(st2_list)
+    pair_ids = np.repeat(np.arange(num_pairs), n_st2)
+
+    counts = np.maximum(ihigh - ilow, 0)
+    cum_counts = np.cumsum(counts)
+
+    K = np.zeros((num_pairs * num_bins,))
+
+    j_start = 0
+    while j_start < st2_all.size:
+
+        # take as many spikes from st2 as fit within max_pairs (at least one)
+        pairs_before = cum_counts[j_start-1] if j_start > 0 else 0
+        j_end = np.searchsorted(cum_counts, pairs_before + max_pairs, side='right')
+        j_end = min(max(j_end, j_start + 1), st2_all.size)
+
+        block_counts = counts[j_start:j_end]
+        total = np.sum(block_counts)
+
+        if total > 0:
+            j = np.repeat(np.arange(j_start, j_end), block_counts)
+            block_starts = np.cumsum(block_counts) - block_counts
+            k = np.repeat(ilow[j_start:j_end] - block_starts, block_counts) + np.arange(total)
+
+            ibin = np.round((st2_all[j] - st1_all[k])/tbin).astype('int64')   # calculate which bin
+            K += np.bincount(pair_ids[j] * num_bins + ibin + nbins, minlength = K.size)
+
+        j_start = j_end
+
+    K = np.reshape(K, (num_pairs, num_bins))
+
     if auto:
-        # print('nspikes, zero bin: ' + repr(n_st1) + ', ' + repr(K[nbins]))
         # if this is an autocorrelogram, remove the self-found spikes from the zero bin
-        K[nbins] = K[nbins] - n_st1     # remove "self found" spikes from 
+        K[:,nbins] = K[:,nbins] - n_st1     # remove "self found" spikes from 
     
     irange1 = np.concatenate((np.arange(1, int(nbins/2)), np.arange(int(3/2*nbins), 2*nbins-1)),0) # this index range corresponds to the CCG shoulders, excluding end bins
     irange2 = np.arange(nbins-50, nbins-10)  # 40 channels to negative side of peak
@@ -1122,32 +1644,24 @@ def ccg(st1, st2, nbins, tbin, auto):
     
     # Normalize the firing rate in the shoulders by the mean firing rate
     # A Poisson process has a flat ACG (equal numbers of spikes at all ISIs) and these ratios would = 1
-    mean_firing_rate = (n_st2)/T
-    Q00 = (sum(K[irange1])/(n_st1 * tbin * len(irange1)))/mean_firing_rate
-    Q01_neg = (sum(K[irange2])/(n_st1 * tbin * len(irange2)))/mean_firing_rate
-    Q01_pos = (sum(K[irange3])/(n_st1 * tbin * len(irange3)))/mean_firing_rate
-    Q01 = max(Q01_neg, Q01_pos)
-    
-    #print('firing rate, Q00, Q01: ' + repr(mean_firing_rate) + ', ' + repr(Q00) + ', ' + repr(Q01))
-    
-    # Get highest spike rate of the sampled time regions
-    R00 = max(np.mean(K[irange2]), np.mean(K[irange3])) # Larger of the two shoulders near t = 0
-    R00 = max(R00, np.mean(K[irange1])) # compare this to the asymptotic shoulder
+    mean_firing_rate = n_st2/T
+    Q00 = (np.sum(K[:,irange1],1)/(n_st1 * tbin * len(irange1)))/mean_firing_rate
+    Q01_neg = (np.sum(K[:,irange2],1)/(n_st1 * tbin * len(irange2)))/mean_firing_rate
+    Q01_pos = (np.sum(K[:,irange3],1)/(n_st1 * tbin * len(irange3)))/mean_firing_rate
+    Q01 = np.where(Q01_pos > Q01_neg, Q01_pos, Q01_neg)
     
     # Calculate "refractoriness for periods from 1*tbin to 10*tbin
-    Qi = np.zeros((11,))
-    Ri = np.zeros((11,))
+    Qi = np.zeros((num_pairs, 11))
+    Ri = np.zeros((num_pairs, 11))
     for i in range(1,11):
         irange = np.arange(nbins-i,nbins+i)
-        Qi[i] = (sum(K[irange])/(2*i*tbin+1))/mean_firing_rate    #rate in this time period/mean rate
-        #print( 'K[nbins-i], Qi: ' + repr(K[nbins-i]) + ', ' + repr( Qi[i]))
+        Qi[:,i] = (np.sum(K[:,irange],1)/(2*i*tbin+1))/mean_firing_rate    #rate in this time period/mean rate
         
-
         # Marius note: this is tricky: we approximate the Poisson likelihood with a gaussian of equal mean and variance
         # that allows us to integrate the probability that we would see <N spikes in the center of the
         # cross-correlogram from a distribution with mean R00*i spikes
         
-        # this calculation is done in KS2 but never used
+        # this calculation is done in KS2 but never used, so R00 and Ri are not computed
         # n = sum(K[irange])/2
         # lam = R00 + i
         # Ri[i] =  1/2 * (1+ special.erf((n - lam)/np.sqrt(2*lam)))
@@ -1163,17 +1677,22 @@ def contamination_rate(st_sec, tbin_sec, refPer_sec):
     #      instead of just taking the range of the acg with the lowest contamination, take the range corresponding
     #      to the user specified refractory period. This will also usually give higher values for the contamination rate.
     
+    return contamination_rates([st_sec], tbin_sec, refPer_sec)[0]
+
+def contamination_rates(st_sec_list, tbin_sec, refPer_sec):
+    # batched version of contamination_rate: one auto-correlogram per spike train,
+    # all computed in a single call to ccg_batch
+    
     refPerBin = int(refPer_sec/tbin_sec)
     if refPerBin == 0:
         refPerBin = 1   # if refractory period < bin size, take the first bin
     
-    K, Qi, Q00, Q01, rir = ccg(st_sec, st_sec, 500, tbin_sec, True); # compute the auto-correlogram with 500 bins at 1ms bins
+    K, Qi, Q00, Q01, rir = ccg_batch(st_sec_list, st_sec_list, 500, tbin_sec, True) # compute the auto-correlograms with 500 bins at 1ms bins
     
-    normFactor = (max(Q00, Q01))
+    normFactor = np.where(Q01 > Q00, Q01, Q00)
     
-    if normFactor > 0:
-        contam_rate  = Qi[refPerBin]/normFactor # get the Q[i] that includes the refractory period
-    else:
-        contam_rate = 1
+    contam_rate = np.ones((len(st_sec_list),))
+    valid = normFactor > 0
+    contam_rate[valid] = Qi[valid,refPerBin]/normFactor[valid] # get the Q[i] that includes the refractory period
     
-    return contam_rate
\ No newline at end of file
+    return contam_rate
@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+# metrics that depend only on the spikes of one cluster
+CLUSTER_METRICS = ['firing_rate', 'presence_ratio', 'isi_viol', 'num_viol', 'amplitude_cutoff',
+                   'contam_rate', 'max_drift', 'cumulative_drift']
+
+# metrics that also depend on the spikes of the neighboring clusters
+PC_METRICS = ['isolation_distance', 'l_ratio', 'd_prime', 'nn_hit_rate', 'nn_miss_rate']
+
+
+class MetricsCache():
+
+    """
+    Stores quality metrics for each cluster keyed by a fingerprint of its spikes,
+    so that after manual curation only new, merged or split clusters (and the
+    clusters whose PC neighborhood changed) need to be recomputed
+
+    The cache is discarded if the data it was computed from (spike times,
+    spike templates, amplitudes, PC channel indices, channel positions) or the
+    metric parameters change. The PC features themselves are too large to hash;
+    they are written by the same sort as the spike times and templates.
+
+    """
+
+    def __init__(self, filename, data_key):
+
+        """
+        filename : str
+            Path of the cache file (csv)
+        data_key : str
+            Hash of the input data and parameters, from get_data_key
+        """
+
+        self.filename = filename
+        self.data_key = data_key
+        self.new_table = []
+
+        self.table = pd.DataFrame()
+
+        if os.path.exists(filename):
+            table = pd.read_csv(filename, dtype = {'fingerprint' : str, 'pc_fingerprint' : str}, float_precision = 'round_trip')
+            if table.shape[0] > 0 and np.all(table['data_key'] == data_key):
+                self.table = table
+
+    def lookup(self, epoch_name):
+
+        """ Returns the cached metrics for one epoch, indexed by cluster fingerprint """
+
+        if self.table.shape[0] == 0:
+            return pd.DataFrame(columns = ['pc_fingerprint'] + CLUSTER_METRICS + PC_METRICS)
+
+        epoch_table = self.table[self.table['epoch_name'] == epoch_name]
+
+        return epoch_table.set_index('fingerprint')
+
+    def store(self, epoch_name, cluster_ids, fingerprints, pc_fingerprints, epoch_metrics):
+
+        """ Records the metrics computed for one epoch
+
+        Inputs:
+        -------
+        epoch_name : str
+        cluster_ids : numpy.ndarray
+            Cluster IDs with spikes in this epoch
+        fingerprints : dict
+            Fingerprint of each cluster's spikes
+        pc_fingerprints : dict
+            Fingerprint of each cluster's PC neighborhood (empty if PCs not used)
+        epoch_metrics : pandas.DataFrame
+            Metrics for this epoch, one row per cluster ID
+
+        """
+
+        table = epoch_metrics.set_index('cluster_id').loc[cluster_ids, CLUSTER_METRICS + PC_METRICS]
+
+        table.insert(0, 'pc_fingerprint', [pc_fingerprints.get(cluster_id, '') for cluster_id in cluster_ids])
+        table.insert(0, 'fingerprint', [fingerprints[cluster_id] for cluster_id in cluster_ids])
+        table.insert(0, 'epoch_name', epoch_name)
+        table.insert(0, 'data_key', self.data_key)
+
+        self.new_table.append(table.reset_index(drop=True))
+
+    def save(self):
+
+        """ Writes the metrics recorded with store to the cache file """
+
+        if len(self.new_table) > 0:
+            pd.concat(self.new_table).to_csv(self.filename, index = False)
+
+
+def get_data_key(params, *arrays):
+
+    """ Hash of the metric parameters and the arrays the metrics are computed from """
+
+    h = hashlib.sha1(json.dumps(params, sort_keys = True, default = str).encode())
+
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(str((arr.dtype.str, arr.shape)).encode())
+        h.update(memoryview(arr).cast('B'))
+
+    return h.hexdigest()
+
+
+def get_cluster_fingerprints(cluster_index, cluster_ids):
+
+    """ Hash of the spike indices of each cluster
+
+    Inputs:
+    -------
+    cluster_index : tuple (spike_order, cluster_offsets)
+        Output of get_cluster_spike_index
+    cluster_ids : numpy.ndarray
+        Cluster IDs to fingerprint
+
+    Outputs:
+    --------
+    fingerprints : dict
+        Fingerprint (hex string) for each cluster ID
+
+    """
+
+    spike_order, cluster_offsets = cluster_index
+
+    fingerprints = {}
+
+    for cluster_id in cluster_ids:
+        spikes = np.ascontiguousarray(spike_order[cluster_offsets[cluster_id]:cluster_offsets[cluster_id+1]], dtype = 'int64')
+        fingerprints[cluster_id] = hashlib.sha1(memoryview(spikes).cast('B')).hexdigest()
+
+    return fingerprints
+
+
+def get_neighborhood_fingerprints(fingerprints, neighborhoods):
+
+    """ Hash of the spikes of each cluster and of the neighbors it is compared with for PC metrics
+
+    Inputs:
+    -------
+    fingerprints : dict
+        Output of get_cluster_fingerprints
+    neighborhoods : dict
+        Output of calculate_pc_neighborhoods
+
+    Outputs:
+    --------
+    pc_fingerprints : dict
+        Fingerprint (hex string) for each cluster ID
+
+    """
+
+    pc_fingerprints = {}
+
+    for cluster_id, (units_for_channel, channels_to_use) in neighborhoods.items():
+        h = hashlib.sha1(fingerprints[cluster_id].encode())
+        for neighbor in units_for_channel:
+            h.update(fingerprints[neighbor].encode())
+        h.update(np.ascontiguousarray(channels_to_use, dtype = 'int64').tobytes())
+        pc_fingerprints[cluster_id] = h.hexdigest()
+
+    return pc_fingerprints
@@ -0,0 +1,26 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.common.cluster_waveforms import select_cluster_spikes, sum_waveforms
+
+
+def test_select_cluster_spikes():
+
+	spike_clusters = np.array([0, 1, 0, 0, 1, 0, 0, 2])
+
+	spike_inds, spike_groups = select_cluster_spikes(spike_clusters, 4, 2)
+
+	assert(np.array_equal(spike_groups, np.array([0, 0, 1, 1, 2])))
+	assert(np.array_equal(spike_inds, np.array([0, 3, 1, 4, 7])))
+
+
+def test_sum_waveforms():
+
+	raw_data = np.arange(40, dtype='int16').reshape((10, 4))
+
+	groups, sums, sum_sq, counts = sum_waveforms(raw_data, np.array([1, 2, 5]), np.array([3, 1, 3]), 3, 2, 1, batch_size = 2)
+
+	assert(np.array_equal(groups, np.array([1, 3])))
+	assert(np.array_equal(counts, np.array([1, 2])))
+	assert(np.array_equal(sums[1], raw_data[1:4, :2] + raw_data[5:8, :2]))
+	assert(np.array_equal(sum_sq[0], raw_data[2:3, :2].astype('int64')**2))
@@ -46,3 +46,138 @@ def test_find_range():
 	output = utils.find_range(data, 20, 30)
 
 	assert(np.array_equal(output, np.arange(20,31)))
+
+
+def test_get_cluster_spike_index():
+
+	spike_clusters = np.array([2, 0, 2, 3, 0, 2])
+
+	spike_order, cluster_offsets = utils.get_cluster_spike_index(spike_clusters, 5)
+
+	assert(np.array_equal(cluster_offsets, np.array([0, 2, 2, 5, 6, 6])))
+	assert(np.array_equal(spike_order[cluster_offsets[2]:cluster_offsets[3]], np.array([0, 2, 5])))
+
+
+def test_get_sparse_pc_features():
+
+	pc_features = np.arange(24).reshape((4, 2, 3)).astype('float32')
+	pc_feature_ind = np.array([[0, 1, 2], [3, 2, 1]])
+	spike_templates = np.array([0, 1, 1, 0])
+
+	spike_pcs = utils.get_sparse_pc_features(pc_features, pc_feature_ind, spike_templates, np.array([2, 0]))
+
+	assert(spike_pcs.shape == (2, 8))
+
+	dense = spike_pcs.toarray()
+	assert(np.array_equal(dense[0, [3, 2, 1]], pc_features[2, 0, :]))
+	assert(np.array_equal(dense[0, [7, 6, 5]], pc_features[2, 1, :]))
+	assert(np.array_equal(dense[1, [4, 5, 6]], pc_features[0, 1, :]))
+	assert(dense[1, 3] == 0)
+
+
+def test_kilosort_dataset(tmp_path):
+
+	np.save(tmp_path / 'spike_times.npy', np.array([[30], [60], [90]], dtype='uint64'))
+	np.save(tmp_path / 'spike_clusters.npy', np.array([1, 0, 1], dtype='int32'))
+	np.save(tmp_path / 'pc_features.npy', np.zeros((3, 3, 4), dtype='float32'))
+	np.save(tmp_path / 'similar_templates.npy', np.eye(2, dtype='float32'))
+
+	dataset = utils.KilosortDataset(str(tmp_path), 30.0)
+
+	assert(np.array_equal(dataset.spike_times, np.array([1.0, 2.0, 3.0])))
+	assert(dataset.spike_times is dataset.spike_times)
+	assert(np.array_equal(dataset.cluster_ids, np.array([0, 1])))
+	assert(isinstance(dataset.pc_features, np.memmap))
+	assert(isinstance(dataset.similar_templates, np.memmap))
+	assert(np.array_equal(dataset.similar_templates, np.eye(2)))
+
+
+def test_load_unwhitened_templates(tmp_path):
+
+	templates = np.zeros((2, 5, 3), dtype='float32')
+	templates[0, 2, 1] = 1.0
+	templates[1, 3, 2] = -2.0
+	np.save(tmp_path / 'templates.npy', templates)
+	np.save(tmp_path / 'whitening_mat_inv.npy', np.eye(3) * 2)
+
+	unwhitened, peak_channels, peak_to_peak = utils.load_unwhitened_templates(str(tmp_path))
+
+	assert(unwhitened.dtype == np.float32)
+	assert(np.array_equal(unwhitened, templates * 2))
+	assert(np.array_equal(peak_channels, np.array([1, 2])))
+	assert(np.array_equal(peak_to_peak, np.array([2.0, 4.0])))
+
+	# second call reads the sidecar file
+	assert(os.path.exists(tmp_path / 'templates_unwhitened.npz'))
+	cached, _, _ = utils.load_unwhitened_templates(str(tmp_path))
+	assert(np.array_equal(cached, unwhitened))
+
+
+def test_getSortResults_peak_channels(tmp_path):
+
+	# asymmetric inverse whitening matrix: each template is unwhitened as
+	# w_inv @ template.T, which moves its peak from channel 0 to channel 2
+	w_inv = np.eye(3)
+	w_inv[2, 0] = 5.0
+
+	templates = np.zeros((2, 5, 3), dtype='float32')
+	templates[0, 2, 0] = 1.0
+	templates[1, 3, 1] = 1.0
+
+	np.save(tmp_path / 'templates.npy', templates)
+	np.save(tmp_path / 'whitening_mat_inv.npy', w_inv)
+	np.save(tmp_path / 'channel_map.npy', np.array([10, 11, 12]))
+	np.save(tmp_path / 'spike_clusters.npy', np.array([0, 0, 1, 1, 1]))
+	np.save(tmp_path / 'spike_templates.npy', np.array([0, 0, 1, 1, 0]))
+
+	utils.getSortResults(str(tmp_path), 0)
+
+	clus_Table = np.load(tmp_path / 'clus_Table.npy')
+
+	expected = [np.argmax(np.ptp(np.matmul(w_inv, templates[t].T), 1)) for t in range(2)]
+
+	assert(np.array_equal(clus_Table[:, 0], np.array([2, 3])))
+	assert(np.array_equal(clus_Table[:, 1], np.array([10, 11, 12])[expected]))
+	assert(clus_Table[0, 1] == 12)
+
+
+
+def test_get_spike_depths_chunks(tmp_path):
+
+	rng = np.random.RandomState(0)
+
+	num_spikes = 1000
+	spike_clusters = rng.randint(0, 5, num_spikes)
+	unit_template_ids = np.array([0, 2, 1, 4, 3])
+	pc_feature_ind = np.array([np.arange(c, c + 4) for c in range(5)])
+	channel_pos = np.stack([np.zeros((8,)), np.arange(8) * 20.0], 1)
+
+	pc_features = rng.normal(size = (num_spikes, 3, 4)).astype('float32')
+	pc_features[:, 0, 1] = np.abs(pc_features[:, 0, 1]) + 0.1   # at least one positive 1st PC
+
+	np.save(tmp_path / 'pc_features.npy', pc_features)
+	mapped = np.load(tmp_path / 'pc_features.npy', mmap_mode = 'r')
+
+	spike_inds = np.sort(rng.choice(num_spikes, 300, replace = False))
+
+	expected = utils.get_spike_depths(spike_clusters, unit_template_ids, pc_features, pc_feature_ind, channel_pos, 
+									  chunk_size = num_spikes)
+	expected_subset = utils.get_spike_depths(spike_clusters[spike_inds], unit_template_ids, pc_features, pc_feature_ind, 
+											 channel_pos, spike_inds = spike_inds, chunk_size = num_spikes)
+
+	assert(np.array_equal(expected_subset, expected[spike_inds]))
+
+	# chunks smaller than, and not dividing, the number of spikes
+	for features in [pc_features, mapped]:
+		for chunk_size in [1, 7, 333]:
+
+			depths = utils.get_spike_depths(spike_clusters, unit_template_ids, features, pc_feature_ind, channel_pos, 
+											chunk_size = chunk_size)
+			assert(np.array_equal(depths, expected))
+
+			depths = utils.get_spike_depths(spike_clusters[spike_inds], unit_template_ids, features, pc_feature_ind, 
+											channel_pos, spike_inds = spike_inds, chunk_size = chunk_size)
+			assert(np.array_equal(depths, expected_subset))
+
+	# memory-mapped features are only read, never modified in place
+	assert(np.array_equal(np.load(tmp_path / 'pc_features.npy'), pc_features))
@@ -3,6 +3,8 @@ import numpy as np
 import os
 
 from ecephys_spike_sorting.modules.automerging.automerging import automerging
+from ecephys_spike_sorting.modules.automerging.metrics import find_depth, make_interp_temps, compare_templates, compute_isi_score
+from ecephys_spike_sorting.modules.automerging.merges import compute_overall_score, ID_merge_groups
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
@@ -14,6 +16,10 @@ def test_automerging():
 	params = {}
 	params['merge_threshold'] = 2.5
 	params['distance_to_compare'] = 5
+	params['min_amplitude_ratio'] = 0.0
+	params['min_overlap'] = 0.0
+	params['similarity_source'] = 'interpolation'
+	params['cross_check_similarity'] = False
 
 	spike_times, spike_clusters, amplitudes, \
 	 templates, channel_map, cluster_ids, cluster_quality \
@@ -21,4 +27,183 @@ def test_automerging():
 	
 	clusters, ids, labels = automerging(spike_times, spike_clusters, cluster_ids, cluster_quality, templates, params)
 
-	assert(len(ids) == len(labels))
\ No newline at end of file
+	assert(len(ids) == len(labels))
+
+
+def make_template(rng, depth, width, scale, num_channels = 384, num_samples = 61):
+
+	channels = np.arange(num_channels)
+	waveform = np.exp(-(np.arange(num_samples) - 20) ** 2 / 5.0)
+
+	template = -np.exp(-(channels - depth) ** 2 / width)[None,:] * waveform[:,None] * scale
+
+	return template + rng.randn(num_samples, num_channels) * 0.01
+
+def make_spike_train(rng, max_time, mean_isi = 3000, refractory_period = 90):
+
+	spike_times = np.cumsum(rng.exponential(mean_isi, int(max_time / mean_isi * 1.2)) + refractory_period)
+
+	return spike_times[spike_times < max_time]
+
+def make_units(seed = 0):
+
+	# clusters 0-2 split the spikes of one neuron (cluster 2 at a third of the
+	# amplitude); clusters 3 and 4 split another, with cluster 4 only in the 
+	# first half of the recording; clusters 5-7 are other neurons nearby
+	rng = np.random.RandomState(seed)
+
+	max_time = 18e6
+	neurons = [make_spike_train(rng, max_time) for n in range(5)]
+
+	labels = [rng.randint(0, 3, neurons[0].size),
+			  np.where((rng.rand(neurons[1].size) < 0.5) & (neurons[1] < max_time / 2), 4, 3),
+			  np.full(neurons[2].size, 5), np.full(neurons[3].size, 6), np.full(neurons[4].size, 7)]
+
+	spike_times = np.concatenate(neurons)
+	spike_clusters = np.concatenate(labels)
+	order = np.argsort(spike_times)
+
+	templates = np.stack([make_template(rng, 100, 10, 10), make_template(rng, 100, 10, 10), make_template(rng, 100, 10, 3),
+						  make_template(rng, 200, 15, 8), make_template(rng, 200, 15, 8), make_template(rng, 103, 40, 6),
+						  make_template(rng, 110, 5, 12), np.roll(make_template(rng, 95, 10, -8), 15, 0)])
+
+	return spike_times[order], spike_clusters[order], np.arange(8), np.array(['unsorted'] * 8), templates
+
+def reference_merges(spike_times, spike_clusters, cluster_ids, templates, params, similar_templates = None):
+
+	# every pair within distance_to_compare is scored, with no pruning
+	depths = np.array([find_depth(templates[cluster_id]) for cluster_id in cluster_ids])
+	order = np.argsort(depths)
+	interp_temps = make_interp_temps(templates, cluster_ids)
+	max_time = np.max(spike_times)
+
+	merges = []
+
+	for idx, i in enumerate(order):
+		for j in order[idx+1:]:
+			if np.abs(depths[i] - depths[j]) <= params['distance_to_compare']:
+				if params['similarity_source'] == 'kilosort':
+					sim = similar_templates[cluster_ids[i], cluster_ids[j]]
+				else:
+					sim, offset_distance = compare_templates(interp_temps[i], interp_temps[j])
+				scores = compute_isi_score(spike_times[spike_clusters == cluster_ids[i]], 
+										   spike_times[spike_clusters == cluster_ids[j]], max_time)
+				overall_score = compute_overall_score(np.max(sim), scores[-1], scores[0])
+				if overall_score > params['merge_threshold']:
+					merges.append((cluster_ids[i], cluster_ids[j]))
+
+	groups = ID_merge_groups(np.array([m[0] for m in merges], dtype = 'int'), np.array([m[1] for m in merges], dtype = 'int'))
+	merged = [unit for group in groups for unit in group]
+
+	return sorted([sorted(group) for group in groups] + [[unit] for unit in cluster_ids if unit not in merged])
+
+def run_automerging(capsys, spike_times, spike_clusters, cluster_ids, cluster_quality, templates, params, similar_templates = None):
+
+	clusters, cluster_index, labels = automerging(spike_times, spike_clusters.copy(), cluster_ids, cluster_quality, 
+												  templates, params, similar_templates)
+
+	# the original clusters in each merged cluster
+	groups = sorted([sorted(np.unique(spike_clusters[clusters == cluster]).tolist()) for cluster in np.unique(clusters)])
+
+	# pairs remaining after each stage of the cascade
+	stage_counts = {}
+	out = capsys.readouterr().out
+	for line in out.splitlines():
+		if line.endswith(' seconds') and ' pairs, ' in line:
+			name, count = line.strip().split(': ')
+			stage_counts[name] = int(count.split(' ')[0])
+
+	return groups, stage_counts, out
+
+def default_params(merge_threshold):
+
+	return {'merge_threshold' : merge_threshold, 'distance_to_compare' : 20, 'min_amplitude_ratio' : 0.0, 
+			'min_overlap' : 0.0, 'similarity_source' : 'interpolation', 'cross_check_similarity' : False}
+
+def test_automerging_cascade(capsys):
+
+	spike_times, spike_clusters, cluster_ids, cluster_quality, templates = make_units()
+
+	# with the default thresholds, the cascade finds the same merges as scoring every pair
+	for merge_threshold in [1.5, 2.5]:
+
+		params = default_params(merge_threshold)
+
+		groups, stage_counts, out = run_automerging(capsys, spike_times, spike_clusters, cluster_ids, cluster_quality, templates, params)
+
+		assert(groups == reference_merges(spike_times, spike_clusters, cluster_ids, templates, params))
+		assert(stage_counts['depth'] == 16)
+		assert(stage_counts['overlap'] == 16)
+
+		assert(groups == [[0, 1, 2], [3, 4], [5], [6], [7]])
+
+		# the waveform similarity stage only prunes pairs for merge_threshold >= 2
+		assert((stage_counts['waveform similarity'] < 16) == (merge_threshold >= 2))
+
+	# cluster 2 is a third of the amplitude of clusters 0 and 1
+	params = default_params(1.5)
+	params['min_amplitude_ratio'] = 0.5
+
+	groups, stage_counts, out = run_automerging(capsys, spike_times, spike_clusters, cluster_ids, cluster_quality, templates, params)
+
+	assert(groups == [[0, 1], [2], [3, 4], [5], [6], [7]])
+	# (and the pairs of cluster 2 with clusters 6 and 7)
+	assert(stage_counts['amplitude ratio'] == 16 - 4)
+
+	# cluster 4 only fires in the first half of the recording
+	params = default_params(1.5)
+	params['min_overlap'] = 0.6
+
+	groups, stage_counts, out = run_automerging(capsys, spike_times, spike_clusters, cluster_ids, cluster_quality, templates, params)
+
+	assert(groups == [[0, 1, 2], [3], [4], [5], [6], [7]])
+	assert(stage_counts['overlap'] == 16 - 1)
+
+	# noise clusters are not compared
+	cluster_quality[2] = 'noise'
+
+	groups, stage_counts, out = run_automerging(capsys, spike_times, spike_clusters, cluster_ids, cluster_quality, templates, default_params(1.5))
+
+	assert(groups == [[0, 1], [2], [3, 4], [5], [6], [7]])
+	assert(stage_counts['depth'] == 16 - 5)
+
+def test_automerging_kilosort_similarity(capsys):
+
+	spike_times, spike_clusters, cluster_ids, cluster_quality, templates = make_units()
+
+	similar_templates = np.full((8, 8), 0.1)
+	similar_templates[np.ix_([0, 1, 2], [0, 1, 2])] = 0.95
+	similar_templates[np.ix_([3, 4], [3, 4])] = 0.9
+	similar_templates[0, 7] = similar_templates[7, 0] = 0.6
+
+	params = default_params(2.5)
+	params['similarity_source'] = 'kilosort'
+
+	groups, stage_counts, out = run_automerging(capsys, spike_times, spike_clusters, cluster_ids, cluster_quality, templates, 
+												params, similar_templates)
+
+	# only the pairs with a similar_templates value above merge_threshold - 2 are scored
+	assert(stage_counts['waveform similarity'] == 5)
+	assert(groups == reference_merges(spike_times, spike_clusters, cluster_ids, templates, params, similar_templates))
+	assert(groups == [[0, 1, 2], [3, 4], [5], [6], [7]])
+
+	# the interpolated similarity is computed for comparison, but does not change the merges
+	params['cross_check_similarity'] = True
+
+	groups_checked, stage_counts, out = run_automerging(capsys, spike_times, spike_clusters, cluster_ids, cluster_quality, 
+														templates, params, similar_templates)
+
+	assert(groups_checked == groups)
+	assert('Waveform similarity cross-check (16 pairs)' in out)
+
+	# with one candidate pair, and with none
+	for num_good, num_pairs in [(2, 1), (1, 0)]:
+
+		quality = np.array(['noise'] * 8, dtype = object)
+		quality[:num_good] = 'good'
+
+		groups_checked, stage_counts, out = run_automerging(capsys, spike_times, spike_clusters, cluster_ids, quality, 
+															templates, params, similar_templates)
+
+		assert(stage_counts['depth'] == num_pairs)
+		assert('Waveform similarity cross-check (' + str(num_pairs) + ' pairs)' in out)
@@ -0,0 +1,55 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.modules.automerging.merges import find_comparison_pairs, ID_merge_groups, make_merges
+
+def test_find_comparison_pairs():
+
+	rng = np.random.RandomState(0)
+
+	# tied depths, and units marked not good
+	depths = np.sort(np.concatenate((rng.randint(0, 200, 60) * 5.0, [100.0, 100.0, 100.0, 105.0])))
+	is_good = rng.rand(depths.size) > 0.2
+
+	for distance_to_compare in [0, 5, 12.5, 40]:
+
+		i_index, j_index = find_comparison_pairs(depths, is_good, distance_to_compare)
+
+		expected = [(i, j) for i in range(depths.size) for j in range(i + 1, depths.size)
+					if abs(depths[i] - depths[j]) <= distance_to_compare and is_good[i] and is_good[j]]
+
+		assert(list(zip(i_index, j_index)) == expected)
+
+	# no units
+	i_index, j_index = find_comparison_pairs(np.zeros((0,)), np.zeros((0,), dtype = 'bool'), 10)
+
+	assert(i_index.size == 0 and j_index.size == 0)
+
+def test_ID_merge_groups():
+
+	# a chain
+	assert(ID_merge_groups(np.array([0, 1, 2]), np.array([1, 2, 3])) == [[0, 1, 2, 3]])
+
+	# two groups, later joined by a bridging merge
+	assert(ID_merge_groups(np.array([4, 1, 2]), np.array([7, 2, 7])) == [[1, 2, 4, 7]])
+	assert(ID_merge_groups(np.array([1, 8, 5, 2]), np.array([2, 9, 6, 6])) == [[1, 2, 5, 6], [8, 9]])
+
+	# a repeated pair, and a unit merged with itself
+	assert(ID_merge_groups(np.array([0, 0, 3, 0, 4]), np.array([1, 1, 5, 1, 4])) == [[0, 1], [3, 5]])
+
+	assert(ID_merge_groups(np.zeros((0,)), np.zeros((0,))) == [])
+
+def test_make_merges():
+
+	# template IDs are not contiguous
+	template_ids = np.array([3, 7, 8, 12, 20])
+	spike_templates = np.array([3, 7, 8, 12, 20, 7, 3, 20])
+
+	spike_clusters = make_merges([[0, 2], [1, 4]], spike_templates.copy(), spike_templates, template_ids)
+
+	assert(np.array_equal(spike_clusters, np.array([21, 22, 21, 12, 22, 22, 21, 22])))
+
+	# no merges
+	spike_clusters = make_merges([], spike_templates.copy(), spike_templates, template_ids)
+
+	assert(np.array_equal(spike_clusters, spike_templates))
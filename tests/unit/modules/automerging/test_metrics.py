@@ -0,0 +1,53 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.modules.automerging.metrics import compare_templates, template_spectrum
+
+def make_template(rng, peak_row, num_channels = 40):
+
+	template = rng.normal(scale = 0.1, size = (61, num_channels, 7))
+	template[20:30, peak_row, 3] -= np.hanning(10) * 5
+
+	return template
+
+def corrcoef_similarity(t1, t2, padding_neg, padding_pos):
+
+	# t2 is written into the same padded array at each offset in turn, so rows
+	# from the earlier offsets remain above it
+	total_channels = t1.shape[1]
+
+	m1 = np.zeros((61, total_channels + padding_neg + padding_pos, 7))
+	m1[:, padding_neg:total_channels + padding_neg, :] = t1
+	m2 = np.zeros((61, total_channels + padding_neg + padding_pos, 7))
+
+	sim = []
+
+	for offset in range(-padding_neg, padding_pos):
+		m2[:, padding_neg + offset:total_channels + padding_neg + offset, :] = t2
+		sim.append(np.corrcoef(m1.flatten(), m2.flatten())[0, 1])
+
+	return np.array(sim)
+
+def test_compare_templates():
+
+	rng = np.random.RandomState(0)
+
+	# peaks near the top and bottom edges limit the offsets to fewer than 10 rows
+	# (the depth of a template is its peak row + 3/7, from the peak column)
+	cases = [(20, 24, 10, 10), (3, 20, 10, 10), (2, 5, 5, 10), (1, 2, 2, 10), (35, 37, 10, 4), (36, 38, 10, 3), (1, 38, 10, 10)]
+
+	for row1, row2, padding_neg, padding_pos in cases:
+
+		t1 = make_template(rng, row1)
+		t2 = make_template(rng, row2)
+
+		sim, offset_distance = compare_templates(t1, t2)
+
+		assert(sim.size == padding_neg + padding_pos)
+		assert(np.allclose(sim, corrcoef_similarity(t1, t2, padding_neg, padding_pos)))
+		assert(np.array_equal(offset_distance, -np.arange(-padding_neg, padding_pos) * 10.0))
+
+		# precomputed spectra give the same result
+		sim_spectra, _ = compare_templates(t1, t2, template_spectrum(t1, 10), template_spectrum(t2, 10))
+
+		assert(np.array_equal(sim_spectra, sim))
@@ -0,0 +1,65 @@
+import pytest
+import numpy as np
+
+from ecephys_spike_sorting.modules.automerging.spike_ISI import reverse_spikes, unit_ISI_summary, find_cISI_score, \
+	find_ISI, find_cISI, find_rcISI, compare_cISI, interval_dist_mode
+
+def reverse_spikes_loop(spike_times, max_time, num_bins = 100):
+
+	# each bin in turn; a spike on the boundary of two bins is overwritten by the later bin
+	reverse_times = np.zeros(np.prod(spike_times.shape))
+	bin_size = max_time/100
+	for i in range(num_bins):
+		time_min = i*bin_size
+		time_max = (i+1)*bin_size
+		spikes_in_bin = np.flatnonzero(np.logical_and(spike_times>=time_min, spike_times<=time_max))
+		reverse_times[spikes_in_bin] = np.sort(time_max-spike_times[spikes_in_bin]+time_min)
+	return reverse_times
+
+def test_reverse_spikes():
+
+	rng = np.random.RandomState(0)
+
+	# spikes at the start and end of the recording, on bin boundaries (including
+	# repeated times), and after max_time
+	boundary_spikes = np.array([0, 0, 100, 200, 200, 250, 300, 9900, 9999, 10000, 10050])
+	spike_times = np.sort(np.concatenate((boundary_spikes, rng.randint(0, 10000, 500))))
+
+	for max_time in [10000, 10000.0, 12345.6]:
+
+		assert(np.array_equal(reverse_spikes(spike_times, max_time), reverse_spikes_loop(spike_times, max_time)))
+
+	assert(np.array_equal(reverse_spikes(boundary_spikes[:2], 10000), np.array([100.0, 100.0])))
+	assert(reverse_spikes(np.zeros((0,)), 10000).size == 0)
+
+def test_find_cISI_score_summary():
+
+	rng = np.random.RandomState(0)
+
+	max_time = 1800000
+
+	for rate1, rate2 in [(900, 1200), (900, 50000), (200000, 300000)]:
+
+		spike_times1 = np.cumsum(rng.exponential(rate1, int(max_time / rate1)) + 30)
+		spike_times2 = np.cumsum(rng.exponential(rate2, int(max_time / rate2)) + 30)
+		spike_times1 = spike_times1[spike_times1 < max_time]
+		spike_times2 = spike_times2[spike_times2 < max_time]
+
+		expected = find_cISI_score(spike_times1, spike_times2, max_time)
+		result = find_cISI_score(spike_times1, spike_times2, max_time, 
+								 unit_ISI_summary(spike_times1, max_time), unit_ISI_summary(spike_times2, max_time))
+
+		for a, b in zip(expected, result):
+			assert(np.array_equal(a, b, equal_nan = True))
+
+		# same similarities as comparing each unit's ISI with the cISI directly
+		cISI = find_cISI(spike_times1, spike_times2, max_time)
+		rcISI = find_rcISI(spike_times1, spike_times2, max_time)
+		ISI1 = find_ISI(spike_times1)
+		ISI2 = find_ISI(spike_times2)
+		sim_1, num1, numc1 = compare_cISI(ISI1, cISI, rcISI, interval_dist_mode(ISI1))
+		sim_2, num2, numc2 = compare_cISI(ISI2, cISI, rcISI, interval_dist_mode(ISI2))
+
+		assert(result[1] == np.min((1, (numc1 + numc2) / 200.)))
+		if num1 + num2 > 0:
+			assert(min(sim_1, sim_2) <= result[0] <= max(sim_1, sim_2))
@@ -0,0 +1,96 @@
+import pytest
+import numpy as np
+import os
+
+from ecephys_spike_sorting.modules.kilosort_postprocessing.postprocessing import find_double_counted_spikes, \
+	find_within_unit_overlaps, find_between_unit_overlaps, remove_spikes_from_file
+
+def make_spikes():
+
+	# units 0 and 1 peak on neighboring sites (20 um apart); unit 2 is 80 um from unit 1
+	channel_map = np.arange(6)
+	channel_pos = np.stack([np.zeros((6,)), np.arange(6) * 20.0], 1)
+
+	templates = np.zeros((3, 10, 6))
+	templates[0, 4, 0] = -1.0
+	templates[1, 4, 1] = -1.0
+	templates[2, 4, 5] = -1.0
+
+	cluster_amplitude = np.array([50.0, 100.0, 80.0])
+
+	spike_times = np.array([100, 103, 500, 502, 900, 903, 1500, 2000, 2002])
+	spike_clusters = np.array([0, 0, 0, 1, 1, 2, 2, 1, 0])
+
+	params = {'within_unit_overlap_window' : 0.0002, 'between_unit_overlap_window' : 0.0002,
+			  'between_unit_dist_um' : 30, 'deletion_mode' : 'lowAmpCluster'}
+
+	return spike_times, spike_clusters, channel_map, channel_pos, templates, cluster_amplitude, params
+
+def test_find_overlaps():
+
+	spike_times, spike_clusters, channel_map, channel_pos, templates, cluster_amplitude, params = make_spikes()
+
+	# the earlier spike of the within-unit pair
+	assert(np.array_equal(find_within_unit_overlaps(spike_times, spike_clusters, 3, 6), np.array([0])))
+
+	neighbors = np.zeros((3, 3), dtype = 'bool')
+	neighbors[0, 1] = neighbors[1, 0] = True
+
+	early, late = find_between_unit_overlaps(spike_times, spike_clusters, neighbors, 6)
+
+	assert(np.array_equal(early, np.array([2, 7])))
+	assert(np.array_equal(late, np.array([3, 8])))
+
+def test_find_double_counted_spikes():
+
+	spike_times, spike_clusters, channel_map, channel_pos, templates, cluster_amplitude, params = make_spikes()
+
+	# duplicates are removed from unit 0, which has the lower amplitude
+	keep, overlap_matrix, overlap_summary = find_double_counted_spikes(spike_times, spike_clusters, channel_map, channel_pos, 
+																	   templates, cluster_amplitude, 30000.0, params)
+
+	assert(np.array_equal(keep, np.array([0, 1, 0, 1, 1, 1, 1, 1, 0], dtype = 'bool')))
+	assert(np.array_equal(overlap_matrix, np.array([[1, 2, 0], [0, 0, 0], [0, 0, 0]])))
+	assert(np.array_equal(overlap_summary, np.array([[0, 1, 1, 2, 1], [1, 3, 0, 0, 0], [2, 2, 0, 0, 0]])))
+
+	# the later spike of each between-unit pair is removed
+	params['deletion_mode'] = 'deleteFirst'
+
+	keep, overlap_matrix, overlap_summary = find_double_counted_spikes(spike_times, spike_clusters, channel_map, channel_pos, 
+																	   templates, cluster_amplitude, 30000.0, params)
+
+	assert(np.array_equal(keep, np.array([0, 1, 1, 0, 1, 1, 1, 1, 0], dtype = 'bool')))
+	assert(np.array_equal(overlap_matrix, np.array([[1, 1, 0], [1, 0, 0], [0, 0, 0]])))
+	assert(np.array_equal(overlap_summary, np.array([[0, 2, 1, 1, 0], [1, 2, 0, 1, 0], [2, 2, 0, 0, 0]])))
+
+	# units beyond between_unit_dist_um are not compared
+	params['between_unit_dist_um'] = 10
+
+	keep, overlap_matrix, overlap_summary = find_double_counted_spikes(spike_times, spike_clusters, channel_map, channel_pos, 
+																	   templates, cluster_amplitude, 30000.0, params)
+
+	assert(np.array_equal(keep, np.array([0, 1, 1, 1, 1, 1, 1, 1, 1], dtype = 'bool')))
+	assert(np.sum(overlap_summary[:, 3]) == 0)
+
+def test_remove_spikes_from_file(tmp_path):
+
+	rng = np.random.RandomState(0)
+
+	pc_features = rng.rand(23, 3, 4).astype('float32')
+	spike_times = np.arange(23, dtype = 'uint64')[:, None]
+
+	for arr in [pc_features, np.asfortranarray(pc_features), spike_times]:
+		for keep in [rng.rand(23) > 0.5, np.ones((23,), dtype = 'bool'), np.zeros((23,), dtype = 'bool')]:
+
+			npy_file = os.path.join(str(tmp_path), 'features.npy')
+			np.save(npy_file, arr)
+
+			# chunks do not divide the number of spikes
+			remove_spikes_from_file(npy_file, keep, chunk_spikes = 5)
+
+			result = np.load(npy_file)
+
+			assert(result.dtype == arr.dtype)
+			assert(result.shape == (np.sum(keep),) + arr.shape[1:])
+			assert(np.array_equal(result, arr[keep]))
+			assert(os.listdir(str(tmp_path)) == ['features.npy'])
@@ -1,9 +1,11 @@
 import pytest
 import numpy as np
 import os
+import pandas as pd
 
-from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms
+from ecephys_spike_sorting.modules.mean_waveforms.extract_waveforms import extract_waveforms, accumulate_waveforms, get_local_channels
 import ecephys_spike_sorting.common.utils as utils
+import ecephys_spike_sorting.modules.mean_waveforms.waveform_metrics as wm
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
 
@@ -29,4 +31,158 @@ def test_extract_waveforms():
     
     data, spike_counts, coords, labels = extract_waveforms(data, spike_times, spike_clusters, cluster_ids, cluster_quality, bit_volts, sample_rate, params)
 
-    print(labels)
\ No newline at end of file
+    print(labels)
+
+def test_accumulate_waveforms():
+
+    raw_data = np.random.RandomState(0).randint(-100, 100, (1000, 4)).astype('int16')
+
+    start_samples = np.array([-5, 10, 200, 250, 400, 990])
+    groups = np.array([0, 0, 1, 0, 1, 1])
+
+    accumulators = np.zeros((2, 2, 4, 20))
+
+    counts = accumulate_waveforms(raw_data, start_samples, groups, accumulators, 0.5, 100, batch_size = 2)
+
+    # waveforms past the start or end of the data are skipped
+    assert(np.array_equal(counts, np.array([2, 2])))
+
+    waveforms = np.stack([raw_data[s:s+20, :].T * 0.5 for s in [10, 250]])
+
+    assert(np.allclose(accumulators[0, 0], np.mean(waveforms, 0)))
+    assert(np.allclose(accumulators[0, 1], np.var(waveforms, 0) * 2))
+
+
+def test_get_local_channels():
+
+    site_x = np.array([0.0, 32.0, 0.0, 32.0, 0.0, 32.0])
+    site_y = np.array([0.0, 0.0, 20.0, 20.0, 40.0, 40.0])
+
+    channel_index = get_local_channels(site_x, site_y, np.array([0, 4]), 35)
+
+    assert(np.array_equal(channel_index, np.array([[0, 1, 2], [2, 4, 5]])))
+
+    # without site positions
+    with pytest.raises(ValueError):
+        get_local_channels(np.array([]), np.array([]), np.array([0]), 35)
+
+
+def test_calculate_1D_waveform_metrics():
+
+    t = np.arange(82)
+    waveforms = np.stack([-np.exp(-(t - 20) ** 2 / 8.0) * a + np.exp(-(t - 20 - d) ** 2 / 30.0) * 0.3 * a
+                          for a, d in [(100, 10), (50, 15), (80, 8)]])
+    waveforms[2] = -waveforms[2] # peak before trough
+
+    metrics, timestamps = wm.calculate_1D_waveform_metrics(waveforms, 30000.0, 200/82)
+
+    for i in range(waveforms.shape[0]):
+
+        waveform = wm.resample(waveforms[i], timestamps.size)
+
+        assert(np.isclose(metrics['duration'][i], wm.calculate_waveform_duration(waveform, timestamps)))
+        assert(np.isclose(metrics['halfwidth'][i], wm.calculate_waveform_halfwidth(waveform, timestamps)))
+        assert(np.isclose(metrics['PT_ratio'][i], wm.calculate_waveform_PT_ratio(waveform)))
+        assert(np.isclose(metrics['repolarization_slope'][i], wm.calculate_waveform_repolarization_slope(waveform, timestamps)))
+        assert(np.isclose(metrics['recovery_slope'][i], wm.calculate_waveform_recovery_slope(waveform, timestamps)))
+
+
+def test_get_site_neighborhood():
+
+    # two columns, staggered rows
+    site_x = np.array([0.0, 16.0, 0.0, 16.0, 0.0, 16.0, 0.0, 16.0])
+    site_y = np.array([0.0, 10.0, 20.0, 30.0, 40.0, 50.0, 60.0, 70.0])
+
+    nn_candidates, sampled_sites = wm.get_site_neighborhood(site_x, site_y, 2, site_range = 4)
+
+    assert(np.array_equal(nn_candidates, np.array([0, 1, 3])))
+
+    sites, y_offsets = sampled_sites[16.0]
+    assert(sites[0] == 2)
+    assert(set(sites[1:3]) == set([1, 3]))
+    assert(np.array_equal(y_offsets, site_y[sites] - 20.0))
+
+    # without a neighbor column, only the peak channel column is sampled
+    sites, y_offsets = sampled_sites[-1]
+    assert(np.all(site_x[sites] == 0.0))
+
+
+def make_kilosort_output(path, num_channels = 8, num_samples = 60000):
+
+    rng = np.random.RandomState(0)
+
+    spike_times = np.sort(rng.choice(np.arange(100, num_samples - 100), 200, replace = False))
+    spike_clusters = np.arange(200) % 2
+
+    templates = np.zeros((2, 82 + 21, num_channels), dtype = 'float32')
+    templates[0, 41, 2] = -1.0
+    templates[1, 41, 5] = -1.0
+
+    # add the template waveform to the raw data at each spike
+    data = rng.randint(-5, 5, (num_samples, num_channels)).astype('int16')
+    for t, c in zip(spike_times, spike_clusters):
+        data[t-5:t+5, 2 + 3 * c] -= 100
+
+    data.tofile(os.path.join(path, 'continuous.dat'))
+
+    np.save(os.path.join(path, 'spike_times.npy'), spike_times.astype('uint64')[:, None])
+    np.save(os.path.join(path, 'spike_clusters.npy'), spike_clusters.astype('int32'))
+    np.save(os.path.join(path, 'spike_templates.npy'), spike_clusters.astype('int32'))
+    np.save(os.path.join(path, 'amplitudes.npy'), np.ones((200,)))
+    np.save(os.path.join(path, 'templates.npy'), templates)
+    np.save(os.path.join(path, 'whitening_mat_inv.npy'), np.eye(num_channels))
+    np.save(os.path.join(path, 'channel_map.npy'), np.arange(num_channels))
+    np.save(os.path.join(path, 'channel_positions.npy'), 
+            np.stack([np.tile([0.0, 32.0], num_channels // 2), np.repeat(np.arange(num_channels // 2) * 20.0, 2)], 1))
+
+    with open(os.path.join(path, 'cluster_Amplitude.tsv'), 'w') as f:
+        f.write('cluster_id\tAmplitude\n0\t100.0\n1\t100.0\n')
+
+    return {'directories' : {'kilosort_output_directory' : path},
+            'ephys_params' : {'ap_band_file' : os.path.join(path, 'continuous.dat'), 'num_channels' : num_channels,
+                              'sample_rate' : 30000.0, 'bit_volts' : 0.195, 'vertical_site_spacing' : 20e-6},
+            'mean_waveform_params' : {'samples_per_spike' : 82, 'pre_samples' : 20, 'num_epochs' : 1, 
+                                      'spikes_per_epoch' : 100, 'upsampling_factor' : 200/82, 'spread_threshold' : 0.12,
+                                      'site_range' : 16, 'use_C_Waves' : False, 'channel_radius_um' : 0,
+                                      'mean_waveforms_file' : os.path.join(path, 'mean_waveforms.npy')},
+            'waveform_metrics' : {'waveform_metrics_file' : os.path.join(path, 'waveform_metrics.csv')},
+            'cluster_metrics' : {'cluster_metrics_file' : os.path.join(path, 'metrics.csv')}}
+
+
+def test_calculate_mean_waveforms_without_meta(tmp_path):
+
+    from scipy.io import savemat
+    from ecephys_spike_sorting.modules.mean_waveforms.__main__ import calculate_mean_waveforms, read_site_positions
+
+    args = make_kilosort_output(str(tmp_path))
+    args['mean_waveform_params']['channel_radius_um'] = 50
+
+    # no .meta and no channel map: all channels are read, 2D metrics are NaN
+    site_x, site_y = read_site_positions(args['ephys_params']['ap_band_file'])
+    assert(site_x.size == 0)
+
+    calculate_mean_waveforms(args)
+
+    waveforms = np.load(args['mean_waveform_params']['mean_waveforms_file'])
+    metrics = pd.read_csv(args['waveform_metrics']['waveform_metrics_file'])
+
+    assert(waveforms.shape == (2, 8, 82))
+    assert(np.array_equal(np.argmin(np.min(waveforms, 2), 1), np.array([2, 5])))
+    assert(np.all(np.isnan(metrics['spread'])))
+
+    # site positions from the channel map copied next to the data
+    site_x = np.tile([0.0, 32.0], 4)
+    site_y = np.repeat(np.arange(4) * 20.0, 2)
+    savemat(os.path.join(str(tmp_path), 'continuous_chanMap.mat'), {'xcoords' : site_x[:, None], 'ycoords' : site_y[:, None]})
+
+    x, y = read_site_positions(args['ephys_params']['ap_band_file'])
+    assert(np.array_equal(x, site_x) and np.array_equal(y, site_y))
+
+    calculate_mean_waveforms(args)
+
+    # only the channels near each unit are read
+    channel_index = np.load(os.path.join(str(tmp_path), 'mean_waveforms_channels.npy'))
+    metrics = pd.read_csv(args['waveform_metrics']['waveform_metrics_file'])
+
+    assert(channel_index.shape[0] == 2 and channel_index.shape[1] < 8)
+    assert(metrics.shape[0] == 2)
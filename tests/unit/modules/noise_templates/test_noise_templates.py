@@ -2,7 +2,10 @@ import pytest
 import numpy as np
 import os
 
+from scipy.interpolate import griddata
+
 from ecephys_spike_sorting.modules.noise_templates.id_noise_templates import id_noise_templates_rf
+import ecephys_spike_sorting.modules.noise_templates.id_noise_templates as nt
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
@@ -20,4 +23,37 @@ def test_noise_templates():
 	
 	cluster_ids, is_noise = id_noise_templates_rf(spike_times, spike_clusters, cluster_ids, templates, params)
 
-	assert(len(cluster_ids) == len(is_noise))
\ No newline at end of file
+	assert(len(cluster_ids) == len(is_noise))
+
+
+def test_interpolate_template():
+
+	channel_map = np.delete(np.arange(48), [10])
+
+	template = np.random.RandomState(0).randn(5, channel_map.size)
+
+	interp_temp = nt.interpolate_template(template, channel_map)
+
+	loc_a = nt.actual_channel_locations(channel_map)
+	loc_i = nt.interp_channel_locations(channel_map)
+
+	for t in range(template.shape[0]):
+		expected = griddata(loc_a, template[t,:], loc_i, method='cubic', fill_value=0, rescale=False)
+		assert(np.allclose(interp_temp[t].flatten(), expected, atol=1e-4))
+
+def test_interpolation_operator_cache():
+
+	channel_map = np.delete(np.arange(48), [10])
+
+	x_i, y_i, operator = nt.make_interpolation_operator(channel_map)
+
+	# built once for each channel map, and reused by interpolate_template
+	assert(nt.make_interpolation_operator(channel_map.copy())[2] is operator)
+	assert(nt.make_interpolation_operator(list(channel_map))[2] is operator)
+	assert(nt.make_interpolation_operator(np.arange(48))[2] is not operator)
+
+	template = np.random.RandomState(0).randn(5, channel_map.size)
+
+	assert(np.array_equal(nt.interpolate_template(template, channel_map), 
+						  nt.interpolate_template(template, channel_map, (x_i, y_i, operator))))
+
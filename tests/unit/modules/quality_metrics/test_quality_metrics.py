@@ -1,8 +1,14 @@
 import pytest
 import numpy as np
 import os
+from scipy import sparse
+from sklearn.metrics import silhouette_score
 
-from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_metrics
+from ecephys_spike_sorting.modules.quality_metrics.metrics import calculate_metrics, ccg, ccg_batch, segment_medians, \
+	epoch_rows, _share_array, _attach_array, calculate_pc_metrics, pairwise_silhouette_scores
+import ecephys_spike_sorting.modules.quality_metrics.metrics as metrics
+from ecephys_spike_sorting.modules.quality_metrics.metrics_cache import MetricsCache, get_data_key, \
+	CLUSTER_METRICS, PC_METRICS
 import ecephys_spike_sorting.common.utils as utils
 
 DATA_DIR = os.environ.get('ECEPHYS_SPIKE_SORTING_DATA', False)
@@ -31,6 +37,234 @@ def te_st_quality_metrics():
 
 	print(metrics)
 
+def test_ccg():
+
+	st = np.array([0.0, 0.002, 0.0035, 1.0])
+	nbins = 500
+
+	K, Qi, Q00, Q01, Ri = ccg(st, st, nbins, 0.001, True)
+
+	assert(K[nbins] == 0)
+	assert(K[nbins-2] == 2 and K[nbins+2] == 2)
+	assert(K[nbins-4] == 1 and K[nbins+4] == 1)
+	assert(np.sum(K) == 6)
+
+	Kb, Qib, Q00b, Q01b, Rib = ccg_batch([st, st[:2]], [st, st[:2]], nbins, 0.001, True, max_pairs = 2)
+
+	assert(np.array_equal(Kb[0], K))
+	assert(np.array_equal(Qib[0], Qi))
+	assert(np.sum(Kb[1]) == 2)
+
+def test_segment_medians():
+
+	# two clusters, sorted by cluster and then time
+	times = np.array([0.5, 1.5, 2.5, 3.5, 0.5, 0.7, 0.9, 2.5])
+	values = np.array([10., 20., 30., 40., 1., 3., 2., 5.])
+	cluster_offsets = np.array([0, 4, 8])
+
+	medians = segment_medians(times, values, cluster_offsets, np.array([0., 2.]), np.array([2., 4.]), 2)
+
+	assert(np.array_equal(medians[0], np.array([15., 35.])))
+	assert(medians[1,0] == 2.)
+	assert(np.isnan(medians[1,1]))
+
+def test_share_array(tmp_path):
+
+	pc_features = np.random.RandomState(0).rand(100, 3, 4).astype('float32')
+	np.save(os.path.join(str(tmp_path), 'pc_features.npy'), pc_features)
+	mapped = np.load(os.path.join(str(tmp_path), 'pc_features.npy'), mmap_mode = 'r')
+
+	in_epoch = (np.arange(100) >= 20) * (np.arange(100) < 70)
+
+	# a contiguous block of a memory-mapped array is re-opened from its file
+	shared_blocks = []
+	desc = _share_array(epoch_rows(mapped, in_epoch), shared_blocks)
+	arr, shm = _attach_array(desc)
+
+	assert(desc[0] == 'memmap')
+	assert(len(shared_blocks) == 0)
+	assert(np.array_equal(arr, pc_features[in_epoch]))
+
+	# other rows are copied to shared memory
+	desc = _share_array(epoch_rows(mapped, np.arange(100) % 2 == 0), shared_blocks)
+	arr, shm = _attach_array(desc)
+
+	assert(desc[0] == 'shm')
+	assert(np.array_equal(arr, pc_features[::2]))
+
+	del arr
+	shm.close()
+	for block in shared_blocks:
+		block.close()
+		block.unlink()
+
+def make_sorting(num_spikes = 4000, num_units = 8, num_channels = 16, num_features = 16, max_peak_channel = 6, seed = 0):
+
+	# small synthetic sort: clusters equal templates, PC features centered per unit
+	rng = np.random.RandomState(seed)
+
+	spike_times = np.sort(rng.uniform(0, 300., num_spikes))
+	spike_clusters = rng.randint(0, num_units, num_spikes)
+	spike_templates = spike_clusters.copy()
+	amplitudes = rng.gamma(5, 3, num_spikes)
+
+	channel_map = np.arange(num_channels)
+	channel_pos = np.stack([np.tile([16, 48, 0, 32], num_channels // 4), 
+							np.repeat(np.arange(num_channels // 2) * 20, 2)], 1).astype('float')
+
+	# every template has PCs on the same channels
+	peak_channels = rng.randint(0, max_peak_channel, num_units)
+	pc_feature_ind = np.tile(np.arange(num_features), (num_units, 1)).astype('uint32')
+	pc_features = rng.normal(size = (num_spikes, 3, num_features)).astype('float32')
+	pc_features[np.arange(num_spikes), 0, peak_channels[spike_clusters]] += 4 + (spike_clusters % 4) * 2
+	templates = rng.normal(size = (num_units, 61, num_channels))
+
+	params = {'isi_threshold' : 0.0015, 'min_isi' : 0.0, 'tbin_sec' : 0.001, 'max_radius_um' : 68,
+			  'max_spikes_for_unit' : 300, 'max_spikes_for_nn' : 1000, 'n_neighbors' : 4, 'n_silhouette' : 2000,
+			  'drift_metrics_min_spikes_per_interval' : 10, 'drift_metrics_interval_s' : 100, 'include_pcs' : True,
+			  'multiprocessing_worker_count' : 1, 'spike_depth_chunk_size' : 700}
+
+	return spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, \
+		templates, pc_features, pc_feature_ind, params
+
+def test_pc_metrics_worker_count(tmp_path):
+
+	spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, \
+		templates, pc_features, pc_feature_ind, params = make_sorting()
+
+	np.save(os.path.join(str(tmp_path), 'pc_features.npy'), pc_features)
+	mapped = np.load(os.path.join(str(tmp_path), 'pc_features.npy'), mmap_mode = 'r')
+
+	cluster_ids = np.unique(spike_clusters)
+	total_units = np.max(spike_clusters) + 1
+	template_ids = np.arange(total_units)
+
+	def pc_metrics(features, worker_count):
+		np.random.seed(1)
+		return calculate_pc_metrics(spike_clusters, spike_templates, total_units, cluster_ids, template_ids,
+									features, pc_feature_ind, channel_pos, params['max_radius_um'], 
+									params['max_spikes_for_unit'], params['max_spikes_for_nn'], params['n_neighbors'],
+									worker_count = worker_count)
+
+	serial = pc_metrics(pc_features, 1)
+
+	# subsamples are drawn before dispatch, so the worker count does not change the result
+	for features in [pc_features, mapped]:
+		parallel = pc_metrics(features, 4)
+		for expected, actual in zip(serial, parallel):
+			assert(np.array_equal(expected, actual, equal_nan = True))
+
+	assert(np.all(np.isfinite(serial[0][cluster_ids])))
+
+def test_pairwise_silhouette_scores():
+
+	rng = np.random.RandomState(0)
+
+	X = rng.normal(size = (200, 6))
+	labels = rng.choice([1, 3, 4, 7], 200)
+	X += labels[:,None] * 0.5
+	
+	# cluster 9 has a single spike
+	labels[17] = 9
+
+	X_sparse = X.copy()
+	X_sparse[:, 3:] = 0
+	X_sparse[rng.rand(200) < 0.3, :] = 0
+
+	for features in [X, sparse.csr_matrix(X_sparse)]:
+
+		cluster_ids, pair_scores = pairwise_silhouette_scores(features, labels)
+
+		assert(np.array_equal(cluster_ids, np.array([1, 3, 4, 7, 9])))
+
+		for idx1 in range(cluster_ids.size):
+			for idx2 in range(idx1 + 1, cluster_ids.size):
+				in_pair = np.isin(labels, cluster_ids[[idx1, idx2]])
+				expected = silhouette_score(features[np.where(in_pair)[0],:], labels[in_pair])
+				assert(np.isclose(pair_scores[idx1, idx2], expected, rtol = 1e-4, atol = 1e-6))
+				assert(np.isclose(pair_scores[idx2, idx1], expected, rtol = 1e-4, atol = 1e-6))
+
+def test_metrics_cache(tmp_path, monkeypatch):
+
+	spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, \
+		templates, pc_features, pc_feature_ind, params = make_sorting(num_units = 12, num_channels = 48, 
+																	  num_features = 48, max_peak_channel = 48)
+
+	# no random subsampling for the PC metrics, so recomputed values match a full run
+	params['max_spikes_for_unit'] = 10000
+	cache_file = os.path.join(str(tmp_path), 'quality_metrics_cache.csv')
+
+	def data_key(params):
+		return get_data_key(params, spike_times, spike_templates, amplitudes, pc_feature_ind, channel_pos)
+
+	# record which units each run recomputes
+	computed = {}
+	isi_violations = metrics.calculate_isi_violations
+	pc_metrics = metrics.calculate_pc_metrics
+
+	def record_isi_violations(*args):
+		computed['cluster'] = args[-1]
+		return isi_violations(*args)
+
+	def record_pc_metrics(*args):
+		computed['pc'] = args[-1]
+		return pc_metrics(*args)
+
+	monkeypatch.setattr(metrics, 'calculate_isi_violations', record_isi_violations)
+	monkeypatch.setattr(metrics, 'calculate_pc_metrics', record_pc_metrics)
+
+	def run(spike_clusters, cache):
+		np.random.seed(0)
+		return calculate_metrics(spike_times, spike_clusters, spike_templates, amplitudes, channel_map, channel_pos, 
+								 templates, pc_features, pc_feature_ind, params, cache = cache)
+
+	cache = MetricsCache(cache_file, data_key(params))
+	run(spike_clusters, cache)
+	cache.save()
+
+	assert(np.array_equal(computed['cluster'], np.arange(12)))
+
+	# split cluster 2; the new cluster 12 keeps template 2
+	split_clusters = spike_clusters.copy()
+	in_cluster = np.where(spike_clusters == 2)[0]
+	split_clusters[in_cluster[::2]] = 12
+
+	metrics_split = run(split_clusters, MetricsCache(cache_file, data_key(params)))
+
+	assert(np.array_equal(computed['cluster'], np.array([2, 12])))
+
+	# PC metrics are also recomputed for units whose neighborhood changed
+	def neighborhoods(spike_clusters, template_ids):
+		return metrics.calculate_pc_neighborhoods(template_ids.size, np.unique(spike_clusters), template_ids, pc_features,
+												  pc_feature_ind, channel_pos, params['max_radius_um'], 
+												  utils.get_cluster_spike_index(spike_clusters, template_ids.size))
+
+	before = neighborhoods(spike_clusters, np.arange(12))
+	after = neighborhoods(split_clusters, np.append(np.arange(12), 2))
+
+	expected = [cid for cid in range(13) if cid in (2, 12) or np.any(np.isin(after[cid][0], [2, 12])) or 
+				not np.array_equal(before[cid][0], after[cid][0]) or not np.array_equal(before[cid][1], after[cid][1])]
+
+	assert(np.array_equal(computed['pc'], np.array(expected)))
+	assert(len(expected) < 13)
+
+	# metrics equal a run without the cache
+	metrics_full = run(split_clusters, None)
+
+	assert(np.array_equal(metrics_split[CLUSTER_METRICS + PC_METRICS].values, 
+						  metrics_full[CLUSTER_METRICS + PC_METRICS].values, equal_nan = True))
+
+	# changing a metric parameter discards the cache
+	changed = dict(params, isi_threshold = 0.002)
+	cache = MetricsCache(cache_file, data_key(changed))
+
+	assert(cache.table.shape[0] == 0)
+
+	run(split_clusters, cache)
+
+	assert(np.array_equal(computed['cluster'], np.arange(13)))
+	assert(np.array_equal(computed['pc'], np.arange(13)))
+
 if __name__ == "__main__":
     #test_quality_metrics()
     pass
\ No newline at end of file